@@ -0,0 +1,301 @@
+"""
+Replays a trace of Telegram updates through the real GPTBot stack, talking to local stand-ins for the
+Telegram Bot API and OpenAI, and reports throughput, latency percentiles, thread count and memory.
+
+    python benchmarks/bot_benchmark.py --duration 30 --rate 20 --openai-latency 1 --openai-429-rate 0.05
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.chdir(REPO_ROOT)  # Translations are loaded from loc/ relative to the working directory
+
+import openai
+from telegram import Update
+
+from akgpt_bot import GPTBot
+from localization import loc
+from fake_openai import FakeOpenAIServer, FakeOpenAIConfig, ANSWER_WORDS
+from fake_telegram import FakeTelegramServer, FakeTelegramConfig
+from traces import generate_trace, load_trace, save_trace, build_update
+
+class ResponseTracker:
+    """
+    A class for matching the Bot API calls the bot makes to the replayed updates they answer.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.placeholder_text = loc("gpt_thinking", "en")
+        self.started = {}  # event id -> (kind, start time)
+        self.gpt_by_message = {}  # message id of a question -> event id
+        self.gpt_by_placeholder = {}  # message id of a streamed reply -> event id
+        self.markers = {}  # event id -> marker the answer ends with
+        self.replies = {}  # message id of a command -> event id
+        self.private_waiters = defaultdict(deque)  # admin chat id -> event ids waiting for a message there
+        self.callback_queries = {}  # callback query id -> event id
+        self.results = []  # (kind, latency, succeeded)
+        self.last_response_time = None
+
+    def start(self, event_id: str, kind: str, chat_id: int, user_id: int, message_id: int):
+        with self.lock:
+            self.started[event_id] = (kind, time.monotonic())
+            if kind == "gpt":
+                self.gpt_by_message[message_id] = event_id
+                self.markers[event_id] = event_id
+            elif kind == "command":
+                self.replies[message_id] = event_id
+            elif kind in ("admin_menu", "admin_click"):
+                self.private_waiters[user_id].append(event_id)
+                self.replies[message_id] = event_id
+                if kind == "admin_click":
+                    self.callback_queries[event_id] = event_id
+
+    def pending(self) -> int:
+        with self.lock:
+            return len(self.started)
+
+    def on_call(self, method: str, params: dict, result):
+        with self.lock:
+            if method == "answerCallbackQuery":
+                self._finish(self.callback_queries.pop(params.get("callback_query_id"), None), True)
+            elif method == "sendMessage":
+                self._on_message(params, result)
+            elif method == "editMessageText":
+                event_id = self.gpt_by_placeholder.get(int(params["message_id"]))
+                if event_id and self.markers.get(event_id) in params.get("text", ""):
+                    self._finish(event_id, True)
+            elif method == "sendDocument":
+                self._finish(self.gpt_by_message.get(int(params.get("reply_to_message_id") or 0)), True)
+
+    def _on_message(self, params: dict, result):
+        text = params.get("text", "")
+        reply_to = int(params.get("reply_to_message_id") or 0)  # python-telegram-bot posts form fields as strings
+        gpt_event_id = self.gpt_by_message.get(reply_to)
+        if gpt_event_id:
+            if text == self.placeholder_text:
+                self.gpt_by_placeholder[result["message_id"]] = gpt_event_id
+            else:
+                # Long answers are sent in parts with the marker at the end of the last one; other texts are errors
+                marker = self.markers.get(gpt_event_id)
+                if marker in text or not text.startswith(tuple(ANSWER_WORDS)):
+                    self._finish(gpt_event_id, marker in text)
+            return
+        if reply_to in self.replies:
+            self._finish(self.replies.pop(reply_to), True)
+            return
+        waiters = self.private_waiters.get(int(params["chat_id"]))
+        while waiters:
+            event_id = waiters.popleft()
+            if event_id in self.started:
+                self._finish(event_id, True)
+                return
+
+    def _finish(self, event_id, succeeded: bool):
+        if event_id is None or event_id not in self.started:
+            return
+        kind, start_time = self.started.pop(event_id)
+        self.last_response_time = time.monotonic()
+        self.results.append((kind, self.last_response_time - start_time, succeeded))
+
+class ResourceSampler:
+    """
+    A class for sampling the bot's thread count and the process RSS while the benchmark runs.
+    Threads of the fake servers are not counted.
+    """
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.max_threads = 0
+        self.max_rss = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="fake-resource-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def sample(self):
+        bot_threads = [thread for thread in threading.enumerate()
+                       if not thread.name.startswith("fake-") and "process_request_thread" not in thread.name]
+        self.max_threads = max(self.max_threads, len(bot_threads))
+        self.max_rss = max(self.max_rss, current_rss())
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+def current_rss() -> int:
+    with open("/proc/self/status") as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(sorted_values, share: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(int(share * len(sorted_values)), len(sorted_values) - 1)]
+
+def summarize(results, kind=None) -> dict:
+    latencies = sorted(latency for result_kind, latency, _ in results if kind in (None, result_kind))
+    failed = sum(1 for result_kind, _, succeeded in results if kind in (None, result_kind) and not succeeded)
+    return {
+        "count": len(latencies),
+        "failed": failed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+    }
+
+def run_benchmark(events, args) -> dict:
+    admin_ids = {event.user_id for event in events if event.kind in ("admin_menu", "admin_click")}
+    tracker = ResponseTracker()
+    telegram_server = FakeTelegramServer(
+        FakeTelegramConfig(args.telegram_latency, args.telegram_error_rate, args.telegram_429_rate, args.retry_after, tuple(admin_ids)),
+        on_call=tracker.on_call)
+    openai_server = FakeOpenAIServer(FakeOpenAIConfig(
+        args.openai_latency, args.token_delay, args.answer_words, args.openai_error_rate, args.openai_429_rate, args.retry_after))
+    telegram_server.start()
+    openai_server.start()
+    openai.api_base = openai_server.api_base
+
+    storage_dir = tempfile.TemporaryDirectory()
+    bot = GPTBot("123456:benchmark", "benchmark", os.path.join(storage_dir.name, "benchmark.db"),
+                 telegram_base_url=telegram_server.base_url)
+    bot.input_handler.stream_responses = not args.no_streaming
+    bot.add_handlers()
+    dispatcher = bot.updater.dispatcher
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+
+    # Admin menu buttons carry signed callback data naming the group the menu was opened for
+    callback_codec = bot.input_handler.admin_menu_manager.callback_codec
+    admin_groups = {}  # admin user id -> group of the admin's last /adminmenu
+
+    sampler = ResourceSampler()
+    sampler.start()
+    rss_before = current_rss()
+    start_time = time.monotonic()
+    for index, event in enumerate(events, start=1):
+        delay = start_time + event.at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        event_id = f"[q{index}]"
+        if event.kind == "admin_menu":
+            admin_groups[event.user_id] = event.chat_id
+        elif event.kind == "admin_click" and callback_codec.decode(event.data) is None:
+            event = event._replace(data=callback_codec.encode(event.data, admin_groups.get(event.user_id, event.chat_id)))
+        update = Update.de_json(build_update(event, index, index, event_id), bot.updater.bot)
+        if event.kind != "text":
+            tracker.start(event_id, event.kind, event.chat_id, event.user_id, index)
+        dispatcher.update_queue.put(update)
+    replay_time = time.monotonic() - start_time
+
+    drain_deadline = time.monotonic() + args.drain_timeout
+    while tracker.pending() and time.monotonic() < drain_deadline:
+        time.sleep(0.1)
+    sampler.sample()
+    sampler.stop()
+    end_time = tracker.last_response_time or time.monotonic()
+
+    report = {
+        "updates": len(events),
+        "replay_seconds": replay_time,
+        "offered_updates_per_second": len(events) / replay_time if replay_time else float("nan"),
+        "answered_per_second": len(tracker.results) / (end_time - start_time) if tracker.results else 0,
+        "timed_out": tracker.pending(),
+        "latency": {kind: summarize(tracker.results, kind) for kind in sorted({result[0] for result in tracker.results})},
+        "latency_all": summarize(tracker.results),
+        "max_threads": sampler.max_threads,
+        "rss_before_mb": rss_before / 2 ** 20,
+        "max_rss_mb": sampler.max_rss / 2 ** 20,
+        "message_sender": bot.message_sender.get_stats(),
+        "gpt_engine": {"coalesced_requests": bot.gpt_request_engine.coalesced_requests, "upstream_retries": bot.gpt_request_engine.client.retries},
+        "fake_telegram": dict(telegram_server.stats),
+        "fake_openai": dict(openai_server.stats),
+    }
+
+    dispatcher.stop()
+    dispatcher_thread.join()
+    bot.shutdown()
+    telegram_server.stop()
+    openai_server.stop()
+    storage_dir.cleanup()
+    return report
+
+def print_report(report: dict):
+    print(f"Updates: {report['updates']} in {report['replay_seconds']:.1f} s ({report['offered_updates_per_second']:.1f}/s offered)")
+    print(f"Answered: {report['answered_per_second']:.1f}/s, timed out: {report['timed_out']}")
+    print(f"{'kind':<12}{'count':>7}{'failed':>8}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}")
+    for kind, summary in list(report["latency"].items()) + [("all", report["latency_all"])]:
+        print(f"{kind:<12}{summary['count']:>7}{summary['failed']:>8}{summary['p50']:>9.3f}{summary['p95']:>9.3f}{summary['p99']:>9.3f}")
+    print(f"Threads (max): {report['max_threads']}, RSS: {report['rss_before_mb']:.1f} MB before, {report['max_rss_mb']:.1f} MB max")
+    print(f"Message sender: {report['message_sender']}")
+    print(f"GPT engine: {report['gpt_engine']}")
+    print(f"Fake Telegram: {report['fake_telegram']}, fake OpenAI: {report['fake_openai']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    trace = parser.add_argument_group("trace")
+    trace.add_argument("--trace", help="Replay this trace file instead of a synthetic one")
+    trace.add_argument("--save-trace", help="Write the replayed trace to this file")
+    trace.add_argument("--duration", type=float, default=30, help="Seconds of synthetic traffic")
+    trace.add_argument("--rate", type=float, default=10, help="Synthetic updates per second")
+    trace.add_argument("--private-chats", type=int, default=50)
+    trace.add_argument("--group-chats", type=int, default=5)
+    trace.add_argument("--group-share", type=float, default=0.5, help="Share of updates sent in groups")
+    trace.add_argument("--gpt-share", type=float, default=0.7, help="Share of updates that are /gpt questions")
+    trace.add_argument("--admin-share", type=float, default=0.05, help="Share of updates that open the admin menu")
+    trace.add_argument("--burst-interval", type=int, default=10, help="Seconds between /gpt bursts in a group, 0 for none")
+    trace.add_argument("--burst-size", type=int, default=10)
+    trace.add_argument("--seed", type=int, default=1)
+
+    upstream = parser.add_argument_group("stand-ins")
+    upstream.add_argument("--telegram-latency", type=float, default=0.05)
+    upstream.add_argument("--telegram-error-rate", type=float, default=0.0)
+    upstream.add_argument("--telegram-429-rate", type=float, default=0.0)
+    upstream.add_argument("--openai-latency", type=float, default=0.5)
+    upstream.add_argument("--token-delay", type=float, default=0.01, help="Seconds between streamed answer chunks")
+    upstream.add_argument("--answer-words", type=int, default=60)
+    upstream.add_argument("--openai-error-rate", type=float, default=0.0)
+    upstream.add_argument("--openai-429-rate", type=float, default=0.0)
+    upstream.add_argument("--retry-after", type=int, default=1, help="Retry-After of the fake 429 responses")
+
+    parser.add_argument("--no-streaming", action="store_true", help="Send answers in one message instead of streaming them")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="Seconds to wait for answers after the trace ends")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.getLogger().setLevel(args.log_level)
+    if args.trace:
+        events = load_trace(args.trace)
+    else:
+        events = generate_trace(args.duration, args.rate, args.private_chats, args.group_chats, args.group_share,
+                                args.gpt_share, args.admin_share, args.burst_interval, args.burst_size, args.seed)
+    if args.save_trace:
+        save_trace(events, args.save_trace)
+
+    report = run_benchmark(events, args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FakeOpenAIConfig = namedtuple("FakeOpenAIConfig", [
+    "latency",  # Seconds until the response, or the first streamed chunk
+    "token_delay",  # Seconds between streamed chunks
+    "answer_words",  # Words in every answer
+    "error_rate",  # Share of requests failing with 500
+    "rate_limit_rate",  # Share of requests failing with 429
+    "retry_after",  # Retry-After header sent with 429s
+], defaults=[0.5, 0.02, 60, 0.0, 0.0, 1])
+
+# Benchmark questions carry a marker that the answer repeats at its very end
+MARKER = re.compile(r"\[q\d+\]")
+ANSWER_WORDS = ["lorem", "ipsum", "dolor", "sit", "amet"]
+
+class FakeOpenAIServer:
+    """
+    A class for a local stand-in for the OpenAI chat completion API, with configurable latency, errors and 429s.
+    Answers end with the marker found in the question, so the benchmark can tell when an answer was delivered.
+    """
+    def __init__(self, config: FakeOpenAIConfig, host="127.0.0.1", port=0):
+        self.config = config
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+        self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.server_thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, stat: str):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def _make_answer(self, request: dict) -> str:
+        question = request["messages"][-1]["content"]
+        marker = MARKER.search(question)
+        words = " ".join(random.choice(ANSWER_WORDS) for _ in range(self.config.answer_words))
+        return f"{words} {marker.group(0) if marker else ''}".strip()
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                server._count("requests")
+                time.sleep(server.config.latency)
+
+                failure = random.random()
+                if failure < server.config.rate_limit_rate:
+                    server._count("rate_limited")
+                    self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                                    {"Retry-After": str(server.config.retry_after)})
+                    return
+                if failure < server.config.rate_limit_rate + server.config.error_rate:
+                    server._count("errors")
+                    self._send_json(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+                    return
+
+                answer = server._make_answer(request)
+                if request.get("stream"):
+                    self._send_stream(answer)
+                    return
+                self._send_json(200, {
+                    "id": "chatcmpl-benchmark",
+                    "object": "chat.completion",
+                    "model": request.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 50, "completion_tokens": len(answer) // 4, "total_tokens": 50 + len(answer) // 4},
+                })
+
+            def _send_json(self, status: int, body: dict, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, answer: str):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                words = answer.split(" ")
+                for index, word in enumerate(words):
+                    chunk = {"choices": [{"index": 0, "delta": {"content": word if index == 0 else f" {word}"}}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(server.config.token_delay)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+        return RequestHandler
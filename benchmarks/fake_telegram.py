@@ -0,0 +1,133 @@
+import itertools
+import json
+import random
+import threading
+import time
+from collections import namedtuple
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FakeTelegramConfig = namedtuple("FakeTelegramConfig", [
+    "latency",  # Seconds every Bot API call takes
+    "error_rate",  # Share of sends failing with a 502 network error
+    "rate_limit_rate",  # Share of sends failing with 429 Too Many Requests
+    "retry_after",  # retry_after returned with 429s
+    "admin_user_ids",  # Users reported as administrators of every group
+], defaults=[0.05, 0.0, 0.0, 1, ()])
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "AKGPTBot", "username": "AKGPTBot"}
+
+# Calls that post to a chat and are subject to errors and flood control
+SEND_METHODS = {"sendMessage", "editMessageText", "sendDocument"}
+
+class FakeTelegramServer:
+    """
+    A class for a local stand-in for the Telegram Bot API, with configurable latency, errors and 429s.
+    Every call is reported to `on_call(method, params, result)`, so the benchmark can match answers to updates.
+    """
+    def __init__(self, config: FakeTelegramConfig, on_call=None, host="127.0.0.1", port=0):
+        self.config = config
+        self.on_call = on_call
+        self.message_ids = itertools.count(1_000_000)  # Kept apart from the ids of replayed messages
+        self.stats_lock = threading.Lock()
+        self.stats = {"calls": 0, "errors": 0, "rate_limited": 0}
+        self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name="fake-telegram", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self.server_thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, stat: str):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def _make_message(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        return {
+            "message_id": int(params.get("message_id") or next(self.message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            "from": BOT_USER,
+            "text": params.get("text") or params.get("caption") or "",
+        }
+
+    def _make_chat_member(self, user_id: int, status: str) -> dict:
+        return {"user": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}, "status": status}
+
+    def handle_call(self, method: str, params: dict):
+        """
+        Returns (HTTP status, response body) for a Bot API call.
+        """
+        self._count("calls")
+        time.sleep(self.config.latency)
+        if method in SEND_METHODS:
+            failure = random.random()
+            if failure < self.config.rate_limit_rate:
+                self._count("rate_limited")
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                             "parameters": {"retry_after": self.config.retry_after}}
+            if failure < self.config.rate_limit_rate + self.config.error_rate:
+                self._count("errors")
+                return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+
+        if method in SEND_METHODS:
+            result = self._make_message(params)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method == "getChat":
+            chat_id = int(params["chat_id"])
+            result = {"id": chat_id, "type": "group" if chat_id < 0 else "private", "title": f"Chat {chat_id}"}
+        elif method == "getChatAdministrators":
+            result = [self._make_chat_member(user_id, "administrator") for user_id in self.config.admin_user_ids]
+        elif method == "getChatMember":
+            user_id = int(params["user_id"])
+            result = self._make_chat_member(user_id, "administrator" if user_id in self.config.admin_user_ids else "member")
+        else:
+            # sendChatAction, answerCallbackQuery, setMyCommands, ...
+            result = True
+
+        if self.on_call:
+            self.on_call(method, params, result)
+        return 200, {"ok": True, "result": result}
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, response = server.handle_call(method, self._parse_params(body))
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _parse_params(self, body: bytes) -> dict:
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    # File uploads: keep the plain fields, e.g. chat_id and caption
+                    message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+                    return {part.get_param("name", header="content-disposition"): part.get_content()
+                            for part in message.iter_parts() if not part.get_filename()}
+                return json.loads(body) if body else {}
+
+        return RequestHandler
@@ -0,0 +1,130 @@
+import json
+import random
+import time
+from collections import namedtuple
+
+from fake_telegram import BOT_USER
+
+# One update to replay `at` seconds after the start. `kind` decides what counts as the bot's response:
+# "gpt", "command" (a reply), "admin_menu" and "admin_click" (a message to the admin's private chat), or "text" (none).
+TraceEvent = namedtuple("TraceEvent", ["at", "kind", "chat_id", "user_id", "text", "data"], defaults=[None, None])
+
+ADMIN_CLICKS = ["show_limit", "show_remaining_messages", "show_dollar_limit", "show_remaining_dollars", "show_bot_description"]
+QUESTIONS = ["What can you do?", "Explain recursion briefly.", "How do I reverse a list in Python?", "Summarize the rules of chess."]
+COMMANDS = ["/start", "/help"]
+
+def generate_trace(duration=30, rate=10, private_chats=50, group_chats=5, group_share=0.5, gpt_share=0.7, admin_share=0.05,
+                   burst_interval=10, burst_size=10, seed=None) -> list:
+    """
+    Returns a synthetic trace: updates arrive at `rate` per second on average, `gpt_share` of them /gpt questions,
+    `admin_share` admin menu sessions and the rest /start and /help; every `burst_interval` seconds
+    `burst_size` users of one group ask at once.
+    """
+    rng = random.Random(seed)
+    group_ids = [-(1000 + index) for index in range(group_chats)]
+    admin_ids = {group_id: 900000 + index for index, group_id in enumerate(group_ids)}
+    events = []
+
+    def pick_chat():
+        if group_ids and rng.random() < group_share:
+            return rng.choice(group_ids), rng.randint(5000, 5999)
+        user_id = 1000 + rng.randrange(private_chats)
+        return user_id, user_id
+
+    at = 0.0
+    while True:
+        at += rng.expovariate(rate)
+        if at >= duration:
+            break
+        chance = rng.random()
+        if chance < gpt_share:
+            chat_id, user_id = pick_chat()
+            events.append(TraceEvent(at, "gpt", chat_id, user_id, f"/gpt {rng.choice(QUESTIONS)}"))
+        elif chance < gpt_share + admin_share and group_ids:
+            group_id = rng.choice(group_ids)
+            admin_id = admin_ids[group_id]
+            events.append(TraceEvent(at, "admin_menu", group_id, admin_id, "/adminmenu"))
+            events.append(TraceEvent(at + 0.5, "admin_click", admin_id, admin_id, data=rng.choice(ADMIN_CLICKS)))
+        else:
+            chat_id, user_id = pick_chat()
+            events.append(TraceEvent(at, "command", chat_id, user_id, rng.choice(COMMANDS)))
+
+    if burst_interval and burst_size and group_ids:
+        for burst_at in range(burst_interval, int(duration), burst_interval):
+            group_id = rng.choice(group_ids)
+            for _ in range(burst_size):
+                events.append(TraceEvent(float(burst_at), "gpt", group_id, rng.randint(5000, 5999), f"/gpt {rng.choice(QUESTIONS)}"))
+
+    return sorted(events, key=lambda event: event.at)
+
+def load_trace(path: str) -> list:
+    """
+    Reads a trace saved by `save_trace`. Lines may instead hold a recorded Telegram update as {"at": ..., "update": {...}}.
+    """
+    events = []
+    with open(path, encoding="utf-8") as trace_file:
+        for line in trace_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "update" in record:
+                events.append(event_from_update(record["at"], record["update"]))
+            else:
+                events.append(TraceEvent(**record))
+    return sorted(events, key=lambda event: event.at)
+
+def save_trace(events, path: str):
+    with open(path, "w", encoding="utf-8") as trace_file:
+        for event in events:
+            trace_file.write(json.dumps(event._asdict(), ensure_ascii=False) + "\n")
+
+def event_from_update(at: float, update: dict) -> TraceEvent:
+    if "callback_query" in update:
+        callback_query = update["callback_query"]
+        user_id = callback_query["from"]["id"]
+        return TraceEvent(at, "admin_click", user_id, user_id, data=callback_query.get("data"))
+
+    message = update.get("message") or update.get("edited_message") or {}
+    text = message.get("text", "")
+    command = text.split()[0].split("@")[0] if text.startswith("/") else None
+    kind = {"/gpt": "gpt", "/adminmenu": "admin_menu", None: "text"}.get(command, "command")
+    return TraceEvent(at, kind, message["chat"]["id"], message["from"]["id"], text)
+
+def build_update(event: TraceEvent, update_id: int, message_id: int, marker: str) -> dict:
+    """
+    Returns the Telegram update for an event; /gpt questions get the marker the fake OpenAI server echoes.
+    """
+    user = {"id": event.user_id, "is_bot": False, "first_name": f"User {event.user_id}", "language_code": "en"}
+    if event.kind == "admin_click":
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": marker,
+                "from": user,
+                "chat_instance": "benchmark",
+                "data": event.data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": event.user_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": "Admin menu:",
+                },
+            },
+        }
+
+    text = event.text
+    if event.kind == "gpt":
+        command, _, question = text.partition(" ")
+        text = f"{command} {marker} {question}"
+    chat_type = "group" if event.chat_id < 0 else "private"
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": event.chat_id, "type": chat_type, "title": f"Group {-event.chat_id}" if chat_type == "group" else None},
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
@@ -1,10 +1,17 @@
 import re
 import logging
+import secrets
 from collections import namedtuple
 from telegram.ext import CallbackContext
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from telegram.error import Unauthorized
+from telegram.error import Unauthorized, TelegramError, BadRequest
 from localization import loc
+from ttl_cache import TTLCache
+from storage import Storage, MemoryStorage
+from model_registry import MODEL_PRICES, AUTO_MODEL
+from message_sender import MessageSender, PRIORITY
+from callback_data import CallbackDataCodec
+from tracing import stage
 
 class AdminMenuManager:
     """
@@ -18,13 +25,18 @@ class AdminMenuManager:
         "SHOW_LIMIT",
         "SHOW_REMAINING_MESSAGES",
         "IS_TO_SET_NEW_LIMIT",
+        "SET_NEW_USER_LIMIT",
+        "REMOVE_USER_LIMIT",
+        "IS_TO_SET_NEW_USER_LIMIT",
         "TOGGLE_NOTIFICATIONS",
         "ADD_CHAT_ID",
         "GET_CHAT_ID",
-        "GROUP_CHAT_ID",
         "BOT_DESC",
         "REMOVE_BOT_DESC",
-        "SHOW_BOT_DESC"
+        "SHOW_BOT_DESC",
+        "SELECT_MODEL",
+        "SET_MODEL",
+        "TOGGLE_RESPONSE_CACHE"
         ])
     FinancialConstants = namedtuple('FinancialConstants', [
         'SET_NEW_DOLLAR_LIMIT',
@@ -34,14 +46,29 @@ class AdminMenuManager:
         "IS_TO_SET_NEW_USD_LIMIT"
     ])
 
-    def __init__(self, message_limit_handler, financial_validator):
+    def __init__(self, message_limit_handler, financial_validator, message_sender: MessageSender, storage: Storage = None, callback_secret: bytes = None):
         self.message_limit_handler = message_limit_handler
         self.financial_validator = financial_validator
+        self.message_sender = message_sender
         
-        self.admin_notification_chat_map = {}
-        self.silenced_notifications = {} # To track if admins notifications are active
+        storage = storage or MemoryStorage()
+        self.admin_notification_chat_map = storage.dict("admin_menu.admin_notification_chat_map")
+        self.silenced_notifications = storage.dict("admin_menu.silenced_notifications") # To track if admins notifications are active
         
-        self.bot_descriptions = {}
+        self.bot_descriptions = storage.dict("admin_menu.bot_descriptions")
+        self.chat_models = storage.dict("admin_menu.chat_models")  # chat_id -> model name or AUTO_MODEL
+        self.response_cache_chats = storage.dict("admin_menu.response_cache_chats")  # Chats that opted in to cached answers
+        
+        # (chat_id, user_id) -> whether the user is an admin of the chat; kept fresh by chat_member updates
+        self.admin_statuses = TTLCache(max_size=10000, ttl=10 * 60)
+        self.warm_admin_statuses = True  # Fetch all admins of a group at once on a cache miss
+        
+        # (lang, response cache enabled, notifications enabled) -> rows of (button text, action); only the toggle rows differ
+        self.admin_menu_templates = {}
+        
+        # Buttons name the chat they apply to. Without a secret shared by all workers, e.g. derived from the bot token,
+        # menus stop working when the bot restarts.
+        self.callback_codec = CallbackDataCodec(callback_secret or secrets.token_bytes(32))
         
         # Initialize constants
         self.constants = self.Constants(
@@ -50,13 +77,18 @@ class AdminMenuManager:
             SHOW_LIMIT="show_limit",
             SHOW_REMAINING_MESSAGES="show_remaining_messages",
             IS_TO_SET_NEW_LIMIT="is_to_set_new_limit",
+            SET_NEW_USER_LIMIT="set_new_user_limit",
+            REMOVE_USER_LIMIT="remove_user_limit",
+            IS_TO_SET_NEW_USER_LIMIT="is_to_set_new_user_limit",
             TOGGLE_NOTIFICATIONS="toggle_notifications",
             ADD_CHAT_ID="add_chat_id",
             GET_CHAT_ID="get_chat_id",
-            GROUP_CHAT_ID="chat_id",
             BOT_DESC="bot_description",
             REMOVE_BOT_DESC="remove_bot_description",
-            SHOW_BOT_DESC="show_bot_description"
+            SHOW_BOT_DESC="show_bot_description",
+            SELECT_MODEL="select_model",
+            SET_MODEL="set_model",
+            TOGGLE_RESPONSE_CACHE="toggle_response_cache"
         )
 
         self.fin_constants = self.FinancialConstants(
@@ -67,9 +99,65 @@ class AdminMenuManager:
             IS_TO_SET_NEW_USD_LIMIT="is_to_set_new_usd_limit"
         )
         
+        # Action of a button -> callback_handler(query, context, chat_id, *arguments)
+        self.callback_handlers = {
+            self.constants.SET_NEW_LIMIT: self.set_new_limit_callback,
+            self.constants.REMOVE_LIMIT: self.remove_limit_callback,
+            self.constants.SHOW_LIMIT: self.show_limit_callback,
+            self.constants.SHOW_REMAINING_MESSAGES: self.show_remaining_messages_callback,
+            self.constants.SET_NEW_USER_LIMIT: self.set_new_user_limit_callback,
+            self.constants.REMOVE_USER_LIMIT: self.remove_user_limit_callback,
+            self.fin_constants.SET_NEW_DOLLAR_LIMIT: self.set_new_usd_limit_callback,
+            self.fin_constants.REMOVE_DOLLAR_LIMIT: self.remove_usd_limit_callback,
+            self.fin_constants.SHOW_DOLLAR_LIMIT: self.show_usd_limit_callback,
+            self.fin_constants.SHOW_REMAINING_DOLLARS: self.show_remaining_usd_callback,
+            self.constants.TOGGLE_NOTIFICATIONS: self.toggle_notifications_callback,
+            self.constants.TOGGLE_RESPONSE_CACHE: self.toggle_response_cache_callback,
+            self.constants.ADD_CHAT_ID: self.handle_add_chat_id,
+            self.constants.GET_CHAT_ID: self.get_current_chat_id_callback,
+            self.constants.BOT_DESC: self.set_new_bot_description_callback,
+            self.constants.REMOVE_BOT_DESC: self.remove_bot_description_callback,
+            self.constants.SHOW_BOT_DESC: self.show_bot_description_callback,
+            self.constants.SELECT_MODEL: self.select_model_callback,
+            self.constants.SET_MODEL: self.set_model_callback,
+        }
+        
     def is_user_admin(self, user_id: int, chat_id: int, context: CallbackContext) -> bool:
-        chat_member = context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-        return chat_member.status in ['administrator', 'creator']
+        with stage("admin_check"):
+            is_admin = self.admin_statuses.get((chat_id, user_id))
+            if is_admin is not None:
+                return is_admin
+
+            # Group ids are negative; private chats have no administrators list
+            if self.warm_admin_statuses and chat_id < 0:
+                try:
+                    admin_ids = self.warm_admin_cache(chat_id, context)
+                    is_admin = user_id in admin_ids
+                    self.admin_statuses.set((chat_id, user_id), is_admin)
+                    return is_admin
+                except TelegramError as e:
+                    logging.warning(f"Failed to get administrators of chat {chat_id}: {e}")
+
+            chat_member = context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+            is_admin = self.is_admin_status(chat_member.status)
+            self.admin_statuses.set((chat_id, user_id), is_admin)
+            return is_admin
+
+    def is_admin_status(self, status: str) -> bool:
+        return status in ['administrator', 'creator']
+
+    def warm_admin_cache(self, chat_id: int, context: CallbackContext):
+        admin_ids = [chat_member.user.id for chat_member in context.bot.get_chat_administrators(chat_id=chat_id)]
+        for admin_id in admin_ids:
+            self.admin_statuses.set((chat_id, admin_id), True)
+        return admin_ids
+
+    def handle_chat_member_update(self, update: Update, context: CallbackContext):
+        chat_member_update = update.chat_member or update.my_chat_member
+        if chat_member_update is None:
+            return
+        new_chat_member = chat_member_update.new_chat_member
+        self.admin_statuses.set((chat_member_update.chat.id, new_chat_member.user.id), self.is_admin_status(new_chat_member.status))
         
     def show_admin_menu(self, update: Update, context: CallbackContext):
         user_id = update.effective_user.id
@@ -88,90 +176,129 @@ class AdminMenuManager:
         
         if isinstance(update, CallbackQuery):
             query = update
-        
-        context.user_data[user_id] = {self.constants.GROUP_CHAT_ID: chat_id}  # Store chat_id in context.user_data
+        lang = query.from_user.language_code if query else update.effective_user.language_code
 
         if self.is_user_admin(user_id, chat_id, context):
-            keyboard = [
-                [InlineKeyboardButton(loc('set_messages_limit'), callback_data=self.constants.SET_NEW_LIMIT),
-                InlineKeyboardButton(loc('set_dollar_limit'), callback_data=self.fin_constants.SET_NEW_DOLLAR_LIMIT)],
-                [InlineKeyboardButton(loc('show_messages_limit'), callback_data=self.constants.SHOW_LIMIT),
-                InlineKeyboardButton(loc('show_dollar_limit'), callback_data=self.fin_constants.SHOW_DOLLAR_LIMIT)],
-                [InlineKeyboardButton(loc('remove_messages_limit'), callback_data=self.constants.REMOVE_LIMIT),
-                InlineKeyboardButton(loc('remove_dollar_limit'), callback_data=self.fin_constants.REMOVE_DOLLAR_LIMIT)],
-                [InlineKeyboardButton(loc('messages_left'), callback_data=self.constants.SHOW_REMAINING_MESSAGES),
-                InlineKeyboardButton(loc('dollars_left'), callback_data=self.fin_constants.SHOW_REMAINING_DOLLARS)],
-                [InlineKeyboardButton(loc('set_bot_description'), callback_data=self.constants.BOT_DESC),
-                 InlineKeyboardButton(loc('remove_bot_description'), callback_data=self.constants.REMOVE_BOT_DESC)],
-                [InlineKeyboardButton(loc('show_bot_description'), callback_data=self.constants.SHOW_BOT_DESC)],
-                [InlineKeyboardButton(loc('add_chat_id'), callback_data=self.constants.ADD_CHAT_ID)],
-                [InlineKeyboardButton(loc('get_current_chat_id'), callback_data=self.constants.GET_CHAT_ID)]
-            ]
-
-            silence_button_text = loc('mute_notifications') if self.admin_notifications_enabled(chat_id) else loc('unmute_notifications')
-            keyboard.append([InlineKeyboardButton(silence_button_text, callback_data=self.constants.TOGGLE_NOTIFICATIONS)])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            try:
-                context.bot.send_message(chat_id=user_id, text=f"{loc('admin_menu')}:", reply_markup=reply_markup)
-            except Unauthorized:
-                error_message = loc('start_conversation')
-                # Send an inline query answer if the bot can't initiate a conversation
-                if query:
-                    query.answer(error_message)
-                else:
-                    update.message.reply_text(error_message)
+            reply_markup = self.get_admin_menu_markup(chat_id, lang)
+            sent = self.message_sender.send_message(user_id, f"{loc('admin_menu', lang)}:", reply_markup=reply_markup)
+            sent.add_done_callback(lambda sent: self.handle_admin_menu_sent(update, query, lang, sent))
         else:
-            error_message = loc('admin_only')
+            error_message = loc('admin_only', lang)
             if query:
                 query.answer(error_message)
             else:
-                update.message.reply_text(error_message)
+                self.message_sender.reply_to(update.message, error_message)
+
+    def get_admin_menu_markup(self, chat_id: int, lang) -> InlineKeyboardMarkup:
+        menu_key = (lang, self.response_cache_enabled(chat_id), self.admin_notifications_enabled(chat_id))
+        template = self.admin_menu_templates.get(menu_key)
+        if template is None:
+            template = self.admin_menu_templates[menu_key] = self.build_admin_menu_template(*menu_key)
+        # Only the signed callback data is made per chat
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(text, callback_data=self.callback_codec.encode(action, chat_id)) for text, action in row]
+            for row in template])
+
+    def build_admin_menu_template(self, lang, response_cache_enabled: bool, notifications_enabled: bool):
+        keyboard = [
+            [(loc('set_messages_limit', lang), self.constants.SET_NEW_LIMIT),
+            (loc('set_dollar_limit', lang), self.fin_constants.SET_NEW_DOLLAR_LIMIT)],
+            [(loc('show_messages_limit', lang), self.constants.SHOW_LIMIT),
+            (loc('show_dollar_limit', lang), self.fin_constants.SHOW_DOLLAR_LIMIT)],
+            [(loc('remove_messages_limit', lang), self.constants.REMOVE_LIMIT),
+            (loc('remove_dollar_limit', lang), self.fin_constants.REMOVE_DOLLAR_LIMIT)],
+            [(loc('messages_left', lang), self.constants.SHOW_REMAINING_MESSAGES),
+            (loc('dollars_left', lang), self.fin_constants.SHOW_REMAINING_DOLLARS)],
+            [(loc('set_user_messages_limit', lang), self.constants.SET_NEW_USER_LIMIT),
+            (loc('remove_user_messages_limit', lang), self.constants.REMOVE_USER_LIMIT)],
+            [(loc('set_bot_description', lang), self.constants.BOT_DESC),
+             (loc('remove_bot_description', lang), self.constants.REMOVE_BOT_DESC)],
+            [(loc('show_bot_description', lang), self.constants.SHOW_BOT_DESC)],
+            [(loc('select_model', lang), self.constants.SELECT_MODEL)],
+            [(loc('add_chat_id', lang), self.constants.ADD_CHAT_ID)],
+            [(loc('get_current_chat_id', lang), self.constants.GET_CHAT_ID)]
+        ]
+
+        response_cache_button_text = loc('disable_response_cache', lang) if response_cache_enabled else loc('enable_response_cache', lang)
+        keyboard.append([(response_cache_button_text, self.constants.TOGGLE_RESPONSE_CACHE)])
+
+        silence_button_text = loc('mute_notifications', lang) if notifications_enabled else loc('unmute_notifications', lang)
+        keyboard.append([(silence_button_text, self.constants.TOGGLE_NOTIFICATIONS)])
+
+        return keyboard
+
+    def toggle_notifications_callback(self, query, context: CallbackContext, chat_id: int):
+        self.toggle_admin_notifications(chat_id)
+        self.update_admin_menu(query, context, chat_id)
+
+    def toggle_response_cache_callback(self, query, context: CallbackContext, chat_id: int):
+        self.toggle_response_cache(chat_id)
+        self.update_admin_menu(query, context, chat_id)
+
+    def update_admin_menu(self, query: CallbackQuery, context: CallbackContext, chat_id: int):
+        """
+        Shows a changed setting by editing the buttons of the menu that was clicked, instead of sending a new menu.
+        """
+        query.answer()
+        reply_markup = self.get_admin_menu_markup(chat_id, query.from_user.language_code)
+        edited = self.message_sender.submit(
+            context.bot.edit_message_reply_markup, PRIORITY.NORMAL,
+            chat_id=query.message.chat_id, message_id=query.message.message_id, reply_markup=reply_markup)
+        edited.add_done_callback(lambda edited: self.handle_admin_menu_edited(query, context, chat_id, edited))
+
+    def handle_admin_menu_edited(self, query: CallbackQuery, context: CallbackContext, chat_id: int, edited):
+        error = edited.exception()
+        # A double click leaves nothing to change; any other failure, e.g. a deleted menu or a network error, gets a new menu
+        if error is not None and not (isinstance(error, BadRequest) and "not modified" in error.message.lower()):
+            self.show_admin_menu_callback(query, context, original_chat_id=chat_id)
+
+    def handle_admin_menu_sent(self, update: Update, query: CallbackQuery, lang, sent):
+        if not isinstance(sent.exception(), Unauthorized):
+            return
+        error_message = loc('start_conversation', lang)
+        # Send an inline query answer if the bot can't initiate a conversation
+        if query:
+            query.answer(error_message)
+        else:
+            self.message_sender.reply_to(update.message, error_message)
         
     def handle_admin_callback(self, update: Update, context: CallbackContext):
         query = update.callback_query
         user = query.from_user
-        data = query.data
-        
-        if user.id in context.user_data and self.constants.GROUP_CHAT_ID in context.user_data[user.id]:
-            chat_id = context.user_data[user.id][self.constants.GROUP_CHAT_ID]  # Retrieve chat_id from context.user_data
-        else:
-            query.answer(loc('error_chat_id_not_found'))
+
+        callback_data = self.callback_codec.decode(query.data)
+        callback_handler = self.callback_handlers.get(callback_data.action) if callback_data else None
+        if callback_handler is None:
+            # E.g. a menu sent before callback data was signed, or signed with another secret
+            query.answer(loc('admin_menu_expired', user.language_code))
             return
 
-        if self.is_user_admin(user.id, chat_id, context):
-            if data == self.constants.SET_NEW_LIMIT:
-                self.set_new_limit_callback(query, context, chat_id)
-            elif data == self.constants.REMOVE_LIMIT:
-                self.remove_limit_callback(query, context, chat_id)
-            elif data == self.constants.SHOW_LIMIT:
-                self.show_limit_callback(query, context, chat_id)
-            elif data == self.constants.SHOW_REMAINING_MESSAGES:
-                self.show_remaining_messages_callback(query, context, chat_id)
-            elif data == self.fin_constants.SET_NEW_DOLLAR_LIMIT:
-                self.set_new_usd_limit_callback(query, context, chat_id)
-            elif data == self.fin_constants.REMOVE_DOLLAR_LIMIT:
-                self.remove_usd_limit_callback(query, context, chat_id)
-            elif data == self.fin_constants.SHOW_DOLLAR_LIMIT:
-                self.show_usd_limit_callback(query, context, chat_id)
-            elif data == self.fin_constants.SHOW_REMAINING_DOLLARS:
-                self.show_remaining_usd_callback(query, context, chat_id)
-            elif data == self.constants.TOGGLE_NOTIFICATIONS:
-                self.toggle_admin_notifications(chat_id)
-                self.show_admin_menu_callback(query, context, original_chat_id=chat_id)
-            elif data == self.constants.ADD_CHAT_ID:
-                self.handle_add_chat_id(query, context, chat_id)
-            elif data == self.constants.GET_CHAT_ID:
-                self.get_current_chat_id_callback(query, context, chat_id)
-            elif data == self.constants.BOT_DESC:
-                self.set_new_bot_description_callback(query, context, chat_id)
-            elif data == self.constants.REMOVE_BOT_DESC:
-                self.remove_bot_description_callback(query, context, chat_id)
-            elif data == self.constants.SHOW_BOT_DESC:
-                self.show_bot_description_callback(query, context, chat_id)
+        if self.is_user_admin(user.id, callback_data.chat_id, context):
+            arguments = [callback_data.argument] if callback_data.argument else []
+            callback_handler(query, context, callback_data.chat_id, *arguments)
         else:
-            query.answer(loc('admin_required'))
+            query.answer(loc('admin_required', user.language_code))
+
+    def select_model_callback(self, query, context: CallbackContext, chat_id: int):
+        lang = query.from_user.language_code
+        current_model = self.get_chat_model(chat_id)
+        keyboard = []
+        for model in [AUTO_MODEL] + list(MODEL_PRICES):
+            model_title = loc('model_auto', lang) if model == AUTO_MODEL else model
+            if model == current_model:
+                model_title = f"✓ {model_title}"
+            callback_data = self.callback_codec.encode(self.constants.SET_MODEL, chat_id, model)
+            keyboard.append([InlineKeyboardButton(model_title, callback_data=callback_data)])
+        self.message_sender.send_message(query.from_user.id, loc('choose_model', lang), reply_markup=InlineKeyboardMarkup(keyboard))
+
+    def set_model_callback(self, query, context: CallbackContext, chat_id: int, model: str):
+        lang = query.from_user.language_code
+        if model != AUTO_MODEL and model not in MODEL_PRICES:
+            query.answer(loc('unknown_model', lang))
+            return
+        self.chat_models[chat_id] = model
+        model_title = loc('model_auto', lang) if model == AUTO_MODEL else model
+        self.message_sender.send_message(query.from_user.id, loc('model_set', lang, model=model_title))
 
     def get_current_chat_id_callback(self, query, context: CallbackContext, chat_id: int):
         message = f"Current chat ID: {chat_id}"
@@ -182,84 +309,100 @@ class AdminMenuManager:
         user_id = query.from_user.id
 
         context.user_data[self.constants.ADD_CHAT_ID] = chat_id
-        context.bot.send_message(
-            chat_id=query.from_user.id,
-            text=loc('enter_dest_chat_id')
+        self.message_sender.send_message(
+            query.from_user.id,
+            loc('enter_dest_chat_id', query.from_user.language_code)
             )
 
     def set_new_limit_callback(self, query, context: CallbackContext, chat_id: int):
         context.user_data[self.constants.IS_TO_SET_NEW_LIMIT] = chat_id
-        context.bot.send_message(chat_id=query.from_user.id, text=loc('enter_new_message_limit'))
+        self.message_sender.send_message(query.from_user.id, loc('enter_new_message_limit', query.from_user.language_code))
 
     def remove_limit_callback(self, query, context: CallbackContext, chat_id: int):
         if self.message_limit_handler.has_limit(chat_id):
             self.message_limit_handler.remove_limit(chat_id)
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('message_limit_removed'))
+            self.message_sender.send_message(query.from_user.id, loc('message_limit_removed', query.from_user.language_code))
         else:
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('no_message_limit_set'))
+            self.message_sender.send_message(query.from_user.id, loc('no_message_limit_set', query.from_user.language_code))
 
     def show_limit_callback(self, query, context: CallbackContext, chat_id: int):
         if self.message_limit_handler.has_limit(chat_id):
             limit = self.message_limit_handler.get_limit(chat_id)
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('daily_message_limit', limit=limit))
+            message = loc('daily_message_limit', query.from_user.language_code, limit=limit)
         else:
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('no_message_limit_set'))
+            message = loc('no_message_limit_set', query.from_user.language_code)
+        user_limit = self.message_limit_handler.get_user_limit(chat_id)
+        if user_limit is not None:
+            message += "\n" + loc('user_message_limit', query.from_user.language_code, limit=user_limit)
+        self.message_sender.send_message(query.from_user.id, message)
+
+    def set_new_user_limit_callback(self, query, context: CallbackContext, chat_id: int):
+        context.user_data[self.constants.IS_TO_SET_NEW_USER_LIMIT] = chat_id
+        self.message_sender.send_message(query.from_user.id, loc('enter_new_user_message_limit', query.from_user.language_code))
+
+    def remove_user_limit_callback(self, query, context: CallbackContext, chat_id: int):
+        if self.message_limit_handler.get_user_limit(chat_id) is not None:
+            self.message_limit_handler.remove_user_limit(chat_id)
+            self.message_sender.send_message(query.from_user.id, loc('user_message_limit_removed', query.from_user.language_code))
+        else:
+            self.message_sender.send_message(query.from_user.id, loc('no_user_message_limit_set', query.from_user.language_code))
 
     def show_remaining_messages_callback(self, query, context: CallbackContext, chat_id: int):
         if not self.message_limit_handler.has_limit(chat_id):
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('no_remaining_message_limit'))
+            self.message_sender.send_message(query.from_user.id, loc('no_remaining_message_limit', query.from_user.language_code))
         else:
             remaining_messages = self.message_limit_handler.get_remaining_messages(chat_id)
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('remaining_messages', remaining_messages=remaining_messages))
+            self.message_sender.send_message(query.from_user.id, loc('remaining_messages', query.from_user.language_code, remaining_messages=remaining_messages))
 
     def set_new_usd_limit_callback(self, query, context: CallbackContext, chat_id: int):
         context.user_data[self.fin_constants.IS_TO_SET_NEW_USD_LIMIT] = chat_id
-        context.bot.send_message(chat_id=query.from_user.id, text=loc('enter_new_usd_limit'))
+        self.message_sender.send_message(query.from_user.id, loc('enter_new_usd_limit', query.from_user.language_code))
 
     def remove_usd_limit_callback(self, query, context: CallbackContext, chat_id: int):
         self.financial_validator.remove_limit(chat_id)
-        context.bot.send_message(chat_id=query.from_user.id, text=loc('daily_usd_limit_removed'))
+        self.message_sender.send_message(query.from_user.id, loc('daily_usd_limit_removed', query.from_user.language_code))
 
     def show_usd_limit_callback(self, query, context: CallbackContext, chat_id: int):
         limit = self.financial_validator.get_limit(chat_id)
         if limit is not None:
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('daily_usd_limit', limit=limit))
+            self.message_sender.send_message(query.from_user.id, loc('daily_usd_limit', query.from_user.language_code, limit=limit))
         else:
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('no_daily_usd_limit_set'))
+            self.message_sender.send_message(query.from_user.id, loc('no_daily_usd_limit_set', query.from_user.language_code))
 
     def show_remaining_usd_callback(self, query, context: CallbackContext, chat_id: int):
         if not self.financial_validator.has_limit(chat_id):
-            message = loc('no_usd_limit')
+            message = loc('no_usd_limit', query.from_user.language_code)
         else:
             remaining_dollars = self.financial_validator.left_dollar_usage(chat_id)
-            message = loc('remaining_usd_limit', remaining_dollars=int(remaining_dollars))
+            message = loc('remaining_usd_limit', query.from_user.language_code, remaining_dollars=int(remaining_dollars))
 
-        context.bot.send_message(chat_id=query.from_user.id, text=message)
+        self.message_sender.send_message(query.from_user.id, message)
         
     def set_new_bot_description_callback(self, query, context: CallbackContext, chat_id: int):
         context.user_data[self.constants.BOT_DESC] = chat_id
-        context.bot.send_message(chat_id=query.from_user.id, text=loc('enter_bot_description'))
+        self.message_sender.send_message(query.from_user.id, loc('enter_bot_description', query.from_user.language_code))
         
     def remove_bot_description_callback(self, query, context: CallbackContext, chat_id: int):
         if self.bot_descriptions.get(chat_id):
             self.bot_descriptions.pop(chat_id, None)
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('bot_description_removed'))
+            self.message_sender.send_message(query.from_user.id, loc('bot_description_removed', query.from_user.language_code))
         else:
-            context.bot.send_message(chat_id=query.from_user.id, text=loc('no_custom_bot_description_set'))
+            self.message_sender.send_message(query.from_user.id, loc('no_custom_bot_description_set', query.from_user.language_code))
             
     def show_bot_description_callback(self, query, context: CallbackContext, chat_id: int):
-        bot_description = self.get_bot_description(chat_id)
-        context.bot.send_message(chat_id=query.from_user.id, text=loc('bot_description', bot_description=bot_description))
+        bot_description = self.get_bot_description(chat_id, query.from_user.language_code)
+        self.message_sender.send_message(query.from_user.id, loc('bot_description', query.from_user.language_code, bot_description=bot_description))
         
     def handle_text(self, update: Update, context: CallbackContext):
         user_data = context.user_data
 
         is_to_set_new_limit = user_data.get(self.constants.IS_TO_SET_NEW_LIMIT)
         is_to_set_new_usd_limit = user_data.get(self.fin_constants.IS_TO_SET_NEW_USD_LIMIT)
+        is_to_set_new_user_limit = user_data.get(self.constants.IS_TO_SET_NEW_USER_LIMIT)
         is_add_chat_id = user_data.get(self.constants.ADD_CHAT_ID)
         is_set_bot_desc = user_data.get(self.constants.BOT_DESC)
 
-        if is_to_set_new_limit or is_to_set_new_usd_limit:
+        if is_to_set_new_limit or is_to_set_new_usd_limit or is_to_set_new_user_limit:
             new_limit_str = update.message.text
             if new_limit_str.isdigit():
                 new_limit = int(new_limit_str)
@@ -267,10 +410,13 @@ class AdminMenuManager:
                     self.set_new_limit(update, context, user_data, new_limit, is_usd=False)
                 elif is_to_set_new_usd_limit:
                     self.set_new_limit(update, context, user_data, new_limit, is_usd=True)
+                elif is_to_set_new_user_limit:
+                    self.set_new_user_limit(update, context, user_data, new_limit)
             else:
-                context.bot.send_message(chat_id=update.message.from_user.id, text=loc('provide_valid_integer'))
+                self.message_sender.send_message(update.message.from_user.id, loc('provide_valid_integer', update.effective_user.language_code))
             user_data.pop(self.constants.IS_TO_SET_NEW_LIMIT, None)
             user_data.pop(self.fin_constants.IS_TO_SET_NEW_USD_LIMIT, None)
+            user_data.pop(self.constants.IS_TO_SET_NEW_USER_LIMIT, None)
 
         elif is_add_chat_id:
             self.set_add_chat_id(update, context, user_data)
@@ -286,22 +432,28 @@ class AdminMenuManager:
     def set_new_usd_limit(self, update: Update, context: CallbackContext, user_data, new_limit):
         chat_id = user_data[self.fin_constants.IS_TO_SET_NEW_USD_LIMIT]
         self.financial_validator.set_limit(chat_id, new_limit)
-        limit_msg = loc('daily_limit_set', new_limit=new_limit)
-        context.bot.send_message(chat_id=update.message.from_user.id, text=limit_msg)
+        limit_msg = loc('daily_limit_set', update.effective_user.language_code, new_limit=new_limit)
+        self.message_sender.send_message(update.message.from_user.id, limit_msg)
             
     def set_new_message_limit(self, update: Update, context: CallbackContext, user_data, new_limit):
         chat_id = user_data[self.constants.IS_TO_SET_NEW_LIMIT]
         self.message_limit_handler.set_limit(chat_id, new_limit)
-        limit_msg = loc('daily_message_limit_set', new_limit=new_limit)
-        context.bot.send_message(chat_id=update.message.from_user.id, text=limit_msg)
+        limit_msg = loc('daily_message_limit_set', update.effective_user.language_code, new_limit=new_limit)
+        self.message_sender.send_message(update.message.from_user.id, limit_msg)
+        
+    def set_new_user_limit(self, update: Update, context: CallbackContext, user_data, new_limit):
+        chat_id = user_data[self.constants.IS_TO_SET_NEW_USER_LIMIT]
+        self.message_limit_handler.set_user_limit(chat_id, new_limit)
+        limit_msg = loc('user_message_limit_set', update.effective_user.language_code, new_limit=new_limit)
+        self.message_sender.send_message(update.message.from_user.id, limit_msg)
         
     def save_bot_description(self, update: Update, context: CallbackContext, user_data):
         bot_desc = update.message.text
         chat_id = user_data[self.constants.BOT_DESC]
         self.bot_descriptions[chat_id] = bot_desc
         user_data.pop(self.constants.BOT_DESC, None)
-        message = loc('bot_description_set', bot_desc=bot_desc)
-        context.bot.send_message(chat_id=update.message.from_user.id, text=message)
+        message = loc('bot_description_set', update.effective_user.language_code, bot_desc=bot_desc)
+        self.message_sender.send_message(update.message.from_user.id, message)
         
     def set_add_chat_id(self, update: Update, context: CallbackContext, user_data):
         chat_id_str = update.message.text
@@ -316,13 +468,13 @@ class AdminMenuManager:
 
             # Compare the chat IDs
             if chat_id == dest_group_chat_id:
-                context.bot.send_message(chat_id=update.message.from_user.id, text=loc('same_chat_id_error'))
+                self.message_sender.send_message(update.message.from_user.id, loc('same_chat_id_error', update.effective_user.language_code))
             else:
                 self.admin_notification_chat_map[chat_id] = dest_group_chat_id
-                reply = loc('receive_notifications', dest_group_chat_id=dest_group_chat_id, chat_id=chat_id)
-                context.bot.send_message(chat_id=update.message.from_user.id, text=reply)
+                reply = loc('receive_notifications', update.effective_user.language_code, dest_group_chat_id=dest_group_chat_id, chat_id=chat_id)
+                self.message_sender.send_message(update.message.from_user.id, reply)
         else:
-            context.bot.send_message(chat_id=update.message.from_user.id, text=loc('provide_valid_chat_id'))
+            self.message_sender.send_message(update.message.from_user.id, loc('provide_valid_chat_id', update.effective_user.language_code))
         user_data[self.constants.ADD_CHAT_ID] = None
         
     def get_admin_notification_chat_id(self, chat_id: int):
@@ -337,5 +489,17 @@ class AdminMenuManager:
     def admin_notifications_enabled(self, chat_id: int) -> bool:
         return chat_id not in self.silenced_notifications
 
-    def get_bot_description(self, chat_id: int) -> str:
-        return self.bot_descriptions.get(chat_id) or loc('assistant_desc')
\ No newline at end of file
+    def toggle_response_cache(self, chat_id: int):
+        if chat_id in self.response_cache_chats:
+            self.response_cache_chats.pop(chat_id, None)
+        else:
+            self.response_cache_chats[chat_id] = True
+
+    def response_cache_enabled(self, chat_id: int) -> bool:
+        return chat_id in self.response_cache_chats
+
+    def get_chat_model(self, chat_id: int):
+        return self.chat_models.get(chat_id)
+
+    def get_bot_description(self, chat_id: int, lang=None) -> str:
+        return self.bot_descriptions.get(chat_id) or loc('assistant_desc', lang)
\ No newline at end of file
@@ -1,10 +1,16 @@
 import openai
+import glob
+import hashlib
 import logging
+import os
+import threading
 import time
+from signal import signal, SIGINT, SIGTERM, SIGABRT, SIGUSR1
 from telegram import Update, ReplyKeyboardRemove, BotCommandScopeDefault, BotCommandScopeAllChatAdministrators, Bot, BotCommand, error
 from telegram.ext import (
     Updater,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
     Filters,
     CallbackContext,
@@ -12,62 +18,109 @@ from telegram.ext import (
 
 from financial_validator import FinancialValidator
 from message_limit_handler import MessageLimitHandler
+from rate_limiters import create_rate_limiter
+from token_counter import load_encodings
+from model_registry import MODEL_PRICES
 from input_handler import InputHandler
+from gpt_request_engine import GPTRequestEngine
+from message_sender import MessageSender, PRIORITY
+from storage import SQLiteStorage
+from shared_state import LocalSharedState, RedisSharedState
+from webhook_server import WebhookServer, WebhookConfig
+from metrics import MetricsServer, MetricsConfig, registry, RETRY_AFTER, GPT_REQUESTS_IN_FLIGHT, TYPING_CHATS
+from tracing import Tracer, TraceLogFilter, SamplingProfiler
 from localization import loc, translator
+from translator import default_lang
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(trace_id)s%(message)s')
+# Prefixes log lines with the correlation id of the update they belong to
+for log_handler in logging.getLogger().handlers:
+    log_handler.addFilter(TraceLogFilter())
 
 class GPTBot:
-    def __init__(self, telegram_api_key, gpt_api_key):
+    def __init__(self, telegram_api_key, gpt_api_key, storage_path, shared_state_url=None, telegram_base_url=None, message_limit_algorithm="token_bucket",
+                 message_limit_timezone="UTC", message_limit_reset_hour=0):
         self.TELEGRAM_API_KEY = telegram_api_key
         self.GPT_API_KEY = gpt_api_key
 
-        self.bot = Bot(token=telegram_api_key)
-        self.updater = Updater(self.TELEGRAM_API_KEY)
-        self.input_handler = InputHandler(MessageLimitHandler(), FinancialValidator(), self.updater)
+        # telegram_base_url points the bot at another Bot API server, e.g. a local one in benchmarks
+        self.bot = Bot(token=telegram_api_key, base_url=telegram_base_url)
+        self.updater = Updater(self.TELEGRAM_API_KEY, base_url=telegram_base_url)
+        self.gpt_request_engine = GPTRequestEngine()
+        # Every outgoing message is queued here to stay within Telegram's flood limits
+        self.message_sender = MessageSender(self.updater.bot)
+        # Limits, counters and chat settings survive restarts
+        self.storage = SQLiteStorage(storage_path)
+        # Limits and counters live in Redis when several workers serve the bot, in the local storage otherwise
+        self.shared_state = RedisSharedState(shared_state_url) if shared_state_url else LocalSharedState(self.storage)
+        self.input_handler = InputHandler(
+            # Reservations of requests that never complete are dropped a minute after the request timeout
+            MessageLimitHandler(self.storage, create_rate_limiter(
+                message_limit_algorithm, timezone=message_limit_timezone, reset_hour=message_limit_reset_hour), self.shared_state,
+                                reservation_ttl=self.gpt_request_engine.request_timeout + 60),
+            FinancialValidator(self.storage, self.shared_state, reservation_ttl=self.gpt_request_engine.request_timeout + 60),
+            self.updater,
+            self.gpt_request_engine,
+            self.storage,
+            message_sender=self.message_sender,
+            # Every worker of the bot derives the same key for signing admin menu buttons
+            callback_secret=hashlib.sha256(f"callback_data:{telegram_api_key}".encode("utf-8")).digest())
         
         # Initialize OpenAI API
         openai.api_key = self.GPT_API_KEY
+        # Token counting must not download encodings while handling requests
+        load_encodings(MODEL_PRICES)
+        # Report loc() calls whose arguments do not match the translations before any handler runs into them
+        translator.check_call_sites(sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))))
         
         self.non_admin_commands = ["start", "gpt", "help"]
         self.admin_commands = self.non_admin_commands + ["adminmenu"]
         
+        self.registered_commands = {}  # (scope type, language code) -> commands already pushed to Telegram
+        
+        # Read when metrics are scraped, so they cost nothing per update
+        GPT_REQUESTS_IN_FLIGHT.set_function(lambda: self.gpt_request_engine.in_flight)
+        TYPING_CHATS.set_function(self.input_handler.typing_indicator.active_count)
+        self.metrics_server: MetricsServer = None
+        
+        # Updates taking longer than this are logged with a breakdown by stage
+        self.tracer = Tracer(slow_request_seconds=10)
+        # Samples the dispatcher threads for this many seconds on SIGUSR1, e.g. `kill -USR1 <pid>`
+        self.profile_seconds = 30
+        self.profiler = SamplingProfiler(thread_filter=lambda thread: thread.name.startswith("Bot:") or thread.name == "dispatcher")
+        
         self.setup_commands_methods()
         
     def handle_retry_after(self, update: Update, context: CallbackContext):
+        # Runs after the update's handler has returned; same correlation id as its trace
+        with self.tracer.trace_update(update, "error"):
+            self.handle_error(update, context)
+
+    def handle_error(self, update: Update, context: CallbackContext):
         try:
             raise context.error
         except error.RetryAfter as e:
             logging.warning(f"Caught RetryAfter error: {e}, waiting for {e.retry_after} seconds before retrying.")
-            # Optional: Send a warning message to the user
-            reply = loc('flood_control', seconds=e.retry_after)
-            context.bot.send_message(chat_id=update.effective_chat.id, text=reply)
+            RETRY_AFTER.inc("dispatcher")
+            if update is None or update.effective_chat is None:
+                return
+            # Hold back everything else for the chat, so the warning is the first message once the wait is over
+            chat_id = update.effective_chat.id
+            self.message_sender.defer_chat(chat_id, e.retry_after)
+            reply = loc('flood_control', self.get_user_language(update), seconds=e.retry_after)
+            self.message_sender.send_message(chat_id, reply, PRIORITY.NOTIFICATION)
         except Exception as e:
             logging.error(f"Unexpected error: {e}")
         
     def handle_command(self, update: Update, context: CallbackContext):
         if update.message is None or update.message.text is None:
             # Send a message to the user that the bot only processes text messages
-            context.bot.send_message(chat_id=update.effective_chat.id, text=loc('only_text_messages'))
+            self.message_sender.send_message(update.effective_chat.id, loc('only_text_messages', self.get_user_language(update)))
             return
         command_with_args = update.message.text.split()
         full_command = command_with_args[0][1:]  # Extract the command without the leading '/'
         command = full_command.split('@')[0]  # Remove the bot's username if it's present
         if command in self.commands_methods:
-            language_code = self.get_user_language(update)
-            
-            new_language = not translator.is_current_lang(language_code)
-            if new_language:
-                chat_id = update.effective_chat.id
-                self.input_handler.start_typing(context, chat_id)
-                
-            translator.change_language(language_code)
-            
-            if new_language:
-                self.update_commands()
-            
-            self.input_handler.stop_typing()
-            
             if command == 'gpt':
                 # Extract the arguments
                 args = command_with_args[1:]
@@ -78,7 +131,7 @@ class GPTBot:
             self.unknown_command(update)
 
     def start(self, update: Update, context: CallbackContext):
-        update.message.reply_text(loc('greeting'), reply_markup=ReplyKeyboardRemove())
+        self.message_sender.reply_to(update.message, loc('greeting', self.get_user_language(update)), reply_markup=ReplyKeyboardRemove())
 
     def help_command(self, update: Update, context: CallbackContext):
         # Check if the user is an admin
@@ -86,18 +139,23 @@ class GPTBot:
 
         commands = self.admin_commands if is_admin else self.non_admin_commands
 
-        help_text = '\n'.join([f'/{cmd} - {loc(cmd)}' for cmd in commands])
+        lang = self.get_user_language(update)
+        help_text = '\n'.join([f'/{cmd} - {loc(cmd, lang)}' for cmd in commands])
 
-        help_text = f"{loc('available_commands')}:\n{help_text}"
-        update.message.reply_text(help_text)
+        help_text = f"{loc('available_commands', lang)}:\n{help_text}"
+        self.message_sender.reply_to(update.message, help_text)
 
     def unknown_command(self, update: Update):
-        update.message.reply_text(loc('unknown_command'))
+        self.message_sender.reply_to(update.message, loc('unknown_command', self.get_user_language(update)))
         
-    def set_bot_commands_with_retry(self, commands, scope, retries=3, delay=5):
+    def set_bot_commands_with_retry(self, commands, scope, language_code=None, retries=3, delay=5):
+        memo_key = (scope.type, language_code)
+        if self.registered_commands.get(memo_key) == commands:
+            return
         for attempt in range(retries):
             try:
-                self.set_bot_commands(commands, scope)
+                self.set_bot_commands(commands, scope, language_code)
+                self.registered_commands[memo_key] = commands
                 return
             except Exception:
                 if attempt < retries - 1:  # No need to sleep for the last attempt
@@ -106,8 +164,8 @@ class GPTBot:
                     logging.error(f"Failed to set bot commands after {retries} attempts due to timeout.")
                     return
         
-    def set_bot_commands(self, commands, scope):
-        self.bot.set_my_commands(commands=commands, scope=scope)
+    def set_bot_commands(self, commands, scope, language_code=None):
+        self.bot.set_my_commands(commands=commands, scope=scope, language_code=language_code)
         
     def setup_commands_methods(self):
         self.commands_methods = {
@@ -117,41 +175,114 @@ class GPTBot:
             'adminmenu': self.input_handler.show_admin_menu,
         }
         
-    def update_commands(self):
+    def register_commands(self):
+        # Users whose language has no translation see the commands in the default language
+        self.update_commands(default_lang, language_code=None)
+        for lang in translator.languages():
+            self.update_commands(lang, language_code=lang)
+
+    def update_commands(self, lang, language_code=None):
         
          # Convert commands dictionaries to lists of BotCommand objects
-        non_admin_bot_commands = [BotCommand(cmd, loc(cmd)) for cmd in self.non_admin_commands]
-        admin_bot_commands = [BotCommand(cmd, loc(cmd)) for cmd in self.admin_commands]
+        non_admin_bot_commands = tuple(BotCommand(cmd, loc(cmd, lang)) for cmd in self.non_admin_commands)
+        admin_bot_commands = tuple(BotCommand(cmd, loc(cmd, lang)) for cmd in self.admin_commands)
 
         # Set commands for non-admin users
         default_scope = BotCommandScopeDefault(type='default')
-        self.set_bot_commands_with_retry(non_admin_bot_commands, default_scope)
+        self.set_bot_commands_with_retry(non_admin_bot_commands, default_scope, language_code)
 
         # Set commands for admin users
         admin_scope = BotCommandScopeAllChatAdministrators(type='all_chat_administrators')
-        self.set_bot_commands_with_retry(admin_bot_commands, admin_scope)
+        self.set_bot_commands_with_retry(admin_bot_commands, admin_scope, language_code)
         
     def get_user_language(self, update: Update):
+        if update is None or update.effective_user is None:
+            return None
         lang_code = update.effective_user.language_code
         return lang_code
 
-    def run(self):
+    def add_handlers(self):
         dp = self.updater.dispatcher
 
+        traced = self.tracer.traced
         # Register the common command handler
-        dp.add_handler(MessageHandler(Filters.command, self.handle_command))
-        dp.add_handler(CallbackQueryHandler(self.input_handler.handle_admin_callback))
-        dp.add_handler(MessageHandler(Filters.text & (~Filters.command), self.input_handler.handle_text))
+        dp.add_handler(MessageHandler(Filters.command, traced(self.handle_command)))
+        dp.add_handler(CallbackQueryHandler(traced(self.input_handler.handle_admin_callback)))
+        dp.add_handler(ChatMemberHandler(traced(self.input_handler.handle_chat_member_update), ChatMemberHandler.ANY_CHAT_MEMBER))
+        dp.add_handler(MessageHandler(Filters.text & (~Filters.command), traced(self.input_handler.handle_text)))
         dp.add_error_handler(self.handle_retry_after)
 
-        self.updater.start_polling()
-        self.updater.idle()
+    def run(self, webhook_config: WebhookConfig = None, metrics_config: MetricsConfig = None):
+        self.add_handlers()
+        self.register_commands()
+        if metrics_config:
+            self.metrics_server = MetricsServer(registry, metrics_config)
+            self.metrics_server.start()
+        signal(SIGUSR1, lambda signum, frame: self.profile())
+        if webhook_config:
+            self.run_webhook(webhook_config)
+        else:
+            # chat_member updates are not delivered unless requested explicitly
+            self.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            self.updater.idle()
+        self.shutdown()
+
+    def profile(self, seconds=None, output_path=None):
+        if not self.profiler.start(seconds or self.profile_seconds, output_path):
+            logging.warning("A profile is already being taken")
+
+    def shutdown(self):
+        self.gpt_request_engine.stop()
+        logging.info(f"Stopping message sender: {self.message_sender.get_stats()}")
+        self.message_sender.stop()
+        self.input_handler.typing_indicator.shutdown()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.storage.close()
+
+    def run_webhook(self, webhook_config: WebhookConfig):
+        dp = self.updater.dispatcher
+        # Fails on a bad config, e.g. without a secret token, before anything is started
+        self.webhook_server = WebhookServer(self.updater.bot, dp.update_queue, webhook_config)
+
+        dispatcher_thread = threading.Thread(target=dp.start, name="dispatcher")
+        dispatcher_thread.start()
+        self.webhook_server.start()
+        if webhook_config.webhook_url:
+            self.webhook_server.register_webhook(allowed_updates=Update.ALL_TYPES)
+
+        # Block until stopped, like Updater.idle() does for polling
+        stop_event = threading.Event()
+        for stop_signal in (SIGINT, SIGTERM, SIGABRT):
+            signal(stop_signal, lambda signum, frame: stop_event.set())
+        while not stop_event.wait(1):
+            pass
+
+        logging.info(f"Stopping webhook server: {self.webhook_server.get_stats()}")
+        self.webhook_server.stop()
+        dp.stop()
+        dispatcher_thread.join()
 
 
 # Set your API keys as environment variables
 TELEGRAM_API_KEY = 'tg_api_key' #os.getenv('TELEGRAM_API_KEY')
 GPT_API_KEY = 'gpt_api_key' #os.getenv('GPT_API_KEY')
+STORAGE_PATH = 'akgpt_bot.db'
+# Set to e.g. 'redis://localhost:6379/0' to enforce limits consistently across several workers
+SHARED_STATE_URL = None
+# How message limits are counted: 'token_bucket' spreads a chat's daily limit across the day,
+# 'sliding_window', 'fixed_window' or 'calendar_day' let a chat use all of it at once
+MESSAGE_LIMIT_ALGORITHM = 'token_bucket'
+# With 'calendar_day', the time zone the days are counted in and the hour the limits reset at
+MESSAGE_LIMIT_TIMEZONE = 'UTC'
+MESSAGE_LIMIT_RESET_HOUR = 0
+# Set to e.g. WebhookConfig(webhook_url='https://example.com/telegram', secret_token='...') to receive updates via webhook instead of polling;
+# the server listens on 127.0.0.1 behind a TLS-terminating proxy unless `listen` says otherwise
+WEBHOOK_CONFIG = None
+# Set to e.g. MetricsConfig(port=9090) to expose Prometheus metrics on http://127.0.0.1:9090/metrics
+METRICS_CONFIG = None
 
 if __name__ == '__main__':
-    gpt_bot = GPTBot(TELEGRAM_API_KEY, GPT_API_KEY)
-    gpt_bot.run()
+    gpt_bot = GPTBot(TELEGRAM_API_KEY, GPT_API_KEY, STORAGE_PATH, SHARED_STATE_URL, message_limit_algorithm=MESSAGE_LIMIT_ALGORITHM,
+                     message_limit_timezone=MESSAGE_LIMIT_TIMEZONE, message_limit_reset_hour=MESSAGE_LIMIT_RESET_HOUR)
+    gpt_bot.run(WEBHOOK_CONFIG, METRICS_CONFIG)
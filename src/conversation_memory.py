@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict, deque, namedtuple
+
+from telegram import Message
+
+from token_counter import count_tokens, TOKENS_PER_MESSAGE
+
+# One question and the bot's answer to it
+Turn = namedtuple("Turn", ["question", "answer", "tokens"])
+
+class ConversationThread:
+    """
+    A class for the recent turns of one reply chain, kept in a ring buffer,
+    plus an optional summary of the turns that no longer fit in it.
+    """
+    def __init__(self, max_turns: int):
+        self.turns = deque(maxlen=max_turns)
+        self.summary = None
+
+class ChatConversations:
+    """
+    A class for the conversation threads of one chat and the messages that belong to each of them.
+    """
+    def __init__(self):
+        self.threads = OrderedDict()  # thread_id -> ConversationThread, least recently used first
+        self.message_threads = OrderedDict()  # message_id -> thread_id
+
+class ConversationMemory:
+    """
+    A class for remembering recent GPT conversations, so follow-up questions are answered in context.
+    A conversation thread is a Telegram reply chain: replying to the bot's answer (or to a question)
+    continues its thread, any other question starts a new one.
+    Memory is bounded on every level: turns per thread, threads per chat and chats, each evicted least recently used first.
+    """
+    def __init__(self, max_chats=2000, max_threads_per_chat=20, max_turns=10, context_token_budget=1500, summarizer=None):
+        self.max_chats = max_chats
+        self.max_threads_per_chat = max_threads_per_chat
+        self.max_turns = max_turns
+        self.context_token_budget = context_token_budget  # Maximum tokens of history sent with a question
+        # Optional callable (summary, evicted Turn) -> new summary, used to fold turns leaving the ring buffer
+        # into a rolling summary. It runs on the dispatcher thread, so it should be cheap.
+        self.summarizer = summarizer
+
+        self.chats = OrderedDict()  # chat_id -> ChatConversations, least recently used first
+        self.lock = threading.Lock()
+
+    def _get_chat(self, chat_id: int) -> ChatConversations:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatConversations()
+            while len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        self.chats.move_to_end(chat_id)
+        return chat
+
+    def resolve_thread(self, chat_id: int, message: Message) -> int:
+        """
+        Returns the id of the thread a question belongs to.
+        """
+        reply_to_message = message.reply_to_message
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            if reply_to_message and chat and reply_to_message.message_id in chat.message_threads:
+                return chat.message_threads[reply_to_message.message_id]
+        return message.message_id
+
+    def get_context(self, chat_id: int, thread_id: int) -> list:
+        """
+        Returns the chat completion messages of the thread's history, newest turns first to fit into the token budget.
+        """
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            thread = chat.threads.get(thread_id) if chat else None
+            if thread is None:
+                return []
+            turns = list(thread.turns)
+            summary = thread.summary
+
+        context = []
+        remaining_tokens = self.context_token_budget
+        for turn in reversed(turns):
+            if turn.tokens > remaining_tokens:
+                break
+            remaining_tokens -= turn.tokens
+            context[:0] = [{"role": "user", "content": turn.question}, {"role": "assistant", "content": turn.answer}]
+
+        if summary and count_tokens(summary) + TOKENS_PER_MESSAGE <= remaining_tokens:
+            context.insert(0, {"role": "system", "content": summary})
+        return context
+
+    def add_turn(self, chat_id: int, thread_id: int, question: str, answer: str, message_ids):
+        """
+        Stores a question and its answer; `message_ids` are the messages replies to which continue the thread.
+        """
+        tokens = count_tokens(question) + count_tokens(answer) + 2 * TOKENS_PER_MESSAGE
+        with self.lock:
+            chat = self._get_chat(chat_id)
+            thread = chat.threads.get(thread_id)
+            if thread is None:
+                thread = chat.threads[thread_id] = ConversationThread(self.max_turns)
+                while len(chat.threads) > self.max_threads_per_chat:
+                    chat.threads.popitem(last=False)
+            chat.threads.move_to_end(thread_id)
+
+            if len(thread.turns) == thread.turns.maxlen and self.summarizer:
+                thread.summary = self.summarizer(thread.summary, thread.turns[0])
+            thread.turns.append(Turn(question, answer, tokens))
+
+            for message_id in message_ids:
+                if message_id is not None:
+                    chat.message_threads[message_id] = thread_id
+            while len(chat.message_threads) > self.max_threads_per_chat * self.max_turns * 2:
+                chat.message_threads.popitem(last=False)
@@ -1,15 +1,35 @@
 import time
+import uuid
+from collections import namedtuple
+
+from storage import Storage
+from shared_state import SharedState, LocalSharedState
+from model_registry import calculate_cost
+
+# Budget set aside for a GPT request that is in flight
+Reservation = namedtuple("Reservation", ["chat_id", "usd", "reservation_id"])
 
 class FinancialValidator:
     """
     A class for validating financial-related input for GPTBot.
+    Spending is kept in the shared state, so several workers enforce a chat's limit together.
     """
-    def __init__(self):
-        self.spent_tokens = {}
-        self.reset_times = {}
-        self.dollar_limits = {}
+    def __init__(self, storage: Storage = None, shared_state: SharedState = None, reservation_ttl=3 * 60):
+        self.shared_state = shared_state or LocalSharedState(storage)
+        self.spent_usd = self.shared_state.dict("financial.spent_usd")
+        self.reset_times = self.shared_state.dict("financial.reset_times")
+        self.dollar_limits = self.shared_state.dict("financial.dollar_limits")
         self.reset_interval = 24 * 60 * 60  # 24 hours in seconds
-        self.price_per_token = 0.002 / 1000  # Price per token in USD
+        
+        # chat_id -> {reservation id: [estimated cost, expiry time]} of the chat's requests in flight.
+        # A reservation that is never committed or released, e.g. by a crashed worker, stops counting after
+        # `reservation_ttl` seconds, which should be somewhat longer than a GPT request may take.
+        self.reserved_usd = self.shared_state.dict("financial.reserved_usd", persistent=False)
+        self.reservation_ttl = reservation_ttl
+
+    def lock(self, chat_id):
+        # Makes checking, reserving and registering a chat's spending atomic
+        return self.shared_state.lock(f"financial:{chat_id}")
 
     def set_limit(self, chat_id, limit):
         self.dollar_limits[chat_id] = limit
@@ -19,7 +39,7 @@ class FinancialValidator:
 
     def remove_limit(self, chat_id):
         self._remove_data(chat_id, self.dollar_limits)
-        self._remove_data(chat_id, self.spent_tokens)
+        self._remove_data(chat_id, self.spent_usd)
         self._remove_data(chat_id, self.reset_times)
 
     def _remove_data(self, chat_id, data_dict):
@@ -29,29 +49,91 @@ class FinancialValidator:
     def get_limit(self, chat_id):
         return self.dollar_limits.get(chat_id, None)
 
-    def register_tokens(self, chat_id, tokens):
+    def get_reset_time(self, chat_id):
+        return self.reset_times.get(chat_id, None)
+
+    def register_tokens(self, chat_id, model, prompt_tokens, completion_tokens):
+        self.register_spending(chat_id, self.calculate_usd(model, prompt_tokens, completion_tokens))
+
+    def register_spending(self, chat_id, usd):
         if not self.has_limit(chat_id):
             return
-        
-        current_time = time.time()
 
-        self._initialize_chat_data(chat_id, self.spent_tokens, 0)
+        with self.lock(chat_id):
+            self._register_spending(chat_id, usd)
+
+    def _register_spending(self, chat_id, usd):
+        if not self.has_limit(chat_id):
+            return
+
+        current_time = time.time()
+        self._initialize_chat_data(chat_id, self.spent_usd, 0)
         self._initialize_chat_data(chat_id, self.reset_times, current_time)
 
-        self._reset_spent_tokens_if_interval_passed(chat_id, current_time)
+        self._reset_spending_if_interval_passed(chat_id, current_time)
+
+        self.spent_usd[chat_id] += usd
+
+    def reserve(self, chat_id, model, prompt_tokens, max_completion_tokens):
+        """
+        Sets aside the worst-case cost of a request before it is sent.
+        Returns None when the chat's remaining budget, minus what other requests in flight have reserved, cannot cover it.
+        """
+        usd = self.calculate_usd(model, prompt_tokens, max_completion_tokens)
+        with self.lock(chat_id):
+            if self.has_limit(chat_id):
+                if chat_id in self.reset_times:
+                    self._reset_spending_if_interval_passed(chat_id, time.time())
+                committed_usd = self._calculate_spent_amount(chat_id) + self._calculate_reserved_amount(chat_id)
+                if committed_usd + usd > self.dollar_limits[chat_id]:
+                    return None
+            reservation = Reservation(chat_id, usd, uuid.uuid4().hex)
+            reservations = self._get_reservations(chat_id)
+            reservations[reservation.reservation_id] = [usd, time.time() + self.reservation_ttl]
+            self.reserved_usd[chat_id] = reservations
+        return reservation
+
+    def commit(self, reservation: Reservation, model, prompt_tokens, completion_tokens):
+        """
+        Replaces a reservation with the cost of the tokens the request actually used.
+        """
+        with self.lock(reservation.chat_id):
+            self._release(reservation)
+            self._register_spending(reservation.chat_id, self.calculate_usd(model, prompt_tokens, completion_tokens))
+
+    def release(self, reservation: Reservation):
+        with self.lock(reservation.chat_id):
+            self._release(reservation)
+
+    def _release(self, reservation: Reservation):
+        # Gone already if it expired or the interval was reset; expired reservations of the chat are dropped too
+        reservations = self._get_reservations(reservation.chat_id)
+        reservations.pop(reservation.reservation_id, None)
+        if reservations:
+            self.reserved_usd[reservation.chat_id] = reservations
+        else:
+            self.reserved_usd.pop(reservation.chat_id, None)
+
+    def _get_reservations(self, chat_id):
+        # The chat's reservations that have not expired
+        current_time = time.time()
+        return {reservation_id: entry for reservation_id, entry in self.reserved_usd.get(chat_id, {}).items() if entry[1] > current_time}
 
-        self.spent_tokens[chat_id] += tokens
+    def _calculate_reserved_amount(self, chat_id):
+        return sum(usd for usd, _ in self._get_reservations(chat_id).values())
 
     def _initialize_chat_data(self, chat_id, data_dict, default_value):
         if chat_id not in data_dict:
             data_dict[chat_id] = default_value
 
-    def _reset_spent_tokens_if_interval_passed(self, chat_id, current_time):
+    def _reset_spending_if_interval_passed(self, chat_id, current_time):
         # Check if the reset interval has passed
         if current_time - self.reset_times[chat_id] > self.reset_interval:
-            # Reset spent tokens and set the new reset time for the chat
-            self.spent_tokens[chat_id] = 0
+            # Reset spending and set the new reset time for the chat
+            self.spent_usd[chat_id] = 0
             self.reset_times[chat_id] = current_time
+            # Requests still in flight count towards the new interval once they complete
+            self.reserved_usd.pop(chat_id, None)
 
     def is_spending_within_limit(self, chat_id):
         # If there's no limit set for the chat, spending is always within limit
@@ -65,10 +147,7 @@ class FinancialValidator:
         return spent_amount <= self.dollar_limits[chat_id]
 
     def _calculate_spent_amount(self, chat_id):
-        # Get the number of spent tokens for the chat
-        tokens_spent = self.spent_tokens.get(chat_id, 0)
-        # Calculate the spent amount in USD
-        return tokens_spent * self.price_per_token
+        return self.spent_usd.get(chat_id, 0)
 
     def left_dollar_usage(self, chat_id: int) -> float:
         # Calculate the spent amount in USD
@@ -85,11 +164,16 @@ class FinancialValidator:
         if not self.has_limit(chat_id):
             return True
 
+        # Start a new interval if the last one is over, or a chat that overspent would stay blocked for good
+        with self.lock(chat_id):
+            if chat_id in self.reset_times:
+                self._reset_spending_if_interval_passed(chat_id, time.time())
+
         if self.is_spending_within_limit(chat_id):
             return True
 
         return False
     
-    def calculate_usd(self, tokens: int) -> float:
-        return tokens * self.price_per_token
+    def calculate_usd(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        return calculate_cost(model, prompt_tokens, completion_tokens)
     
\ No newline at end of file
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from openai.openai_object import OpenAIObject
+
+from openai_client import OpenAIClient
+from tracing import current_trace, record_stage
+from token_counter import count_tokens, count_message_tokens
+
+class Flight:
+    """
+    A class for one upstream completion shared by every identical request submitted while it runs.
+    """
+    def __init__(self):
+        self.task: asyncio.Task = None
+        self.subscribers = 0
+        self.answer_parts = []
+        self.delta_listeners = []
+
+    def add_delta_listener(self, on_delta):
+        # Catch a late subscriber up with the text streamed so far
+        if self.answer_parts:
+            on_delta("".join(self.answer_parts))
+        self.delta_listeners.append(on_delta)
+
+    def publish_delta(self, delta: str):
+        self.answer_parts.append(delta)
+        for on_delta in self.delta_listeners:
+            on_delta(delta)
+
+class GPTRequestEngine:
+    """
+    A class for running OpenAI chat completions on a dedicated asyncio event loop,
+    so that slow upstream calls never occupy the Telegram dispatcher threads.
+    Identical requests (same model, messages and parameters) submitted while one of them is in flight
+    share its upstream call; the response tells how many requests shared it in "shared_by".
+    """
+    def __init__(self, max_in_flight=8, request_timeout=120, coalesce_requests=True, client: OpenAIClient = None):
+        self.client = client or OpenAIClient(max_concurrency=max_in_flight)  # Caps concurrency and retries failed calls
+        self.request_timeout = request_timeout  # Seconds before a completion, retries included, is abandoned
+        self.coalesce_requests = coalesce_requests
+        self.in_flight = 0
+        self.coalesced_requests = 0  # Requests answered by another request's upstream call
+
+        self.flights = {}  # Request key -> Flight; only used on the engine loop
+
+        self.loop = asyncio.new_event_loop()
+        self._loop_ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="gpt-request-engine", daemon=True)
+        self._thread.start()
+        self._loop_ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._loop_ready.set()
+        self.loop.run_forever()
+
+    def submit(self, chat_id=None, **request_kwargs) -> Future:
+        """
+        Schedule a chat completion from any thread and return a concurrent future for its response.
+        """
+        return asyncio.run_coroutine_threadsafe(self._join_flight(None, chat_id, request_kwargs, current_trace.get()), self.loop)
+
+    def submit_stream(self, on_delta, chat_id=None, **request_kwargs) -> Future:
+        """
+        Schedule a streamed chat completion. `on_delta` is called on the engine loop with every new
+        piece of text, so it must be cheap and non-blocking. The future resolves to a response shaped
+        like a regular (non-streamed) completion, with locally counted usage.
+        """
+        return asyncio.run_coroutine_threadsafe(self._join_flight(on_delta, chat_id, request_kwargs, current_trace.get()), self.loop)
+
+    async def _join_flight(self, on_delta, chat_id, request_kwargs, trace=None):
+        # Every task has its own context, so this puts the task, and the upstream call it starts, in the submitter's trace
+        current_trace.set(trace)
+        key = json.dumps(request_kwargs, sort_keys=True) if self.coalesce_requests else object()
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight()
+            if on_delta:
+                completion = self._collect_stream(flight.publish_delta, request_kwargs)
+            else:
+                completion = self._create_completion(request_kwargs)
+            flight.task = self.loop.create_task(self._run_flight(key, flight, chat_id, completion))
+        else:
+            self.coalesced_requests += 1
+            logging.info(f"Sharing an in-flight {request_kwargs.get('model')} completion with {flight.subscribers} other requests")
+
+        flight.subscribers += 1
+        if on_delta:
+            flight.add_delta_listener(on_delta)
+        # Shielded, so a subscriber being cancelled does not cancel the call for the others
+        return await asyncio.shield(flight.task)
+
+    async def _run_flight(self, key, flight: Flight, chat_id, completion):
+        try:
+            response = await self._run_limited(chat_id, completion)
+            response["shared_by"] = flight.subscribers
+            return response
+        finally:
+            del self.flights[key]
+
+    async def _run_limited(self, chat_id, coroutine):
+        queued_time = time.monotonic()
+        async with self.client.slot(chat_id):
+            record_stage("openai_queue", queued_time)
+            start_time = time.monotonic()
+            self.in_flight += 1
+            try:
+                return await asyncio.wait_for(coroutine, self.request_timeout)
+            finally:
+                self.in_flight -= 1
+                record_stage("openai", start_time)
+
+    async def _create_completion(self, request_kwargs):
+        return await self.client.create_chat_completion(**request_kwargs)
+
+    async def _collect_stream(self, on_delta, request_kwargs):
+        chunks = await self.client.create_chat_completion(stream=True, **request_kwargs)
+        answer_parts = []
+        async for chunk in chunks:
+            delta = chunk["choices"][0]["delta"].get("content")
+            if delta:
+                answer_parts.append(delta)
+                on_delta(delta)
+
+        answer_text = "".join(answer_parts)
+        # Streamed responses carry no usage, so count the tokens locally
+        prompt_tokens = count_message_tokens(request_kwargs["messages"], request_kwargs["model"])
+        completion_tokens = count_tokens(answer_text, request_kwargs["model"])
+        return OpenAIObject.construct_from({
+            "choices": [{"message": {"role": "assistant", "content": answer_text}}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    def stop(self):
+        if not self.loop.is_running():
+            return
+        logging.info(f"Stopping GPT request engine with {self.in_flight} requests in flight")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
@@ -1,34 +1,82 @@
 import openai
 import logging
-import threading
 from typing import List
 from telegram.ext import CallbackContext
-from telegram import Update, Message
-import asyncio
-from telegram.error import RetryAfter
+from telegram import Update, Message, Chat
+from collections import namedtuple
+from concurrent.futures import Future
 
 from admin_menu_manager import AdminMenuManager
-from financial_validator import FinancialValidator
-from message_limit_handler import MessageLimitHandler
-from translator import Translator
+from gpt_request_engine import GPTRequestEngine
+from openai_client import CircuitOpenError
+from streaming_reply import StreamingReply
+from message_sender import MessageSender, PRIORITY
+from message_chunker import split_message
+from typing_indicator import TypingIndicatorManager
+from ttl_cache import TTLCache
+from token_counter import count_tokens, count_message_tokens
+from model_registry import ModelRouter, DEFAULT_MODEL
+from conversation_memory import ConversationMemory
+from response_cache import ResponseCache
+from financial_validator import FinancialValidator, Reservation
+from message_limit_handler import MessageLimitHandler, MessageReservation
 from localization import loc
+from tracing import Trace, stage, bind, hold_trace
+from metrics import TOKENS, USD_SPENT, RESPONSE_CACHE_LOOKUPS, REJECTED_REQUESTS
+
+# Everything needed to deliver and account for a GPT answer once the completion finishes
+GPTRequest = namedtuple("GPTRequest", [
+    "context",
+    "message",
+    "chat_id",
+    "user_id",
+    "lang",
+    "request_kwargs",
+    "streaming_reply",
+    "reservation",
+    "message_reservation",
+    "question",
+    "thread_id",
+    "cache_key",  # Response cache key the answer is stored under, None when the chat has no cache or the question has context
+    "trace",  # Trace of the update, kept open until the answer is sent
+])
 
 class InputHandler:
     """
     A class for handling input for GPTBot other than commands.
     """
-    def __init__(self, message_limit_handler, financial_validator, updater):
+    def __init__(self, message_limit_handler, financial_validator, updater, gpt_request_engine, storage=None, stream_responses=True, message_sender=None, callback_secret=None):
         self.chat_states = {}  # Add this line
         self.message_limit_handler: MessageLimitHandler = message_limit_handler
         self.financial_validator: FinancialValidator = financial_validator
         self.updater = updater
-        self.translator = Translator()
-        self.admin_menu_manager = AdminMenuManager(message_limit_handler, financial_validator)
+        self.gpt_request_engine: GPTRequestEngine = gpt_request_engine
+        self.message_sender: MessageSender = message_sender or MessageSender(updater.bot)
+        self.admin_menu_manager = AdminMenuManager(message_limit_handler, financial_validator, self.message_sender, storage, callback_secret)
+        
+        # Keeps the typing action alive for every chat with a pending request
+        self.typing_indicator = TypingIndicatorManager(updater.bot)
+        
+        # Stream answers into a placeholder reply; edits are spaced out to stay within Telegram flood limits
+        self.stream_responses = stream_responses
+        self.stream_edit_interval = 1.0  # Seconds between edits in private chats
+        self.group_stream_edit_interval = 3.0  # Seconds between edits in group chats
         
-        # Create an event to stop the typing action when the response is received
-        self.stop_typing_event: threading.Event = None
+        self.max_completion_tokens = 1024  # Caps the answer length, and with it the cost reserved per request
+        # Answers longer than this many characters are sent as a file after their first part; None splits them into messages
+        self.document_answer_length = None
+        self.model_router = ModelRouter()
+        # Recent turns of every reply chain, sent along with follow-up questions
+        self.conversation_memory = ConversationMemory()
+        # Answers to repeated questions in chats that opted in, served without calling GPT
+        self.response_cache = ResponseCache(storage=storage)
         
         self.total_tokens_used = 0
+        self.total_usd_spent = 0
+        
+        self.chat_names = TTLCache(max_size=5000, ttl=60 * 60)  # chat_id -> title or username
+        # (chat_id, limit type, reset window start) of limit notifications already sent to the admins
+        self.sent_limit_notifications = TTLCache(max_size=5000, ttl=24 * 60 * 60)
         
     def admin_notifications_enabled(self, chat_id: int) -> bool:
         self.admin_menu_manager.admin_notifications_enabled(chat_id)
@@ -42,6 +90,11 @@ class InputHandler:
     def handle_admin_callback(self, update: Update, context: CallbackContext):
         self.admin_menu_manager.handle_admin_callback(update, context)
         
+    def handle_chat_member_update(self, update: Update, context: CallbackContext):
+        if update.effective_chat:
+            self.remember_chat(update.effective_chat)
+        self.admin_menu_manager.handle_chat_member_update(update, context)
+        
     def handle_text(self, update: Update, context: CallbackContext):
         user_id = update.effective_user.id
         
@@ -54,109 +107,282 @@ class InputHandler:
     def start_gpt_question(self, update: Update, context: CallbackContext):
         user_id = update.effective_user.id
         context.chat_data[user_id] = True
-        update.message.reply_text(f'{loc("enter_question")}:')
+        self.message_sender.reply_to(update.message, f'{loc("enter_question", update.effective_user.language_code)}:')
             
-    def send_typing_action(self, chat_id, stop_typing_event, context):
-        if self.stop_typing_event is None:
-            return
-        while not stop_typing_event.is_set():
-            context.bot.send_chat_action(chat_id=chat_id, action='typing')
-            stop_typing_event.wait(5)
-
     def notify_admins_limit_reached(self, chat_id: int, limit_type: str, context: CallbackContext):
         if not self.admin_menu_manager.admin_notifications_enabled(chat_id):
             return
 
         dest_chat_id = self.admin_menu_manager.get_admin_notification_chat_id(chat_id)
         if dest_chat_id:
+            notification_key = (chat_id, limit_type, self.get_limit_reset_time(chat_id, limit_type))
+            if notification_key in self.sent_limit_notifications:
+                return
+            self.sent_limit_notifications.set(notification_key, True)
+
             chat_name = self.get_chat_name(context, chat_id)
             message = loc("limit_reached", limit_type=limit_type, chat_name=chat_name)
-            self.updater.bot.send_message(chat_id=dest_chat_id, text=message)
+            self.message_sender.send_message(dest_chat_id, message, PRIORITY.NOTIFICATION)
         else:
             message = loc("no_destination_chat_id", chat_id=chat_id)
             logging.info(message)
             
+    def get_limit_reset_time(self, chat_id: int, limit_type: str):
+        if limit_type == "USD":
+            return self.financial_validator.get_reset_time(chat_id)
+        return self.message_limit_handler.get_reset_time(chat_id)
+
     def get_chat_name(self, context: CallbackContext, chat_id: int):
-        bot = context.bot
-        chat = bot.get_chat(chat_id)
-        return chat.title or chat.username
+        chat_name = self.chat_names.get(chat_id)
+        if chat_name is None:
+            bot = context.bot
+            chat = bot.get_chat(chat_id)
+            chat_name = self.remember_chat(chat)
+        return chat_name
+
+    def remember_chat(self, chat: Chat):
+        chat_name = chat.title or chat.username
+        self.chat_names.set(chat.id, chat_name)
+        return chat_name
     
     def start_typing(self, context: CallbackContext, chat_id: int):
-        self.stop_typing_event = threading.Event()
-        # Start a separate thread to send the typing action
-        typing_thread = threading.Thread(target=self.send_typing_action, args=(chat_id, self.stop_typing_event, context))
-        typing_thread.start()
+        self.typing_indicator.start(chat_id)
         
-    def stop_typing(self):
-        if self.stop_typing_event is None:
-            return
-        self.stop_typing_event.set()
+    def stop_typing(self, chat_id: int):
+        self.typing_indicator.stop(chat_id)
         
-    async def send_message_with_delay(self, context, chat_id, text, delay):
-        await asyncio.sleep(delay)
-        context.bot.send_message(chat_id=chat_id, text=text)
-    
     def process_gpt_request(self, context: CallbackContext, message: Message, chat_id: int):
         self.chat_states[chat_id] = None  # Reset the chat state
+        self.remember_chat(message.chat)
 
-        if not self.is_request_allowed(message, chat_id):
+        # Claim a message slot up front, so concurrent requests cannot overshoot the chat's message limits together
+        with stage("limit_check"):
+            message_reservation = self.reserve_request(message, chat_id)
+        if message_reservation is None:
             return
 
         question = message.text
-        
-        self.start_typing(context, chat_id)
+        lang = message.from_user.language_code
 
-        bot_system_desc = self.admin_menu_manager.get_bot_description(chat_id)
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": bot_system_desc},
-                    {"role": "user", "content": f"{question}\n\nAnswer:"}
-                ])
-        except openai.error.RateLimitError:
-            message.reply_text(loc('model_overloaded'))
-            self.stop_typing()
-            return
-        except Exception as e:
-            logging.error(f"An error occurred while processing the GPT request: {e}")
-            message.reply_text(loc('gpt_error_message'))
-            self.stop_typing()
+        bot_system_desc = self.admin_menu_manager.get_bot_description(chat_id, lang)
+        thread_id = self.conversation_memory.resolve_thread(chat_id, message)
+        history = self.conversation_memory.get_context(chat_id, thread_id)
+        messages = [
+            {"role": "system", "content": bot_system_desc},
+            *history,
+            {"role": "user", "content": f"{question}\n\nAnswer:"}
+        ]
+        prompt_tokens = count_message_tokens(messages)
+        model = self.model_router.select_model(
+            self.admin_menu_manager.get_chat_model(chat_id),
+            count_tokens(question),
+            prompt_tokens,
+            self.max_completion_tokens,
+            self.financial_validator.left_dollar_usage(chat_id))
+        request_kwargs = dict(model=model, messages=messages, max_tokens=self.max_completion_tokens)
+
+        # Follow-up questions depend on their thread, so only standalone questions are cached
+        cache_key = None
+        if self.admin_menu_manager.response_cache_enabled(chat_id) and not history:
+            cache_key = self.response_cache.make_key(chat_id, model, bot_system_desc, question)
+            cached_answer = self.response_cache.get(cache_key)
+            RESPONSE_CACHE_LOOKUPS.inc("miss" if cached_answer is None else "hit")
+            if cached_answer is not None:
+                self.reply_with_cached_answer(message, chat_id, thread_id, question, cached_answer, message_reservation)
+                return
+
+        # Set aside the worst-case cost up front, so concurrent requests cannot overshoot the chat's USD limit together
+        with stage("budget_check"):
+            reservation = self.financial_validator.reserve(chat_id, model, prompt_tokens, self.max_completion_tokens)
+        if reservation is None:
+            self.message_limit_handler.release(message_reservation)
+            REJECTED_REQUESTS.inc("usd_reservation")
+            self.message_sender.reply_to(message, loc('daily_usd_limit_reached', lang))
+            # Reservations keep spending from going over the limit, so the limit is reached once they are refused
+            self.notify_admins_limit_reached(chat_id, "USD", context)
             return
 
-        self.handle_gpt_response(chat_id, context, response)
+        streaming_reply = self.start_streaming_reply(message, chat_id) if self.stream_responses else None
+        gpt_request = GPTRequest(
+            context, message, chat_id, message.from_user.id, lang, request_kwargs, streaming_reply, reservation, message_reservation, question,
+            thread_id, cache_key, hold_trace())
+        if streaming_reply:
+            future = self.gpt_request_engine.submit_stream(streaming_reply.append, chat_id=chat_id, **request_kwargs)
+        else:
+            self.start_typing(context, chat_id)
+            future = self.gpt_request_engine.submit(chat_id=chat_id, **request_kwargs)
+
+        # Hand the finished completion back to the dispatcher's worker pool instead of blocking on it here
+        handle_gpt_completion = bind(self.handle_gpt_completion)
+        future.add_done_callback(
+            lambda done: self.updater.dispatcher.run_async(handle_gpt_completion, gpt_request, done))
 
-        # Set the event to stop the typing action
-        self.stop_typing()
+    def start_streaming_reply(self, message: Message, chat_id: int):
+        flood_wait = self.message_sender.get_chat_delay(chat_id)
+        if flood_wait:
+            # Fall back to a single reply once the answer is complete
+            logging.warning(f"Chat {chat_id} is flood limited, not streaming the response for the next {flood_wait:.0f} seconds")
+            return None
+        if not self.message_sender.is_chat_ready(chat_id):
+            # A placeholder would cost the busy chat one more message; the answer goes out as a single reply instead
+            return None
+        # The placeholder is queued, not awaited: the completion starts right away and its text is shown once the placeholder is sent
+        edit_interval = self.group_stream_edit_interval if chat_id < 0 else self.stream_edit_interval
+        return StreamingReply(self.message_sender, message, loc('gpt_thinking', message.from_user.language_code), edit_interval)
 
-        answer_text = response.choices[0].message.content.strip()
+    def handle_gpt_completion(self, gpt_request: "GPTRequest", future: Future):
+        sent = None
         try:
-            message.reply_text(answer_text)
-        except RetryAfter as e:
-            logging.warning(f"RetryAfter error, waiting {e.retry_after} seconds before sending message")
-            asyncio.ensure_future(self.send_message_with_delay(context, chat_id, answer_text, e.retry_after))
+            try:
+                response = future.result()
+            except (openai.error.RateLimitError, CircuitOpenError):
+                REJECTED_REQUESTS.inc("model_overloaded")
+                self.reply_with_error(gpt_request, loc('model_overloaded', gpt_request.lang))
+                self.release_reservations(gpt_request)
+                return
+            except Exception as e:
+                logging.error(f"An error occurred while processing the GPT request: {e}")
+                self.reply_with_error(gpt_request, loc('gpt_error_message', gpt_request.lang))
+                self.release_reservations(gpt_request)
+                return
+
+            self.handle_gpt_response(
+                gpt_request.chat_id, gpt_request.context, response, gpt_request.user_id, gpt_request.reservation, gpt_request.request_kwargs["model"],
+                gpt_request.message_reservation)
+
+            answer_text = response.choices[0].message.content.strip()
+            if gpt_request.cache_key:
+                self.response_cache.set(gpt_request.cache_key, answer_text)
+            sent = self.send_answer(gpt_request.message, answer_text, gpt_request.lang, gpt_request.streaming_reply)
+        finally:
+            # Registering the response may fail too, e.g. on a Telegram error fetching the chat or a lock timeout;
+            # the indicator must stop either way, and the trace ends here unless the answer is on its way
+            if not gpt_request.streaming_reply:
+                self.stop_typing(gpt_request.chat_id)
+            if sent is None:
+                self.finish_trace(gpt_request)
+        sent.add_done_callback(lambda sent: self.handle_answer_sent(gpt_request, answer_text, sent))
+
+    def send_answer(self, message: Message, answer_text: str, lang, streaming_reply: StreamingReply = None) -> Future:
+        """
+        Sends an answer of any length as an ordered batch of replies; a streamed reply is finished with the first part.
+        The future resolves to the list of messages sent besides the streamed reply.
+        """
+        if streaming_reply is None:
+            return self.send_answer_parts(message, answer_text, lang)
+        # Wait for the placeholder without blocking; if it could not be sent, the answer goes out as new messages
+        sent = Future()
+        streaming_reply.when_ready(lambda placeholder: chain_future(
+            self.send_answer_parts(message, answer_text, lang, streaming_reply if placeholder else None), sent))
+        return sent
+
+    def send_answer_parts(self, message: Message, answer_text: str, lang, streaming_reply: StreamingReply = None) -> Future:
+        bot = self.updater.bot
+        reply_kwargs = dict(chat_id=message.chat_id, reply_to_message_id=message.message_id, allow_sending_without_reply=True)
+        parts = split_message(answer_text) or [answer_text]
+        calls = []
+        if self.document_answer_length and len(answer_text) > self.document_answer_length:
+            # Show the beginning of a very long answer and attach all of it as a file
+            parts = parts[:1]
+            calls.append((bot.send_document, dict(
+                reply_kwargs, document=answer_text.encode("utf-8"), filename="answer.md", caption=loc('answer_as_document', lang))))
+
+        if streaming_reply:
+            streaming_reply.finish(parts.pop(0))
+        calls[:0] = [(bot.send_message, dict(reply_kwargs, text=part)) for part in parts]
+        return self.message_sender.send_batch(calls, PRIORITY.ANSWER)
+
+    def handle_answer_sent(self, gpt_request: "GPTRequest", answer_text: str, sent: Future):
+        self.finish_trace(gpt_request)
+        try:
+            answer_messages = sent.result()
         except Exception as e:
             logging.error(f"An error occurred while sending the GPT response: {e}")
-            message.reply_text(loc('gpt_error_message'))
+            self.message_sender.reply_to(gpt_request.message, loc('gpt_error_message', gpt_request.lang), PRIORITY.ANSWER)
+            return
+        answer_message_ids = [answer_message.message_id for answer_message in answer_messages]
+        if gpt_request.streaming_reply and gpt_request.streaming_reply.placeholder:
+            answer_message_ids.append(gpt_request.streaming_reply.placeholder.message_id)
+        self.remember_turn(gpt_request, answer_text, answer_message_ids)
+
+    def reply_with_cached_answer(self, message: Message, chat_id: int, thread_id: int, question: str, answer_text: str, message_reservation: MessageReservation):
+        logging.info(f"Answering a question in chat {chat_id} from the response cache")
+        sent = self.send_answer(message, answer_text, message.from_user.language_code)
+        # A cached answer costs no tokens, but still counts towards the message limits
+        self.message_limit_handler.commit(message_reservation)
+        sent.add_done_callback(lambda sent: self.handle_cached_answer_sent(message, chat_id, thread_id, question, answer_text, sent))
+
+    def handle_cached_answer_sent(self, message: Message, chat_id: int, thread_id: int, question: str, answer_text: str, sent: Future):
+        if sent.exception():
+            logging.error(f"An error occurred while sending the cached response: {sent.exception()}")
+            return
+        answer_message_ids = [answer_message.message_id for answer_message in sent.result()]
+        self.conversation_memory.add_turn(chat_id, thread_id, question, answer_text, [message.message_id, *answer_message_ids])
+
+    def remember_turn(self, gpt_request: "GPTRequest", answer_text: str, answer_message_ids=()):
+        self.conversation_memory.add_turn(
+            gpt_request.chat_id,
+            gpt_request.thread_id,
+            gpt_request.question,
+            answer_text,
+            [gpt_request.message.message_id, *answer_message_ids])
+
+    def finish_trace(self, gpt_request: "GPTRequest"):
+        trace: Trace = gpt_request.trace
+        if trace:
+            trace.release()
 
-    def is_request_allowed(self, message: Message, chat_id: int) -> bool:
+    def release_reservations(self, gpt_request: "GPTRequest"):
+        # A failed request counts towards neither limit
+        self.financial_validator.release(gpt_request.reservation)
+        self.message_limit_handler.release(gpt_request.message_reservation)
+
+    def reply_with_error(self, gpt_request: "GPTRequest", error_message: str):
+        if gpt_request.streaming_reply:
+            gpt_request.streaming_reply.when_ready(lambda placeholder: gpt_request.streaming_reply.finish(error_message) if placeholder
+                                                    else self.message_sender.reply_to(gpt_request.message, error_message, PRIORITY.ANSWER))
+            return
+        self.message_sender.reply_to(gpt_request.message, error_message, PRIORITY.ANSWER)
+
+    def reserve_request(self, message: Message, chat_id: int):
+        """
+        Returns the message slot claimed for the request, or None if a limit has been reached.
+        """
         if not self.financial_validator.can_send_message(chat_id):
-            message.reply_text(loc('daily_usd_limit_reached'))
-            return False
-        elif not self.message_limit_handler.can_send_message(chat_id):
-            message.reply_text(loc('daily_limit_reached'))
-            return False
-        return True
-
-    def handle_gpt_response(self, chat_id: int, context: CallbackContext, response):
-        tokens_used = response["usage"]["total_tokens"]
-        self.total_tokens_used += int(tokens_used)
-        logging.info(f'{tokens_used} tokens used; {self.total_tokens_used} total tokens used (since bot launch) == {self.financial_validator.calculate_usd(self.total_tokens_used)}$')
-
-        # Register the message in the MessageLimitHandler
-        self.message_limit_handler.register_message(chat_id)
-        # Register the message in the FinancialValidator
-        self.financial_validator.register_tokens(chat_id, tokens_used)
+            REJECTED_REQUESTS.inc("usd_limit")
+            self.message_sender.reply_to(message, loc('daily_usd_limit_reached', message.from_user.language_code))
+            return None
+        message_reservation = self.message_limit_handler.reserve(chat_id, message.from_user.id)
+        if message_reservation is None:
+            REJECTED_REQUESTS.inc("message_limit")
+            self.message_sender.reply_to(message, loc('daily_limit_reached', message.from_user.language_code))
+        return message_reservation
+
+    def handle_gpt_response(self, chat_id: int, context: CallbackContext, response, user_id: int = None, reservation: Reservation = None, model: str = DEFAULT_MODEL,
+                            message_reservation: MessageReservation = None):
+        usage = response["usage"]
+        # Identical requests from several chats may share one completion; each chat pays its share of it
+        shared_by = response.get("shared_by", 1)
+        tokens_used = usage["total_tokens"] / shared_by
+        prompt_tokens, completion_tokens = usage["prompt_tokens"] / shared_by, usage["completion_tokens"] / shared_by
+        usd_spent = self.financial_validator.calculate_usd(model, prompt_tokens, completion_tokens)
+        self.total_tokens_used += tokens_used
+        self.total_usd_spent += usd_spent
+        TOKENS.inc(model, "prompt", amount=prompt_tokens)
+        TOKENS.inc(model, "completion", amount=completion_tokens)
+        USD_SPENT.inc(str(chat_id), amount=usd_spent)
+        logging.info(f'{tokens_used:g} tokens used by {model} (completion shared by {shared_by}); {self.total_tokens_used:g} total tokens used (since bot launch) == {self.total_usd_spent}$')
+
+        # Register the message in the MessageLimitHandler, in place of the slot claimed for it
+        if message_reservation:
+            self.message_limit_handler.commit(message_reservation)
+        else:
+            self.message_limit_handler.register_message(chat_id, user_id)
+        # Register the message in the FinancialValidator, replacing the estimate reserved for it
+        if reservation:
+            self.financial_validator.commit(reservation, model, prompt_tokens, completion_tokens)
+        else:
+            self.financial_validator.register_tokens(chat_id, model, prompt_tokens, completion_tokens)
 
         if not self.financial_validator.is_spending_within_limit(chat_id):
             self.notify_admins_limit_reached(chat_id, "USD", context)
@@ -175,4 +401,15 @@ class InputHandler:
     def is_user_admin(self, update: Update, context: CallbackContext) -> bool:
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
-        return self.admin_menu_manager.is_user_admin(user_id, chat_id, context)
\ No newline at end of file
+        return self.admin_menu_manager.is_user_admin(user_id, chat_id, context)
+
+def chain_future(source: Future, target: Future):
+    """
+    Resolves `target` with the outcome of `source` once it is done.
+    """
+    def copy_outcome(source: Future):
+        if source.exception():
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+    source.add_done_callback(copy_outcome)
@@ -3,5 +3,5 @@ from translator import Translator
 
 translator = Translator()
 
-def loc(key, **kwargs):
-    return translator.localised(key, **kwargs)
+def loc(key, lang=None, **kwargs):
+    return translator.localised(key, lang=lang, **kwargs)
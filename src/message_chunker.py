@@ -0,0 +1,74 @@
+import re
+
+from streaming_reply import MAX_MESSAGE_LENGTH
+
+CODE_FENCE = re.compile(r"^\s*```")
+CLOSING_FENCE = "```"
+
+def split_message(text: str, max_length=MAX_MESSAGE_LENGTH) -> list:
+    """
+    Splits text into messages of at most `max_length` characters.
+    Cuts go at paragraph ends or after code blocks where possible, then at line ends, then between words.
+    A code block that has to be cut is closed at the end of one message and reopened with the same fence
+    (language included) at the start of the next, so every message is valid Markdown on its own.
+    """
+    text = text.strip()
+    if len(text) <= max_length:
+        return [text] if text else []
+
+    # Leave room for closing and reopening a code block around every cut
+    fence_lengths = [len(line.strip()) for line in text.split("\n") if CODE_FENCE.match(line)]
+    line_limit = max_length - (max(fence_lengths, default=0) + len(CLOSING_FENCE) + 2)
+
+    chunks = []
+    current_lines = []
+    current_length = 0
+    last_break = 0  # Number of lines in current_lines up to the last paragraph or code block end
+    in_code = False
+    for line in _split_long_lines(text.split("\n"), line_limit):
+        while current_lines and current_length + len(line) + 1 > line_limit:
+            cut = last_break or len(current_lines)
+            chunks.append(current_lines[:cut])
+            current_lines = current_lines[cut:]
+            current_length = sum(len(chunk_line) + 1 for chunk_line in current_lines)
+            last_break = 0
+
+        current_lines.append(line)
+        current_length += len(line) + 1
+        if CODE_FENCE.match(line):
+            in_code = not in_code
+            if not in_code:
+                last_break = len(current_lines)
+        elif not in_code and not line.strip():
+            last_break = len(current_lines)
+    chunks.append(current_lines)
+
+    return _balance_code_fences(chunks)
+
+def _split_long_lines(lines, line_limit: int):
+    for line in lines:
+        while len(line) > line_limit:
+            cut = line.rfind(" ", 0, line_limit)
+            if cut <= 0:
+                cut = line_limit
+            yield line[:cut]
+            line = line[cut:].lstrip(" ")
+        yield line
+
+def _balance_code_fences(chunks) -> list:
+    messages = []
+    open_fence = None
+    for chunk_lines in chunks:
+        lines = [open_fence] if open_fence else []
+        for line in chunk_lines:
+            if CODE_FENCE.match(line):
+                open_fence = None if open_fence else line.strip()
+            lines.append(line)
+        if open_fence:
+            lines.append(CLOSING_FENCE)
+
+        message = "\n".join(lines).strip("\n")
+        # A chunk holding only a reopened and closed fence has nothing to show
+        if message.strip() and message != f"{open_fence}\n{CLOSING_FENCE}":
+            messages.append(message)
+    return messages
@@ -1,74 +1,147 @@
 import time
+import uuid
+from collections import namedtuple
+
+from storage import Storage
+from shared_state import SharedState, LocalSharedState
+from rate_limiters import RateLimiter, create_rate_limiter
+
+# A message slot claimed by a GPT request that is in flight
+MessageReservation = namedtuple("MessageReservation", ["chat_id", "user_id", "reservation_id"])
 
 class MessageLimitHandler:
     """
     A class for handling message limits for GPTBot.
+    Limits apply per chat and, optionally, per user within a chat; how messages are counted is decided by the rate limiter.
+    Limits and counters are kept in the shared state, so several workers enforce them together.
     """
-    def __init__(self):
-        self.sent_messages = {}
-        self.reset_times = {}
-        self.message_limits = {}
-        self.reset_interval = 24 * 60 * 60  # 24 hours in seconds
+    def __init__(self, storage: Storage = None, rate_limiter: RateLimiter = None, shared_state: SharedState = None, reservation_ttl=3 * 60):
+        self.shared_state = shared_state or LocalSharedState(storage)
+        self.rate_limiter = rate_limiter or create_rate_limiter("token_bucket", 24 * 60 * 60)  # 24 hours in seconds
+        self.message_limits = self.shared_state.dict("message_limit.message_limits")
+        self.user_message_limits = self.shared_state.dict("message_limit.user_message_limits")  # chat_id -> limit for each user
+        # chat_id or "chat_id:user_id" -> limiter state; kept per algorithm, so switching algorithms starts counting afresh
+        self.limit_states = self.shared_state.dict(f"message_limit.limit_states.{self.rate_limiter.name}")
+        # chat_id or "chat_id:user_id" -> {reservation id: expiry time} of the slots claimed by requests in flight;
+        # like budget reservations, they stop counting after `reservation_ttl` seconds
+        self.reserved_messages = self.shared_state.dict("message_limit.reserved_messages", persistent=False)
+        self.reservation_ttl = reservation_ttl
+
+    def lock(self, chat_id):
+        # Makes checking, reserving and registering the messages of a chat and its users atomic
+        return self.shared_state.lock(f"message_limit:{chat_id}")
 
     def set_limit(self, chat_id, limit):
         self.message_limits[chat_id] = limit
 
+    def set_user_limit(self, chat_id, limit):
+        self.user_message_limits[chat_id] = limit
+
     def _remove_key(self, dictionary, key):
         if key in dictionary:
             del dictionary[key]
 
     def remove_limit(self, chat_id):
         self._remove_key(self.message_limits, chat_id)
-        self._remove_key(self.sent_messages, chat_id)
-        self._remove_key(self.reset_times, chat_id)
+        self._remove_key(self.limit_states, chat_id)
+
+    def remove_user_limit(self, chat_id):
+        self._remove_key(self.user_message_limits, chat_id)
+        user_key_prefix = f"{chat_id}:"
+        for key in [key for key in self.limit_states if isinstance(key, str) and key.startswith(user_key_prefix)]:
+            del self.limit_states[key]
 
     def get_limit(self, chat_id):
         return self.message_limits.get(chat_id, None)
-    
-    def has_limit(self, chat_id):
-        return chat_id in self.message_limits
-
-    def register_message(self, chat_id):
-        if not self.has_limit(chat_id):
-            return
-        
-        current_time = time.time()
 
-        if chat_id not in self.sent_messages:
-            self.sent_messages[chat_id] = 0
+    def get_user_limit(self, chat_id):
+        return self.user_message_limits.get(chat_id, None)
 
-        if chat_id not in self.reset_times:
-            self.reset_times[chat_id] = current_time
-
-        # Check if the reset interval has passed and reset the sent messages and reset times if needed
-        if current_time - self.reset_times[chat_id] > self.reset_interval:
-            self.sent_messages[chat_id] = 0
-            self.reset_times[chat_id] = current_time
+    def has_limit(self, chat_id):
+        return chat_id in self.message_limits
 
-        # Increment the sent message count for this chat
-        self.sent_messages[chat_id] += 1
+    def _user_key(self, chat_id, user_id):
+        return f"{chat_id}:{user_id}"
 
-    def is_within_message_limit(self, chat_id):
-        if chat_id not in self.message_limits:
-            return True
+    def _scopes(self, chat_id, user_id=None):
+        # (state key, limit) of every limit the message counts towards
+        scopes = []
+        if chat_id in self.message_limits:
+            scopes.append((chat_id, self.message_limits[chat_id]))
+        if user_id is not None and chat_id in self.user_message_limits:
+            scopes.append((self._user_key(chat_id, user_id), self.user_message_limits[chat_id]))
+        return scopes
 
-        messages_sent = self.sent_messages.get(chat_id, 0)
-        return messages_sent < self.message_limits[chat_id]
+    def get_reset_time(self, chat_id):
+        return self.rate_limiter.window_start(self.limit_states.get(chat_id), time.time())
 
-    def get_remaining_messages(self, chat_id):
-        messages_sent = self.sent_messages.get(chat_id, 0)
-        limit = self.message_limits.get(chat_id)
+    def register_message(self, chat_id, user_id=None):
+        with self.lock(chat_id):
+            self._register_message(chat_id, user_id)
 
-        if limit is not None:
-            return max(limit - messages_sent, 0)
+    def _register_message(self, chat_id, user_id=None):
+        current_time = time.time()
+        for key, limit in self._scopes(chat_id, user_id):
+            # Reassign the (possibly mutated) state so that the change reaches the storage
+            self.limit_states[key] = self.rate_limiter.register(self.limit_states.get(key), limit, current_time)
+
+    def reserve(self, chat_id, user_id=None):
+        """
+        Claims a message slot in every limit the message counts towards, before the request is sent.
+        Returns None when a limit has no slot left besides those claimed by other requests in flight.
+        """
+        reservation = MessageReservation(chat_id, user_id, uuid.uuid4().hex)
+        with self.lock(chat_id):
+            current_time = time.time()
+            scopes = self._scopes(chat_id, user_id)
+            for key, limit in scopes:
+                remaining = self.rate_limiter.remaining(self.limit_states.get(key), limit, current_time)
+                if remaining <= len(self._get_reservations(key)):
+                    return None
+            for key, _ in scopes:
+                reservations = self._get_reservations(key)
+                reservations[reservation.reservation_id] = current_time + self.reservation_ttl
+                self.reserved_messages[key] = reservations
+        return reservation
+
+    def commit(self, reservation: MessageReservation):
+        """
+        Counts the message of a reservation once its request has completed.
+        """
+        with self.lock(reservation.chat_id):
+            self._release(reservation)
+            self._register_message(reservation.chat_id, reservation.user_id)
+
+    def release(self, reservation: MessageReservation):
+        with self.lock(reservation.chat_id):
+            self._release(reservation)
+
+    def _release(self, reservation: MessageReservation):
+        # Expired reservations of the same limits are dropped too
+        for key, _ in self._scopes(reservation.chat_id, reservation.user_id):
+            reservations = self._get_reservations(key)
+            reservations.pop(reservation.reservation_id, None)
+            if reservations:
+                self.reserved_messages[key] = reservations
+            else:
+                self.reserved_messages.pop(key, None)
+
+    def _get_reservations(self, key):
+        # The reservations of a limit that have not expired
+        current_time = time.time()
+        return {reservation_id: expiry for reservation_id, expiry in self.reserved_messages.get(key, {}).items() if expiry > current_time}
 
-        return float("inf")
-    
-    def can_send_message(self, chat_id):
-        if not self.has_limit(chat_id):
-            return True
+    def is_within_message_limit(self, chat_id, user_id=None):
+        current_time = time.time()
+        return all(self.rate_limiter.is_allowed(self.limit_states.get(key), limit, current_time)
+                   for key, limit in self._scopes(chat_id, user_id))
 
-        if self.is_within_message_limit(chat_id):
-            return True
+    def get_remaining_messages(self, chat_id, user_id=None):
+        # What is left of the daily limit; a token bucket may let only part of it through at once
+        current_time = time.time()
+        remaining = [self.rate_limiter.remaining_in_window(self.limit_states.get(key), limit, current_time)
+                     for key, limit in self._scopes(chat_id, user_id)]
+        return min(remaining) if remaining else float("inf")
 
-        return False
\ No newline at end of file
+    def can_send_message(self, chat_id, user_id=None):
+        return self.is_within_message_limit(chat_id, user_id)
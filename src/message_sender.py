@@ -0,0 +1,305 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter, BadRequest, NetworkError
+
+from rate_limiters import TokenBucketLimiter
+from metrics import RETRY_AFTER
+from tracing import Trace, current_trace, use_trace, record_stage
+
+# Lower values are sent first when several chats are ready
+Priorities = namedtuple("Priorities", ["ANSWER", "NORMAL", "NOTIFICATION"])
+PRIORITY = Priorities(ANSWER=0, NORMAL=1, NOTIFICATION=2)
+
+class OutboundMessage:
+    """
+    A class for a Bot API call waiting to be sent, with the future its result is delivered to.
+    """
+    def __init__(self, chat_id: int, method, kwargs: dict, priority: int, sequence: int):
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.sequence = sequence  # Keeps messages of the same priority first in, first out
+        self.attempts = 0
+        self.future = Future()
+        self.trace: Trace = current_trace.get()  # Trace of the update the message answers, if any
+
+class ChatQueue:
+    """
+    A class for the messages waiting for one chat and that chat's rate limit state.
+    """
+    def __init__(self):
+        self.messages = deque()
+        self.busy = False  # A message to this chat is being sent; the next one waits, so order is kept
+        self.not_before = 0.0  # Monotonic time before which nothing is sent, e.g. after a RetryAfter
+        self.limiter_state = None
+
+class MessageSender:
+    """
+    A class for sending every outgoing Telegram message through one rate-aware queue.
+    Sends stay within Telegram's limits: `messages_per_second` overall, one message per second in a private chat
+    and `group_messages_per_minute` in a group. Messages to a chat are sent one at a time in order; among chats
+    that may send, answers go before other messages and notifications last.
+    A RetryAfter pauses the chat and sends the message once the wait is over. Network errors are retried with
+    backoff while the retry budget lasts: it grows by `retry_budget_ratio` with every successful send, so a
+    failing Bot API gets a bounded amount of extra traffic.
+    Send methods return a future for the Bot API result and never block the caller.
+    """
+    def __init__(self, bot: Bot, messages_per_second=30, group_messages_per_minute=20, group_burst=3, max_workers=8,
+                 max_retries=3, retry_budget_ratio=0.1, max_retry_budget=20):
+        self.bot = bot
+        self.messages_per_second = messages_per_second
+        self.group_messages_per_minute = group_messages_per_minute
+        self.global_limiter = TokenBucketLimiter(window=1)
+        self.private_chat_limiter = TokenBucketLimiter(window=1)
+        self.group_chat_limiter = TokenBucketLimiter(window=60, burst=group_burst)
+        self.max_retries = max_retries
+        self.retry_budget_ratio = retry_budget_ratio
+        self.max_retry_budget = max_retry_budget
+
+        self.condition = threading.Condition()  # Guards everything below
+        self.chats = {}  # chat_id -> ChatQueue, only while the chat has messages or is rate limited
+        self.global_limiter_state = None
+        self.sequence = 0
+        self.pending = 0  # Messages queued or being sent
+        self.retry_budget = max_retry_budget
+        self.stopped = False
+        self.stats = {
+            "queued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "retries_denied": 0,
+            "flood_waits": 0,
+        }
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="message-sender")
+        self.scheduler_thread = threading.Thread(target=self._run, name="message-sender-scheduler", daemon=True)
+        self.scheduler_thread.start()
+
+    def send_message(self, chat_id: int, text: str, priority=PRIORITY.NORMAL, **kwargs) -> Future:
+        return self.submit(self.bot.send_message, priority, chat_id=chat_id, text=text, **kwargs)
+
+    def reply_to(self, message: Message, text: str, priority=PRIORITY.NORMAL, **kwargs) -> Future:
+        return self.send_message(
+            message.chat_id, text, priority, reply_to_message_id=message.message_id, allow_sending_without_reply=True, **kwargs)
+
+    def submit(self, method, priority=PRIORITY.NORMAL, **kwargs) -> Future:
+        """
+        Queues a Bot API call, e.g. `bot.send_document`, and returns a future for its result.
+        The call's keyword arguments must include the `chat_id` it sends to.
+        """
+        with self.condition:
+            outbound = self._enqueue(method, priority, kwargs)
+            self.condition.notify_all()
+        return outbound.future
+
+    def send_batch(self, calls, priority=PRIORITY.NORMAL) -> Future:
+        """
+        Queues Bot API calls given as (method, kwargs) pairs, e.g. the parts of a long answer, to be sent in order.
+        The future resolves to the list of their results, or to the first error once all of them are done.
+        """
+        batch_future = Future()
+        with self.condition:
+            futures = [self._enqueue(method, priority, kwargs).future for method, kwargs in calls]
+            self.condition.notify_all()
+        if not futures:
+            batch_future.set_result([])
+            return batch_future
+
+        remaining = [len(futures)]
+        remaining_lock = threading.Lock()
+
+        def on_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [future.exception() for future in futures if future.exception()]
+            if errors:
+                batch_future.set_exception(errors[0])
+            else:
+                batch_future.set_result([future.result() for future in futures])
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return batch_future
+
+    def defer_chat(self, chat_id: int, seconds: float):
+        """
+        Holds back messages to a chat, e.g. after a RetryAfter raised by a call made outside the sender.
+        """
+        with self.condition:
+            chat = self._get_chat(chat_id)
+            chat.not_before = max(chat.not_before, time.monotonic() + seconds)
+
+    def get_chat_delay(self, chat_id: int) -> float:
+        """
+        Returns the seconds the chat is paused for by Telegram's flood control.
+        """
+        with self.condition:
+            chat = self.chats.get(chat_id)
+            return max(chat.not_before - time.monotonic(), 0) if chat else 0
+
+    def is_chat_ready(self, chat_id: int) -> bool:
+        """
+        Returns whether a message to the chat would be sent right away: nothing is queued for it and its limits allow a send.
+        Optional messages, e.g. intermediate edits of a streamed answer, are only worth sending then.
+        """
+        with self.condition:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                return True
+            now = time.monotonic()
+            limiter, limit = self._chat_limiter(chat_id)
+            return not chat.messages and not chat.busy and chat.not_before <= now and limiter.wait_time(chat.limiter_state, limit, now) <= 0
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            stats = dict(self.stats)
+            stats["pending"] = self.pending
+            stats["retry_budget"] = self.retry_budget
+        return stats
+
+    def stop(self, timeout=10):
+        """
+        Stops accepting work once the queued messages are sent, waiting at most `timeout` seconds for them.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.pending and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            if self.pending:
+                logging.warning(f"Stopping the message sender with {self.pending} messages not sent")
+            self.stopped = True
+            self.condition.notify_all()
+        self.scheduler_thread.join(timeout=1)
+        self.executor.shutdown(wait=False)
+
+    def _enqueue(self, method, priority, kwargs: dict) -> OutboundMessage:
+        chat_id = kwargs["chat_id"]
+        self.sequence += 1
+        outbound = OutboundMessage(chat_id, method, kwargs, priority, self.sequence)
+        self._get_chat(chat_id).messages.append(outbound)
+        self.pending += 1
+        self.stats["queued"] += 1
+        return outbound
+
+    def _get_chat(self, chat_id: int) -> ChatQueue:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatQueue()
+        return chat
+
+    def _chat_limiter(self, chat_id: int):
+        # Group ids are negative
+        if chat_id < 0:
+            return self.group_chat_limiter, self.group_messages_per_minute
+        return self.private_chat_limiter, 1
+
+    def _run(self):
+        with self.condition:
+            while not self.stopped:
+                self.condition.wait(self._dispatch_ready_messages())
+
+    def _dispatch_ready_messages(self):
+        """
+        Starts sending every message that the rate limits allow; returns the seconds until the next one may go.
+        """
+        while True:
+            now = time.monotonic()
+            next_wait = None
+            best_chat = None
+            for chat_id, chat in list(self.chats.items()):
+                limiter, limit = self._chat_limiter(chat_id)
+                chat_wait = max(chat.not_before - now, limiter.wait_time(chat.limiter_state, limit, now))
+                if not chat.messages:
+                    if not chat.busy and chat_wait <= 0:
+                        del self.chats[chat_id]
+                    continue
+                if chat.busy:
+                    continue
+                if chat_wait > 0:
+                    next_wait = chat_wait if next_wait is None else min(next_wait, chat_wait)
+                    continue
+                head = chat.messages[0]
+                if best_chat is None or (head.priority, head.sequence) < (best_chat.messages[0].priority, best_chat.messages[0].sequence):
+                    best_chat = chat
+            if best_chat is None:
+                return next_wait
+
+            global_wait = self.global_limiter.wait_time(self.global_limiter_state, self.messages_per_second, now)
+            if global_wait > 0:
+                return global_wait if next_wait is None else min(next_wait, global_wait)
+
+            outbound = best_chat.messages.popleft()
+            limiter, limit = self._chat_limiter(outbound.chat_id)
+            best_chat.limiter_state = limiter.register(best_chat.limiter_state, limit, now)
+            self.global_limiter_state = self.global_limiter.register(self.global_limiter_state, self.messages_per_second, now)
+            best_chat.busy = True
+            self.executor.submit(self._deliver, best_chat, outbound)
+
+    def _deliver(self, chat: ChatQueue, outbound: OutboundMessage):
+        # Log lines and the callbacks of the message's future belong to the update it answers
+        with use_trace(outbound.trace):
+            self._deliver_traced(chat, outbound)
+
+    def _deliver_traced(self, chat: ChatQueue, outbound: OutboundMessage):
+        result, error = None, None
+        start_time = time.monotonic()
+        try:
+            result = outbound.method(**outbound.kwargs)
+        except RetryAfter as e:
+            logging.warning(f"RetryAfter error, waiting {e.retry_after} seconds before sending to chat {outbound.chat_id}")
+            RETRY_AFTER.inc("message_sender")
+            with self.condition:
+                chat.not_before = time.monotonic() + e.retry_after
+                self._requeue(chat, outbound, "flood_waits")
+            return
+        except BadRequest as e:
+            error = e
+        except NetworkError as e:
+            with self.condition:
+                if outbound.attempts < self.max_retries and self.retry_budget >= 1:
+                    self.retry_budget -= 1
+                    outbound.attempts += 1
+                    delay = 2 ** outbound.attempts
+                    logging.warning(f"Failed to send to chat {outbound.chat_id} ({e}), retry {outbound.attempts} in {delay} seconds")
+                    chat.not_before = time.monotonic() + delay
+                    self._requeue(chat, outbound, "retries")
+                    return
+                if outbound.attempts < self.max_retries:
+                    self.stats["retries_denied"] += 1
+            error = e
+        except Exception as e:
+            error = e
+        finally:
+            record_stage("telegram_send", start_time, outbound.trace)
+
+        with self.condition:
+            chat.busy = False
+            self.pending -= 1
+            if error is None:
+                self.stats["sent"] += 1
+                self.retry_budget = min(self.retry_budget + self.retry_budget_ratio, self.max_retry_budget)
+            else:
+                self.stats["failed"] += 1
+            self.condition.notify_all()
+
+        if error is None:
+            outbound.future.set_result(result)
+        else:
+            logging.warning(f"Failed to send to chat {outbound.chat_id}: {error}")
+            outbound.future.set_exception(error)
+
+    def _requeue(self, chat: ChatQueue, outbound: OutboundMessage, stat: str):
+        # Put the message back in front, so it still goes before everything queued after it
+        chat.messages.appendleft(outbound)
+        chat.busy = False
+        self.stats[stat] += 1
+        self.condition.notify_all()
@@ -0,0 +1,244 @@
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MetricsConfig = namedtuple("MetricsConfig", [
+    "listen",  # Local address the metrics endpoint binds to; keep it off the public network
+    "port",
+    "path",
+], defaults=["127.0.0.1", 9090, "/metrics"])
+
+# Seconds; spans cache hits and admin checks (milliseconds) as well as long completions (minutes)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Metric:
+    """
+    A base class for a metric with a fixed list of label names; values are kept per tuple of label values.
+    Updates take one short lock, so metrics are cheap enough to stay on in production.
+    """
+    type_name = None
+
+    def __init__(self, name: str, description: str, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+
+    def samples(self):
+        """
+        Returns (name suffix, label values, value) for every sample of the metric.
+        """
+        with self.lock:
+            return [("", labels, value) for labels, value in self.values.items()]
+
+    def snapshot(self) -> dict:
+        return {labels: value for _, labels, value in self.samples()}
+
+class Counter(Metric):
+    """
+    A class for a value that only goes up, e.g. tokens used.
+    """
+    type_name = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    """
+    A class for a value that goes up and down. A gauge given a function reads it when scraped instead,
+    which suits values the bot already tracks, e.g. requests in flight.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name: str, description: str, label_names=()):
+        super().__init__(name, description, label_names)
+        self.function = None
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            return [("", (), self.function())]
+        return super().samples()
+
+class Histogram(Metric):
+    """
+    A class for the distribution of observed values, e.g. stage durations, in cumulative buckets.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                # Counts per bucket (the last one is +Inf), sum of values
+                state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *label_values)
+
+    def samples(self):
+        with self.lock:
+            states = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        samples = []
+        for labels, counts, total in states:
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(("_bucket", labels + (format_value(upper_bound),), cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {labels: {"count": sum(counts), "sum": total} for labels, (counts, total) in self.values.items()}
+
+class MetricsRegistry:
+    """
+    A class for the bot's metrics, rendered in the Prometheus text exposition format.
+    """
+    def __init__(self):
+        self.metrics = {}  # name -> Metric
+        self.lock = threading.Lock()
+
+    def counter(self, name: str, description: str, label_names=()) -> Counter:
+        return self._register(Counter(name, description, label_names))
+
+    def gauge(self, name: str, description: str, label_names=()) -> Gauge:
+        return self._register(Gauge(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, label_names, buckets))
+
+    def _register(self, metric: Metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Metric:
+        return self.metrics[name]
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current values of all metrics, keyed by metric name and then by label values.
+        """
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for suffix, label_values, value in metric.samples():
+                label_names = metric.label_names + (("le",) if suffix == "_bucket" else ())
+                labels = ",".join(f'{label_name}="{escape_label(label_value)}"' for label_name, label_value in zip(label_names, label_values))
+                lines.append(f"{metric.name}{suffix}{{{labels}}} {format_value(value)}" if labels else f"{metric.name}{suffix} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsServer:
+    """
+    A class for serving a metrics registry over HTTP for Prometheus to scrape.
+    """
+    def __init__(self, registry: MetricsRegistry, config: MetricsConfig):
+        self.registry = registry
+        self.config = config
+        self.httpd = ThreadingHTTPServer((config.listen, config.port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+        self.server_thread: threading.Thread = None
+
+    @property
+    def server_address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+        self.server_thread.start()
+        logging.info(f"Metrics endpoint listening on {self.server_address[0]}:{self.server_address[1]}{self.config.path}")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.server_thread:
+            self.server_thread.join()
+
+    def _make_request_handler(self):
+        server = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != server.config.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = server.registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Metrics request: {format % args}")
+
+        return MetricsRequestHandler
+
+# The bot's metrics; every component updates them directly
+registry = MetricsRegistry()
+STAGE_SECONDS = registry.histogram(
+    "akgpt_stage_seconds", "Seconds spent in each stage of handling an update", ["stage"])
+TOKENS = registry.counter(
+    "akgpt_tokens_total", "Tokens used by GPT requests", ["model", "type"])
+USD_SPENT = registry.counter(
+    "akgpt_usd_spent_total", "USD spent on GPT requests per chat", ["chat_id"])
+RESPONSE_CACHE_LOOKUPS = registry.counter(
+    "akgpt_response_cache_lookups_total", "Response cache lookups by result", ["result"])
+RETRY_AFTER = registry.counter(
+    "akgpt_retry_after_total", "Telegram RetryAfter errors by where they were raised", ["source"])
+REJECTED_REQUESTS = registry.counter(
+    "akgpt_rejected_requests_total", "GPT requests refused by reason", ["reason"])
+GPT_REQUESTS_IN_FLIGHT = registry.gauge(
+    "akgpt_gpt_requests_in_flight", "Upstream GPT calls in progress")
+TYPING_CHATS = registry.gauge(
+    "akgpt_typing_chats", "Chats the typing indicator is kept alive for")
@@ -0,0 +1,46 @@
+from collections import namedtuple
+
+# USD per 1000 tokens
+ModelPrice = namedtuple("ModelPrice", ["prompt", "completion"])
+
+MODEL_PRICES = {
+    "gpt-3.5-turbo": ModelPrice(prompt=0.0015, completion=0.002),
+    "gpt-3.5-turbo-16k": ModelPrice(prompt=0.003, completion=0.004),
+    "gpt-4": ModelPrice(prompt=0.03, completion=0.06),
+    "gpt-4-32k": ModelPrice(prompt=0.06, completion=0.12),
+}
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+AUTO_MODEL = "auto"  # Chat setting that lets the ModelRouter pick the model per request
+
+def get_price(model: str) -> ModelPrice:
+    return MODEL_PRICES.get(model, MODEL_PRICES[DEFAULT_MODEL])
+
+def calculate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    price = get_price(model)
+    return (prompt_tokens * price.prompt + completion_tokens * price.completion) / 1000
+
+class ModelRouter:
+    """
+    A class for choosing the model of chats set to automatic selection.
+    Short questions go to the cheap, fast model; longer ones are upgraded while the chat can afford
+    the upgraded model's worst-case cost with room to spare.
+    """
+    def __init__(self, cheap_model=DEFAULT_MODEL, upgraded_model="gpt-4", short_question_tokens=150, budget_headroom=5):
+        self.cheap_model = cheap_model
+        self.upgraded_model = upgraded_model
+        self.short_question_tokens = short_question_tokens
+        self.budget_headroom = budget_headroom  # Required multiple of the upgraded request cost left in the budget
+
+    def select_model(self, chat_model, question_tokens: int, prompt_tokens: int, max_completion_tokens: int, remaining_usd: float) -> str:
+        if chat_model and chat_model != AUTO_MODEL:
+            return chat_model
+        if chat_model is None:
+            return DEFAULT_MODEL
+
+        if question_tokens <= self.short_question_tokens:
+            return self.cheap_model
+        upgraded_cost = calculate_cost(self.upgraded_model, prompt_tokens, max_completion_tokens)
+        if remaining_usd >= upgraded_cost * self.budget_headroom:
+            return self.upgraded_model
+        return self.cheap_model
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+
+import openai
+
+# Errors worth another attempt: the upstream is overloaded, unreachable or failing on its side
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    asyncio.TimeoutError,
+)
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the upstream while the circuit breaker is open.
+    """
+
+class CircuitBreaker:
+    """
+    A class for failing fast while the upstream is degraded.
+    After `failure_threshold` consecutive failures the circuit opens and requests are refused for `reset_timeout`
+    seconds; then a single probe request is let through, which closes the circuit again if it succeeds.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+        return self.state != self.OPEN
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info("Upstream recovered, closing the circuit breaker")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+
+    def record_abandoned(self):
+        """
+        Records an attempt that ended without an answer either way, e.g. because it was cancelled.
+        It says nothing about the upstream, but a probe has to make way for the next one.
+        """
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.warning(f"Opening the circuit breaker for {self.reset_timeout} seconds after {self.consecutive_failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+class OpenAIClient:
+    """
+    A class for calling the OpenAI chat completion API with bounded concurrency and retries.
+    Concurrent calls are capped globally and per chat, failed attempts are retried with exponential backoff
+    and full jitter (waiting at least as long as a Retry-After header asks), every attempt has a timeout,
+    and a circuit breaker fails fast while the upstream keeps failing.
+    All methods must be used on one event loop. `api_base` points the client at another server, e.g. a local fake.
+    """
+    def __init__(self, max_concurrency=8, max_per_chat=2, max_retries=3, backoff_base=1.0, backoff_max=30.0,
+                 attempt_timeout=60, circuit_breaker: CircuitBreaker = None, api_base=None):
+        self.max_concurrency = max_concurrency
+        self.max_per_chat = max_per_chat
+        self.max_retries = max_retries  # Attempts after the first one
+        self.backoff_base = backoff_base  # Seconds
+        self.backoff_max = backoff_max
+        self.attempt_timeout = attempt_timeout  # Seconds until the response (or the first streamed chunk) arrives
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.api_base = api_base
+
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.chat_semaphores = {}  # chat_id -> [semaphore, number of requests using it]
+        self.retries = 0
+
+    @asynccontextmanager
+    async def slot(self, chat_id=None):
+        """
+        Holds a chat slot and then a global slot for the duration of a request, including reading a stream.
+        """
+        if chat_id is None:
+            async with self.semaphore:
+                yield
+            return
+
+        chat_semaphore = self.chat_semaphores.setdefault(chat_id, [asyncio.Semaphore(self.max_per_chat), 0])
+        chat_semaphore[1] += 1
+        try:
+            async with chat_semaphore[0], self.semaphore:
+                yield
+        finally:
+            chat_semaphore[1] -= 1
+            if not chat_semaphore[1]:
+                del self.chat_semaphores[chat_id]
+
+    async def create_chat_completion(self, **request_kwargs):
+        """
+        Returns the chat completion response, or the chunk iterator when `stream=True`.
+        Only opening a stream is retried, since chunks already delivered cannot be taken back.
+        """
+        if self.api_base:
+            request_kwargs.setdefault("api_base", self.api_base)
+
+        attempt = 0
+        while True:
+            if not self.circuit_breaker.allow_request():
+                raise CircuitOpenError("The OpenAI API is failing, not sending requests for now")
+            try:
+                response = await asyncio.wait_for(openai.ChatCompletion.acreate(**request_kwargs), self.attempt_timeout)
+            except RETRYABLE_ERRORS as e:
+                self.circuit_breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.get_backoff_delay(attempt, e)
+                attempt += 1
+                self.retries += 1
+                logging.warning(f"OpenAI request failed ({type(e).__name__}: {e}), retry {attempt} of {self.max_retries} in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
+                continue
+            except openai.error.OpenAIError:
+                # The request itself was rejected, which says nothing about the upstream's health
+                self.circuit_breaker.record_success()
+                raise
+            except BaseException:
+                # Cancelled, e.g. by the engine's request timeout, or an unexpected error; without this
+                # a half-open probe would stay in flight and the circuit would never close again
+                self.circuit_breaker.record_abandoned()
+                raise
+            self.circuit_breaker.record_success()
+            return response
+
+    def get_backoff_delay(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = self.get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def get_retry_after(self, error: Exception):
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("retry-after") or headers.get("Retry-After")
+        try:
+            return float(retry_after) if retry_after is not None else None
+        except ValueError:
+            return None
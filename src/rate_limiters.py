@@ -0,0 +1,219 @@
+import math
+from abc import ABC, abstractmethod
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+class RateLimiter(ABC):
+    """
+    A base class for message rate limiting algorithms.
+    Limiters hold no per-chat data themselves: the state of every limited chat or user is a JSON-serializable
+    value owned by the caller (so it can be persisted), which `register` updates and returns.
+    States of different algorithms are not interchangeable; `name` tells them apart.
+    """
+    name = None
+    def is_allowed(self, state, limit: int, now: float) -> bool:
+        return self.remaining(state, limit, now) > 0
+
+    @abstractmethod
+    def remaining(self, state, limit: int, now: float) -> int:
+        pass
+
+    def remaining_in_window(self, state, limit: int, now: float) -> int:
+        """
+        Returns how many more messages the limit allows over the whole window, whether or not they may be sent at once.
+        """
+        return self.remaining(state, limit, now)
+
+    @abstractmethod
+    def register(self, state, limit: int, now: float):
+        pass
+
+    def window_start(self, state, now: float):
+        """
+        Returns the start of the current limit window, or None for algorithms without discrete windows.
+        """
+        return None
+
+class FixedWindowLimiter(RateLimiter):
+    """
+    Counts messages in a window of `interval` seconds that starts with the first message after the previous window ended.
+    State: [window start, message count].
+    """
+    name = "fixed_window"
+
+    def __init__(self, interval=24 * 60 * 60):
+        self.interval = interval
+
+    def _is_current(self, state, now: float) -> bool:
+        return state is not None and now - state[0] <= self.interval
+
+    def remaining(self, state, limit: int, now: float) -> int:
+        messages_sent = state[1] if self._is_current(state, now) else 0
+        return max(limit - messages_sent, 0)
+
+    def register(self, state, limit: int, now: float):
+        if not self._is_current(state, now):
+            state = [now, 0]
+        state[1] += 1
+        return state
+
+    def window_start(self, state, now: float):
+        return state[0] if self._is_current(state, now) else None
+
+class SlidingWindowLimiter(RateLimiter):
+    """
+    Allows at most `limit` messages in any `window` seconds, using a ring buffer of the last `limit` message times.
+    Checking is O(1): a message is allowed when the buffer is not full or its oldest entry has left the window.
+    State: {"head": index of the oldest entry once the buffer is full, "times": message times}.
+    """
+    name = "sliding_window"
+
+    def __init__(self, window=24 * 60 * 60):
+        self.window = window
+
+    def _resize(self, state, limit: int):
+        times = state["times"]
+        head = state["head"]
+        if len(times) == limit or (head == 0 and len(times) < limit):
+            # The buffer fits the limit, whether or not it has wrapped around
+            return state
+        # The limit changed: keep the most recent entries in chronological order, starting again at index 0
+        ordered_times = times[head:] + times[:head]
+        return {"head": 0, "times": ordered_times[-limit:] if limit else []}
+
+    def is_allowed(self, state, limit: int, now: float) -> bool:
+        if state is None:
+            return limit > 0
+        state = self._resize(state, limit)
+        times = state["times"]
+        return len(times) < limit or times[state["head"]] <= now - self.window
+
+    def remaining(self, state, limit: int, now: float) -> int:
+        if state is None:
+            return limit
+        state = self._resize(state, limit)
+        times, head = state["times"], state["head"]
+
+        # Entries are sorted starting at head, so binary search for the first one still inside the window
+        low, high = 0, len(times)
+        while low < high:
+            middle = (low + high) // 2
+            if times[(head + middle) % len(times)] <= now - self.window:
+                low = middle + 1
+            else:
+                high = middle
+        return max(limit - (len(times) - low), 0)
+
+    def register(self, state, limit: int, now: float):
+        state = self._resize(state, limit) if state is not None else {"head": 0, "times": []}
+        times = state["times"]
+        if len(times) < limit:
+            times.append(now)
+        elif limit:
+            times[state["head"]] = now
+            state["head"] = (state["head"] + 1) % limit
+        return state
+
+class TokenBucketLimiter(RateLimiter):
+    """
+    Refills `limit` messages per `window` seconds evenly, holding at most `burst` messages at once,
+    or `burst_share` of the limit (the full limit by default), implemented as GCRA.
+    State: the theoretical arrival time of the next message.
+    """
+    name = "token_bucket"
+
+    def __init__(self, window=24 * 60 * 60, burst=None, burst_share=None):
+        self.window = window
+        self.burst = burst
+        self.burst_share = burst_share
+
+    def _parameters(self, limit: int):
+        emission_interval = self.window / limit
+        burst = self.burst or (max(math.ceil(limit * self.burst_share), 1) if self.burst_share else limit)
+        burst = min(burst, limit)
+        return emission_interval, (burst - 1) * emission_interval, burst
+
+    def is_allowed(self, state, limit: int, now: float) -> bool:
+        if limit <= 0:
+            return False
+        _, tolerance, _ = self._parameters(limit)
+        return state is None or state - now <= tolerance
+
+    def remaining(self, state, limit: int, now: float) -> int:
+        if limit <= 0:
+            return 0
+        emission_interval, tolerance, burst = self._parameters(limit)
+        backlog = max(state - now, 0) if state is not None else 0
+        if backlog > tolerance:
+            return 0
+        return min(math.floor((tolerance - backlog) / emission_interval) + 1, burst)
+
+    def remaining_in_window(self, state, limit: int, now: float) -> int:
+        if limit <= 0:
+            return 0
+        emission_interval, _, _ = self._parameters(limit)
+        # Every message still in the backlog was sent within the last window
+        backlog = max(state - now, 0) if state is not None else 0
+        return max(limit - math.ceil(backlog / emission_interval), 0)
+
+    def register(self, state, limit: int, now: float):
+        if limit <= 0:
+            return state
+        emission_interval, _, _ = self._parameters(limit)
+        return max(state if state is not None else now, now) + emission_interval
+
+    def wait_time(self, state, limit: int, now: float) -> float:
+        """
+        Returns the seconds until the next message is allowed.
+        """
+        if state is None:
+            return 0
+        _, tolerance, _ = self._parameters(limit)
+        return max(state - tolerance - now, 0)
+
+class CalendarDayLimiter(RateLimiter):
+    """
+    Counts messages per calendar day in `timezone`, resetting every day at `reset_hour`.
+    State: [day ordinal, message count].
+    """
+    name = "calendar_day"
+
+    def __init__(self, timezone="UTC", reset_hour=0):
+        self.timezone = ZoneInfo(timezone)
+        self.reset_hour = reset_hour
+
+    def _day(self, now: float) -> int:
+        local_time = datetime.fromtimestamp(now, self.timezone) - timedelta(hours=self.reset_hour)
+        return local_time.date().toordinal()
+
+    def remaining(self, state, limit: int, now: float) -> int:
+        messages_sent = state[1] if state is not None and state[0] == self._day(now) else 0
+        return max(limit - messages_sent, 0)
+
+    def register(self, state, limit: int, now: float):
+        day = self._day(now)
+        if state is None or state[0] != day:
+            state = [day, 0]
+        state[1] += 1
+        return state
+
+    def window_start(self, state, now: float):
+        day = datetime.fromordinal(self._day(now)).date()
+        return datetime.combine(day, time(self.reset_hour), self.timezone).timestamp()
+
+def create_rate_limiter(algorithm: str, window=24 * 60 * 60, timezone="UTC", reset_hour=0) -> RateLimiter:
+    """
+    Returns the limiter for a message limit of the given algorithm over `window` seconds:
+    "token_bucket" refills the limit evenly across the window and lets a chat spend at most a quarter of it at once,
+    "sliding_window" counts messages in the last `window` seconds, "fixed_window" in windows starting with
+    the first message, and "calendar_day" per calendar day in `timezone`, starting at `reset_hour`.
+    """
+    if algorithm == TokenBucketLimiter.name:
+        return TokenBucketLimiter(window, burst_share=0.25)
+    if algorithm == SlidingWindowLimiter.name:
+        return SlidingWindowLimiter(window)
+    if algorithm == FixedWindowLimiter.name:
+        return FixedWindowLimiter(window)
+    if algorithm == CalendarDayLimiter.name:
+        return CalendarDayLimiter(timezone, reset_hour)
+    raise ValueError(f"Unknown message limit algorithm: {algorithm}")
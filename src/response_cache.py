@@ -0,0 +1,91 @@
+import hashlib
+import json
+import re
+import threading
+import time
+
+from storage import Storage
+from ttl_cache import TTLCache
+
+# A leading bot command, e.g. "/gpt" or "/gpt@AKGPTBot"
+COMMAND_PREFIX = re.compile(r"^/\w+(@\w+)?\s*")
+TRAILING_PUNCTUATION = "?!.,;: "
+
+def normalize_question(question: str) -> str:
+    """
+    Returns the question reduced to what decides its answer: no command prefix, case, extra whitespace or trailing punctuation.
+    """
+    question = COMMAND_PREFIX.sub("", question.strip())
+    return " ".join(question.casefold().split()).rstrip(TRAILING_PUNCTUATION)
+
+class ResponseCache:
+    """
+    A class for caching GPT answers to questions that are asked again and again, e.g. FAQ-type prompts in groups.
+    Answers are cached per chat and keyed by the model, the bot description and the normalized question.
+    Recent answers are kept in memory; with a storage they are also written to disk, so they survive restarts
+    and outlive the memory tier's size limit until they expire.
+    """
+    namespace = "response_cache"
+
+    def __init__(self, max_size=1000, ttl=6 * 60 * 60, storage: Storage = None):
+        self.ttl = ttl
+        self.memory = TTLCache(max_size=max_size, ttl=ttl)
+        self.storage = storage
+
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+        }
+
+        if storage:
+            self.purge_expired()
+
+    def make_key(self, chat_id: int, model: str, bot_description: str, question: str) -> str:
+        key_data = json.dumps([chat_id, model, bot_description, normalize_question(question)], ensure_ascii=False)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        answer = self.memory.get(key)
+        if answer is not None:
+            self._count("hits")
+            return answer
+
+        if self.storage:
+            entry = self.storage.get(self.namespace, key)
+            if entry is not None:
+                expires_at, answer = entry
+                time_left = expires_at - time.time()
+                if time_left > 0:
+                    self.memory.set(key, answer, ttl=time_left)
+                    self._count("hits")
+                    self._count("disk_hits")
+                    return answer
+                self.storage.delete(self.namespace, key)
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, answer: str):
+        self.memory.set(key, answer)
+        if self.storage:
+            self.storage.set(self.namespace, key, [time.time() + self.ttl, answer])
+        self._count("stores")
+
+    def purge_expired(self):
+        current_time = time.time()
+        for key, (expires_at, _) in self.storage.load(self.namespace).items():
+            if expires_at <= current_time:
+                self.storage.delete(self.namespace, key)
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["memory_size"] = len(self.memory)
+        return stats
+
+    def _count(self, stat: str):
+        with self.stats_lock:
+            self.stats[stat] += 1
@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from storage import Storage, MemoryStorage
+
+class SharedState(ABC):
+    """
+    A base class for the limits and counters that every bot worker has to agree on.
+    State is grouped into namespaces of JSON-serializable keys and values, like Storage. `lock` serializes
+    read-modify-write sequences across all workers, so checking and updating a chat's budget stays atomic
+    no matter how many workers serve the chat.
+    """
+    @abstractmethod
+    def dict(self, namespace: str, persistent=True) -> MutableMapping:
+        """
+        Returns a dictionary view of the namespace. Non-persistent namespaces, e.g. budget reserved by requests
+        in flight, are shared between workers but need not survive a restart.
+        """
+
+    @abstractmethod
+    def lock(self, name: str):
+        """
+        Returns a context manager that holds the named lock.
+        """
+
+class LocalSharedState(SharedState):
+    """
+    A class for state shared by the threads of a single worker, kept in the bot's storage.
+    It is the default, and a stand-in for RedisSharedState in tests.
+    """
+    def __init__(self, storage: Storage = None, lock_count=64):
+        self.storage = storage or MemoryStorage()
+        self.dicts = {}  # (namespace, persistent) -> dictionary handed out for it, so every user sees the same data
+        self.dicts_lock = threading.Lock()
+        # Names are spread over a fixed set of reentrant locks, so there is no lock per chat to clean up
+        self.locks = [threading.RLock() for _ in range(lock_count)]
+
+    def dict(self, namespace: str, persistent=True) -> MutableMapping:
+        with self.dicts_lock:
+            if (namespace, persistent) not in self.dicts:
+                self.dicts[(namespace, persistent)] = self.storage.dict(namespace) if persistent else {}
+            return self.dicts[(namespace, persistent)]
+
+    def lock(self, name: str):
+        return self.locks[hash(name) % len(self.locks)]
+
+class RedisSharedState(SharedState):
+    """
+    A class for state shared by several workers through a Redis-compatible server.
+    Every namespace is a hash, every access is a round trip, and locks are Redis keys that expire after
+    `lock_timeout` seconds, so a crashed worker cannot block a chat for good. Locks are not reentrant.
+    Non-persistent namespaces expire `volatile_ttl` seconds after their last change, so entries a crashed worker
+    left behind do not outlive it for good either.
+    """
+    # Deletes the lock only if it is still held by the releasing worker
+    RELEASE_LOCK_SCRIPT = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="akgpt_bot", lock_timeout=10, volatile_ttl=15 * 60, client=None):
+        if client is None:
+            if redis is None:
+                raise ImportError("The redis package is required for RedisSharedState")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.volatile_ttl = volatile_ttl
+
+    def dict(self, namespace: str, persistent=True) -> MutableMapping:
+        return RedisDict(self.client, f"{self.prefix}:{namespace}", None if persistent else self.volatile_ttl)
+
+    @contextmanager
+    def lock(self, name: str):
+        lock_key = f"{self.prefix}:lock:{name}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.001
+        while not self.client.set(lock_key, token, nx=True, px=int(self.lock_timeout * 1000)):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not acquire the shared lock {name} in {self.lock_timeout} seconds")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        try:
+            yield
+        finally:
+            self.client.eval(self.RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+class RedisDict(MutableMapping):
+    """
+    A dictionary backed by a Redis hash; keys and values are stored as JSON.
+    With a `ttl`, the whole hash expires that many seconds after its last change.
+    """
+    def __init__(self, client, hash_key: str, ttl=None):
+        self.client = client
+        self.hash_key = hash_key
+        self.ttl = ttl
+
+    def __getitem__(self, key):
+        value = self.client.hget(self.hash_key, json.dumps(key))
+        if value is None:
+            raise KeyError(key)
+        return json.loads(value)
+
+    def get(self, key, default=None):
+        value = self.client.hget(self.hash_key, json.dumps(key))
+        return default if value is None else json.loads(value)
+
+    def __setitem__(self, key, value):
+        if self.ttl is None:
+            self.client.hset(self.hash_key, json.dumps(key), json.dumps(value))
+            return
+        pipeline = self.client.pipeline()
+        pipeline.hset(self.hash_key, json.dumps(key), json.dumps(value))
+        pipeline.pexpire(self.hash_key, int(self.ttl * 1000))
+        pipeline.execute()
+
+    def __delitem__(self, key):
+        if not self.client.hdel(self.hash_key, json.dumps(key)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return bool(self.client.hexists(self.hash_key, json.dumps(key)))
+
+    def __iter__(self):
+        return iter([json.loads(key) for key in self.client.hkeys(self.hash_key)])
+
+    def __len__(self):
+        return self.client.hlen(self.hash_key)
@@ -0,0 +1,192 @@
+import json
+from abc import ABC, abstractmethod
+import logging
+import sqlite3
+import threading
+
+class Storage(ABC):
+    """
+    A base class for the key-value storage backing the bot's limits, counters and settings.
+    Data is grouped into namespaces, one per persisted dictionary; keys and values must be JSON serializable.
+    """
+    @abstractmethod
+    def load(self, namespace: str) -> dict:
+        pass
+
+    def get(self, namespace: str, key, default=None):
+        return self.load(namespace).get(key, default)
+
+    @abstractmethod
+    def set(self, namespace: str, key, value):
+        pass
+
+    @abstractmethod
+    def delete(self, namespace: str, key):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def dict(self, namespace: str) -> "PersistentDict":
+        """
+        Returns a dictionary pre-filled with the namespace contents that writes every change back to this storage.
+        """
+        return PersistentDict(self, namespace, self.load(namespace))
+
+class MemoryStorage(Storage):
+    """
+    A class for storage that lives only as long as the process, e.g. for tests.
+    """
+    def __init__(self):
+        self.namespaces = {}
+        self.lock = threading.Lock()
+
+    def load(self, namespace: str) -> dict:
+        with self.lock:
+            return dict(self.namespaces.get(namespace, {}))
+
+    def get(self, namespace: str, key, default=None):
+        with self.lock:
+            return self.namespaces.get(namespace, {}).get(key, default)
+
+    def set(self, namespace: str, key, value):
+        with self.lock:
+            self.namespaces.setdefault(namespace, {})[key] = value
+
+    def delete(self, namespace: str, key):
+        with self.lock:
+            self.namespaces.get(namespace, {}).pop(key, None)
+
+class SQLiteStorage(Storage):
+    """
+    A class for storage in a local SQLite database.
+    Writes are buffered in memory and flushed in a single transaction every `flush_interval` seconds by a
+    background thread, so updating a counter never waits for the disk. Repeated writes to the same key
+    between flushes are coalesced into one.
+    """
+    _deleted = object()
+    _missing = object()
+
+    def __init__(self, path: str, flush_interval=2.0):
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))")
+        self.connection.commit()
+        self.db_lock = threading.Lock()  # Guards the connection
+
+        self.pending_writes = {}  # (namespace, encoded key) -> value or _deleted
+        self.pending_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_periodically, name="sqlite-storage-flush", daemon=True)
+        self.flush_thread.start()
+
+    def load(self, namespace: str) -> dict:
+        with self.db_lock:
+            rows = self.connection.execute("SELECT key, value FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+        data = {json.loads(key): json.loads(value) for key, value in rows}
+
+        # Apply writes that have not been flushed yet
+        with self.pending_lock:
+            for (pending_namespace, key), value in self.pending_writes.items():
+                if pending_namespace != namespace:
+                    continue
+                if value is self._deleted:
+                    data.pop(json.loads(key), None)
+                else:
+                    data[json.loads(key)] = value
+        return data
+
+    def get(self, namespace: str, key, default=None):
+        encoded_key = json.dumps(key)
+        with self.pending_lock:
+            value = self.pending_writes.get((namespace, encoded_key), self._missing)
+        if value is not self._missing:
+            return default if value is self._deleted else value
+
+        with self.db_lock:
+            row = self.connection.execute("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, encoded_key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace: str, key, value):
+        with self.pending_lock:
+            self.pending_writes[(namespace, json.dumps(key))] = value
+
+    def delete(self, namespace: str, key):
+        with self.pending_lock:
+            self.pending_writes[(namespace, json.dumps(key))] = self._deleted
+
+    def flush(self):
+        with self.pending_lock:
+            pending_writes, self.pending_writes = self.pending_writes, {}
+        if not pending_writes:
+            return
+
+        upserts = [(namespace, key, json.dumps(value)) for (namespace, key), value in pending_writes.items() if value is not self._deleted]
+        deletes = [(namespace, key) for (namespace, key), value in pending_writes.items() if value is self._deleted]
+        try:
+            with self.db_lock, self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)", upserts)
+                self.connection.executemany("DELETE FROM kv WHERE namespace = ? AND key = ?", deletes)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to flush {len(pending_writes)} writes to {self.path}: {e}")
+            # Put the writes back unless they were overwritten in the meantime
+            with self.pending_lock:
+                for pending_key, value in pending_writes.items():
+                    self.pending_writes.setdefault(pending_key, value)
+
+    def _flush_periodically(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stop_event.set()
+        self.flush_thread.join(timeout=self.flush_interval)
+        self.flush()
+        with self.db_lock:
+            self.connection.close()
+
+class PersistentDict(dict):
+    """
+    A dictionary that mirrors every modification into a storage namespace. Reads never touch the storage.
+    """
+    def __init__(self, storage: Storage, namespace: str, data: dict):
+        super().__init__(data)
+        self.storage = storage
+        self.namespace = namespace
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.storage.set(self.namespace, key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.storage.delete(self.namespace, key)
+
+    def pop(self, key, *default):
+        had_key = key in self
+        value = super().pop(key, *default)
+        if had_key:
+            self.storage.delete(self.namespace, key)
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from telegram import Message
+from telegram.error import BadRequest
+
+from message_sender import MessageSender, PRIORITY
+
+MAX_MESSAGE_LENGTH = 4096
+
+class StreamingReply:
+    """
+    A class for progressively editing a placeholder reply while a GPT answer is being streamed.
+    The placeholder and every edit go through the message sender, so they count towards the chat's flood limits
+    and wait out RetryAfter like any other message; nothing here blocks the caller.
+    Edits are coalesced: one at a time, at most one per `min_edit_interval` seconds, and only while the chat has no backlog,
+    until the answer is finished.
+    """
+    def __init__(self, message_sender: MessageSender, message: Message, placeholder_text: str, min_edit_interval: float):
+        self.message_sender = message_sender
+        self.min_edit_interval = min_edit_interval
+        self.placeholder: Message = None  # Set once the placeholder is sent
+
+        self.lock = threading.Lock()  # Guards the state below
+        self.parts = []
+        self.shown_text = placeholder_text
+        self.next_edit_time = 0.0
+        self.edit_in_flight = False
+        self.finished = False
+
+        self.placeholder_future: Future = message_sender.reply_to(message, placeholder_text, PRIORITY.ANSWER)
+        self.placeholder_future.add_done_callback(self._on_placeholder_sent)
+
+    def when_ready(self, callback):
+        """
+        Calls `callback(placeholder)` once the placeholder is sent, with None if it could not be sent.
+        """
+        def on_done(future: Future):
+            callback(None if future.exception() else future.result())
+        self.placeholder_future.add_done_callback(on_done)
+
+    def append(self, delta: str):
+        """
+        Add a piece of streamed text. Safe to call from the GPT request engine loop, never blocks on Telegram.
+        """
+        with self.lock:
+            self.parts.append(delta)
+        self._schedule_edit()
+
+    def finish(self, text: str = None):
+        """
+        Show the final text (the accumulated stream by default) once any pending edit has completed.
+        """
+        with self.lock:
+            self.finished = True
+            if text is not None:
+                self.parts = [text]
+        self._schedule_edit()
+
+    def _on_placeholder_sent(self, future: Future):
+        if future.exception():
+            logging.warning(f"Failed to send the placeholder reply, not streaming the response: {future.exception()}")
+            return
+        with self.lock:
+            self.placeholder = future.result()
+        self._schedule_edit()
+
+    def _schedule_edit(self):
+        with self.lock:
+            if self.placeholder is None or self.edit_in_flight:
+                return
+            if not self.finished and time.monotonic() < self.next_edit_time:
+                # A later delta or the final text picks the change up
+                return
+            if not self.finished and not self.message_sender.is_chat_ready(self.placeholder.chat_id):
+                # Intermediate edits would hold back other messages to the chat; only the final text is sure to be sent
+                return
+            text = "".join(self.parts).strip()[:MAX_MESSAGE_LENGTH]
+            if not text or text == self.shown_text:
+                return
+            self.edit_in_flight = True
+            placeholder = self.placeholder
+
+        edited = self.message_sender.submit(
+            self.message_sender.bot.edit_message_text, PRIORITY.ANSWER,
+            chat_id=placeholder.chat_id, message_id=placeholder.message_id, text=text)
+        edited.add_done_callback(lambda edited: self._on_edited(text, edited))
+
+    def _on_edited(self, text: str, edited: Future):
+        error = edited.exception()
+        if error and not (isinstance(error, BadRequest) and "not modified" in error.message.lower()):
+            logging.error(f"An error occurred while editing the streamed GPT response: {error}")
+        with self.lock:
+            self.edit_in_flight = False
+            # A failed text is not retried as is; the sender already retried it, and newer text replaces it anyway
+            self.shown_text = text
+            self.next_edit_time = time.monotonic() + self.min_edit_interval
+        self._schedule_edit()
@@ -0,0 +1,45 @@
+import logging
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Extra tokens the chat format adds around every message and to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+_encodings = {}  # model -> encoding, or None to count approximately
+
+def load_encodings(models):
+    """
+    Loads the encodings of the models, which may download them. Called once at startup, so counting tokens
+    while handling requests never waits on the network; models loaded here or not at all are counted approximately.
+    """
+    for model in models:
+        if model in _encodings:
+            continue
+        encoding = None
+        if tiktoken is not None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except Exception as e:
+                # Unknown model or the encoding could not be downloaded
+                logging.warning(f"Falling back to approximate token counts for {model}: {e}")
+        _encodings[model] = encoding
+
+def _get_encoding(model: str):
+    return _encodings.get(model)
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # Roughly 4 characters per token for English text
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+def count_message_tokens(messages, model: str = "gpt-3.5-turbo") -> int:
+    """
+    Returns the number of prompt tokens a chat completion request with these messages is billed for.
+    """
+    return sum(TOKENS_PER_MESSAGE + count_tokens(message["content"], model) for message in messages) + TOKENS_PER_REPLY
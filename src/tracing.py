@@ -0,0 +1,223 @@
+import contextvars
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+
+from metrics import STAGE_SECONDS
+
+# One timed step of handling an update, e.g. the OpenAI call; `start` is relative to the start of the trace
+Span = namedtuple("Span", ["name", "start", "duration"])
+
+# The trace of the update being handled. Threads and tasks that work on an update are bound to its trace,
+# so their spans and log lines are attributed to it.
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """
+    A class for the spans recorded while handling one update, identified by a correlation id derived from the update id.
+    A trace ends when the handler returns, or later when work continues elsewhere: `hold` keeps it open
+    until a matching `release`, e.g. until the answer to a GPT request is sent.
+    """
+    def __init__(self, tracer: "Tracer", trace_id: str, chat_id=None, name=None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.chat_id = chat_id
+        self.name = name  # What the update is, e.g. a command
+        self.start_time = time.monotonic()
+        self.duration = None
+        self.spans = []
+        self.lock = threading.Lock()
+        self.holds = 0
+
+    def add_span(self, name: str, start_time: float, duration: float):
+        with self.lock:
+            self.spans.append(Span(name, start_time - self.start_time, duration))
+
+    def hold(self):
+        with self.lock:
+            self.holds += 1
+
+    def release(self):
+        with self.lock:
+            self.holds -= 1
+            if self.holds or self.duration is not None:
+                return
+            self.duration = time.monotonic() - self.start_time
+        self.tracer.finish(self)
+
+    def get_breakdown(self) -> dict:
+        """
+        Returns the seconds spent in each kind of span.
+        """
+        breakdown = Counter()
+        with self.lock:
+            for span in self.spans:
+                breakdown[span.name] += span.duration
+        return dict(breakdown)
+
+class Tracer:
+    """
+    A class for tracing updates through the bot. Traces taking longer than `slow_request_seconds`
+    are logged with a breakdown by stage and kept, the most recent `max_slow_traces` of them.
+    """
+    def __init__(self, slow_request_seconds=10.0, max_slow_traces=100):
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_traces = deque(maxlen=max_slow_traces)
+
+    @contextmanager
+    def trace_update(self, update, name=None):
+        """
+        Runs the block in the update's trace; the trace ends with the block unless it is held.
+        """
+        update_id = getattr(update, "update_id", None)
+        chat = getattr(update, "effective_chat", None)
+        trace = Trace(self, f"u{update_id}" if update_id is not None else f"t{id(update):x}", chat.id if chat else None, name)
+        trace.hold()
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+            trace.release()
+
+    def traced(self, callback, name=None):
+        """
+        Wraps a dispatcher callback `callback(update, context)` in a trace of its update.
+        """
+        @functools.wraps(callback)
+        def traced_callback(update, context, *args, **kwargs):
+            with self.trace_update(update, name or callback.__name__):
+                return callback(update, context, *args, **kwargs)
+        return traced_callback
+
+    def finish(self, trace: Trace):
+        if trace.duration < self.slow_request_seconds:
+            return
+        self.slow_traces.append(trace)
+        breakdown = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in sorted(trace.get_breakdown().items(), key=lambda item: -item[1]))
+        logging.warning(f"Slow {trace.name or 'update'} in chat {trace.chat_id}: {trace.duration:.3f}s ({breakdown or 'no spans'})")
+
+@contextmanager
+def stage(name: str):
+    """
+    Times the block as a stage of handling an update: in the stage latency metric, and as a span of the current trace.
+    """
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(name, start_time)
+
+def record_stage(name: str, start_time: float, trace: "Trace" = None):
+    """
+    Records a stage that started at the monotonic `start_time` and ends now, in the given or the current trace.
+    """
+    duration = time.monotonic() - start_time
+    STAGE_SECONDS.observe(duration, name)
+    trace = trace or current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start_time, duration)
+
+@contextmanager
+def use_trace(trace: Trace):
+    """
+    Runs the block in the given trace, e.g. in a thread that works on requests of several updates.
+    """
+    token = current_trace.set(trace)
+    try:
+        yield
+    finally:
+        current_trace.reset(token)
+
+def bind(function):
+    """
+    Returns a function that runs `function` in the current trace, from whichever thread calls it.
+    """
+    context = contextvars.copy_context()
+    return functools.partial(context.run, function)
+
+def hold_trace():
+    """
+    Keeps the current trace open after its handler returns; returns the trace to release later, or None.
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.hold()
+    return trace
+
+class TraceLogFilter(logging.Filter):
+    """
+    A logging filter that tags records with the correlation id of the current trace, as `trace_id`.
+    """
+    def filter(self, record):
+        trace = current_trace.get()
+        record.trace_id = f"[{trace.trace_id}] " if trace else ""
+        return True
+
+class SamplingProfiler:
+    """
+    A class for sampling the stacks of the dispatcher threads for a while, e.g. when the bot is slow in production.
+    Samples are written in the collapsed stack format ("thread;module:function;... count" per line)
+    that flamegraph.pl, speedscope and similar tools read.
+    """
+    def __init__(self, interval=0.005, thread_filter=None):
+        self.interval = interval
+        # Threads to sample, by default all of them except the profiler itself
+        self.thread_filter = thread_filter or (lambda thread: True)
+        self.lock = threading.Lock()
+        self.thread: threading.Thread = None
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds: float, output_path: str = None) -> bool:
+        """
+        Profiles for `seconds` in the background and writes the samples to `output_path`.
+        Returns False if a profile is already being taken.
+        """
+        with self.lock:
+            if self.is_running():
+                return False
+            output_path = output_path or f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+            self.thread = threading.Thread(target=self._run, args=(seconds, output_path), name="sampling-profiler", daemon=True)
+            self.thread.start()
+        logging.info(f"Profiling for {seconds} seconds into {output_path}")
+        return True
+
+    def _run(self, seconds: float, output_path: str):
+        stacks = self.sample(seconds)
+        with open(output_path, "w", encoding="utf-8") as output_file:
+            for stack, count in stacks.most_common():
+                output_file.write(f"{stack} {count}\n")
+        logging.info(f"Wrote {sum(stacks.values())} samples of {len(stacks)} stacks to {output_path}")
+
+    def sample(self, seconds: float) -> Counter:
+        """
+        Returns how many times each collapsed stack was seen in `seconds` of sampling.
+        """
+        stacks = Counter()
+        own_thread_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                thread = threads.get(thread_id)
+                if thread_id == own_thread_id or thread is None or not self.thread_filter(thread):
+                    continue
+                stacks[collapse_stack(thread.name, frame)] += 1
+            time.sleep(self.interval)
+        return stacks
+
+def collapse_stack(thread_name: str, frame) -> str:
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+        frame = frame.f_back
+    # Worker threads are numbered; merge them so their stacks add up in the flamegraph
+    thread_name = thread_name.rstrip("0123456789_")
+    return ";".join([thread_name, *reversed(functions)])
@@ -1,35 +1,144 @@
+import ast
+import glob
 import json
+import logging
 import os
+import string
+from collections import namedtuple
+from types import MappingProxyType
 
 # Constants
 default_lang = 'ru'
+fallback_lang = 'en'
+loc_dir = "loc"
+
+# A string with placeholders, split once into (literal_text, field_name, format_spec, conversion) pieces
+CompiledTemplate = namedtuple("CompiledTemplate", ["pieces", "fields"])
+
+_conversions = {None: lambda value: value, 's': str, 'r': repr, 'a': ascii}
+
+def compile_template(text: str):
+    """
+    Returns the text itself when it has no placeholders (so lookups need no formatting at all),
+    otherwise a CompiledTemplate that `render` can fill in without re-parsing the string.
+    """
+    pieces = list(string.Formatter().parse(text))
+    fields = frozenset(field_name for _, field_name, _, _ in pieces if field_name is not None)
+    if not fields:
+        # Pre-render constant strings, which also unescapes doubled braces
+        return "".join(literal_text for literal_text, _, _, _ in pieces)
+    if any(not field_name.isidentifier() for field_name in fields):
+        raise ValueError(f"Only named placeholders are supported in translations: '{text}'")
+    return CompiledTemplate(tuple(pieces), fields)
+
+def render(template: CompiledTemplate, kwargs) -> str:
+    parts = []
+    for literal_text, field_name, format_spec, conversion in template.pieces:
+        parts.append(literal_text)
+        if field_name is not None:
+            parts.append(format(_conversions[conversion](kwargs[field_name]), format_spec))
+    return "".join(parts)
 
 class Translator:
-    def __init__(self, language_code=default_lang):
-        self.language_code = language_code
+    """
+    A class holding the translations of every language in `loc/`, loaded and compiled once and never mutated,
+    so it can be shared by all dispatcher threads without locking.
+    Missing keys fall back to the default language, then to English.
+    """
+    def __init__(self, loc_path=loc_dir):
+        self.loc_path = loc_path
         self.translations = self.load_translations()
+        self.reported_missing_keys = set()
 
     def load_translations(self):
-        if self.language_code is None:
-            self.language_code = default_lang
-        file_name = f"{self.language_code}.json"
-        file_path = os.path.join("loc", file_name)
+        raw_translations = {}
+        for file_path in sorted(glob.glob(os.path.join(self.loc_path, "*.json"))):
+            language_code = os.path.splitext(os.path.basename(file_path))[0]
+            with open(file_path, "r", encoding="utf-8") as f:
+                raw_translations[language_code] = {key: compile_template(text) for key, text in json.load(f).items()}
 
-        with open(file_path, "r", encoding="utf-8") as f:
-            translations = json.load(f)
+        if default_lang not in raw_translations:
+            raise FileNotFoundError(f"No translations found for the default language '{default_lang}' in {self.loc_path}")
 
-        return translations
+        self.check_placeholders(raw_translations)
 
-    def localised(self, key, **kwargs):
-        translated_string = self.translations.get(key, key)
-        return translated_string.format(**kwargs)
+        # Resolve the fallback chain up front: every language table also contains the keys it is missing
+        fallback_chain = [raw_translations.get(fallback_lang, {}), raw_translations[default_lang]]
+        translations = {}
+        for language_code, language_translations in raw_translations.items():
+            merged = {}
+            for table in fallback_chain + [language_translations]:
+                merged.update(table)
+            translations[language_code] = MappingProxyType(merged)
+        return MappingProxyType(translations)
 
-    def change_language(self, language_code):
-        if self.language_code == language_code:
-            return
-        
-        self.language_code = language_code
-        self.translations = self.load_translations()
-        
-    def is_current_lang(self, language_code) -> bool:
-        return self.language_code == language_code
+    def check_placeholders(self, raw_translations):
+        # Every translation of a key has to accept the same arguments as the default language one
+        reference = raw_translations[default_lang]
+        for language_code, language_translations in raw_translations.items():
+            for key, template in language_translations.items():
+                if key in reference and self._fields(template) != self._fields(reference[key]):
+                    logging.warning(f"Placeholders of '{key}' in '{language_code}' differ from '{default_lang}': "
+                                    f"{sorted(self._fields(template))} != {sorted(self._fields(reference[key]))}")
+
+    @staticmethod
+    def _fields(template):
+        return template.fields if isinstance(template, CompiledTemplate) else frozenset()
+
+    def resolve_language(self, language_code) -> str:
+        # Telegram sends IETF tags such as 'en' or 'pt-br'; fall back to the default language for unknown ones
+        if not language_code:
+            return default_lang
+        language_code = language_code.lower()
+        if language_code in self.translations:
+            return language_code
+        base_code = language_code.split('-')[0]
+        return base_code if base_code in self.translations else default_lang
+
+    def placeholders(self, key, lang=None) -> frozenset:
+        return self._fields(self.translations[self.resolve_language(lang)].get(key, ""))
+
+    def check_call_sites(self, source_paths, function_name="loc"):
+        """
+        Warns about `function_name("key", ...)` calls in the source files whose keyword arguments do not match
+        the placeholders of the key, so a renamed placeholder shows up at startup rather than as a KeyError in a handler.
+        Returns the number of mismatched calls.
+        """
+        mismatches = 0
+        for source_path in source_paths:
+            with open(source_path, "r", encoding="utf-8") as f:
+                tree = ast.parse(f.read(), source_path)
+            for node in ast.walk(tree):
+                if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == function_name):
+                    continue
+                if not node.args or not isinstance(node.args[0], ast.Constant) or not isinstance(node.args[0].value, str):
+                    continue
+                if any(keyword.arg is None for keyword in node.keywords):
+                    # **kwargs, can't tell statically
+                    continue
+                key = node.args[0].value
+                arguments = frozenset(keyword.arg for keyword in node.keywords if keyword.arg != "lang")
+                placeholders = self.placeholders(key)
+                if arguments != placeholders:
+                    mismatches += 1
+                    logging.warning(f"{source_path}:{node.lineno}: '{key}' is called with {sorted(arguments)}, "
+                                    f"but its placeholders are {sorted(placeholders)}")
+        return mismatches
+
+    def localised(self, key, lang=None, **kwargs):
+        template = self.translations[self.resolve_language(lang)].get(key)
+        if template is None:
+            if key not in self.reported_missing_keys:
+                self.reported_missing_keys.add(key)
+                logging.warning(f"No translation found for key '{key}'")
+            return key
+        if isinstance(template, str):
+            return template
+
+        missing_fields = template.fields - kwargs.keys()
+        if missing_fields:
+            raise KeyError(f"Missing placeholders {sorted(missing_fields)} for translation key '{key}'")
+        return render(template, kwargs)
+
+    def languages(self):
+        return list(self.translations)
@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+
+from telegram import Bot, ChatAction
+
+from tracing import current_trace, use_trace
+
+class TypingIndicatorManager:
+    """
+    A class for keeping the "typing" chat action alive for every chat with a pending request.
+    A single scheduler thread serves all chats; each chat is reference counted, so concurrent
+    requests in the same chat share one indicator and stopping one of them does not affect the others.
+    """
+    def __init__(self, bot: Bot, interval=5):
+        self.bot = bot
+        self.interval = interval  # Telegram shows a chat action for about 5 seconds
+        self.active_chats = {}  # chat_id -> number of requests waiting in that chat
+        self.chat_traces = {}  # chat_id -> trace of the request that started the indicator, for its log lines
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.scheduler_thread = threading.Thread(target=self._run, name="typing-indicator", daemon=True)
+        self.scheduler_thread.start()
+
+    def start(self, chat_id: int):
+        with self.condition:
+            self.active_chats[chat_id] = self.active_chats.get(chat_id, 0) + 1
+            is_new_chat = self.active_chats[chat_id] == 1
+            if is_new_chat:
+                self.chat_traces[chat_id] = current_trace.get()
+            self.condition.notify()
+        if is_new_chat:
+            # Show the indicator right away instead of waiting for the next tick
+            self._send_typing(chat_id)
+
+    def stop(self, chat_id: int):
+        with self.condition:
+            count = self.active_chats.get(chat_id, 0)
+            if count <= 1:
+                self.active_chats.pop(chat_id, None)
+                self.chat_traces.pop(chat_id, None)
+            else:
+                self.active_chats[chat_id] = count - 1
+
+    def active_count(self) -> int:
+        with self.condition:
+            return len(self.active_chats)
+
+    def shutdown(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.scheduler_thread.join(timeout=self.interval)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                # Sleep until a chat needs the indicator, then tick every interval while any does
+                while not self.active_chats and not self.stopped:
+                    self.condition.wait()
+                next_tick = time.monotonic() + self.interval
+                while not self.stopped and time.monotonic() < next_tick:
+                    self.condition.wait(next_tick - time.monotonic())
+                if self.stopped:
+                    return
+                chat_traces = [(chat_id, self.chat_traces.get(chat_id)) for chat_id in self.active_chats]
+
+            for chat_id, trace in chat_traces:
+                with use_trace(trace):
+                    self._send_typing(chat_id)
+
+    def _send_typing(self, chat_id: int):
+        try:
+            self.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Exception as e:
+            logging.warning(f"Failed to send typing action to chat {chat_id}: {e}")
@@ -0,0 +1,132 @@
+import hmac
+import json
+import logging
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Full
+
+from telegram import Bot, Update
+
+WebhookConfig = namedtuple("WebhookConfig", [
+    "webhook_url",  # Public HTTPS URL Telegram posts updates to, e.g. behind a load balancer
+    "listen",  # Local address the HTTP server binds to; the loopback address suits a reverse proxy on the same host
+    "port",
+    "url_path",  # Path updates are accepted on
+    "secret_token",  # Expected X-Telegram-Bot-Api-Secret-Token header value; required
+    "max_queue_size",  # Updates waiting for the dispatcher before new ones are rejected
+], defaults=["127.0.0.1", 8443, "/telegram", None, 1000])
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookServer:
+    """
+    A class for receiving Telegram updates over HTTP and passing them to the dispatcher's update queue.
+    When the dispatcher falls behind by `max_queue_size` updates, new updates are refused with 503
+    so Telegram redelivers them later instead of the backlog growing without bound.
+    Every request must carry the configured secret token, so only Telegram can inject updates.
+    """
+    def __init__(self, bot: Bot, update_queue: Queue, config: WebhookConfig):
+        if not config.secret_token:
+            raise ValueError("WebhookConfig.secret_token is required to receive updates via webhook")
+        self.bot = bot
+        self.update_queue = update_queue
+        self.config = config
+
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "received": 0,
+            "accepted": 0,
+            "rejected_queue_full": 0,
+            "rejected_unauthorized": 0,
+            "rejected_invalid": 0,
+            "max_queue_size_seen": 0,
+        }
+
+        self.httpd = ThreadingHTTPServer((config.listen, config.port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+        self.server_thread: threading.Thread = None
+
+    @property
+    def server_address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, name="webhook-server", daemon=True)
+        self.server_thread.start()
+        logging.info(f"Webhook server listening on {self.server_address[0]}:{self.server_address[1]}{self.config.url_path}")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.server_thread:
+            self.server_thread.join()
+
+    def register_webhook(self, allowed_updates=None):
+        self.bot.set_webhook(
+            url=self.config.webhook_url,
+            allowed_updates=allowed_updates,
+            api_kwargs={"secret_token": self.config.secret_token})
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["queue_size"] = self.update_queue.qsize()
+        return stats
+
+    def _count(self, stat: str):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def handle_update(self, headers, body: bytes) -> int:
+        """
+        Validates and enqueues one webhook request, returning the HTTP status code to answer with.
+        """
+        self._count("received")
+
+        secret_token = headers.get(SECRET_TOKEN_HEADER) or ""
+        if not hmac.compare_digest(secret_token, self.config.secret_token):
+            self._count("rejected_unauthorized")
+            return 403
+
+        queue_size = self.update_queue.qsize()
+        if queue_size >= self.config.max_queue_size:
+            self._count("rejected_queue_full")
+            return 503
+
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning(f"Received an invalid webhook update: {e}")
+            self._count("rejected_invalid")
+            return 400
+
+        try:
+            self.update_queue.put_nowait(update)
+        except Full:
+            self._count("rejected_queue_full")
+            return 503
+
+        with self.stats_lock:
+            self.stats["accepted"] += 1
+            self.stats["max_queue_size_seen"] = max(self.stats["max_queue_size_seen"], queue_size + 1)
+        return 200
+
+    def _make_request_handler(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.config.url_path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                content_length = int(self.headers.get("Content-Length", 0))
+                status = server.handle_update(self.headers, self.rfile.read(content_length))
+                self.send_response(status)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug(f"Webhook request: {format % args}")
+
+        return WebhookRequestHandler
@@ -0,0 +1,30 @@
+from concurrent.futures import Future
+
+import pytest
+from telegram.error import BadRequest, NetworkError, TimedOut
+
+from admin_menu_manager import AdminMenuManager
+
+def edited(error=None) -> Future:
+    future = Future()
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(True)
+    return future
+
+@pytest.mark.parametrize("error, resent", [
+    (None, False),
+    (BadRequest("Message is not modified: specified new message content is the same"), False),
+    (BadRequest("Message to edit not found"), True),
+    (NetworkError("Connection reset"), True),
+    (TimedOut(), True),
+])
+def test_menu_is_sent_again_when_editing_it_fails(error, resent):
+    manager = AdminMenuManager(None, None, None)
+    shown = []
+    manager.show_admin_menu_callback = lambda query, context, original_chat_id=None: shown.append(original_chat_id)
+
+    manager.handle_admin_menu_edited(None, None, -100, edited(error))
+
+    assert shown == ([-100] if resent else [])
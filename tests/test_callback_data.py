@@ -0,0 +1,36 @@
+import pytest
+
+from callback_data import CallbackData, CallbackDataCodec, MAX_CALLBACK_DATA_LENGTH, encode_int, decode_int
+
+@pytest.fixture
+def codec():
+    return CallbackDataCodec(b"secret")
+
+@pytest.mark.parametrize("value", [0, 1, 35, 36, -1, -1001234567890, 2 ** 53])
+def test_int_round_trip(value):
+    assert decode_int(encode_int(value)) == value
+
+def test_round_trip(codec):
+    data = codec.encode("set_model", -1001234567890, "gpt-4")
+
+    assert len(data.encode("utf-8")) <= MAX_CALLBACK_DATA_LENGTH
+    assert codec.decode(data) == CallbackData("set_model", -1001234567890, "gpt-4")
+    assert codec.decode(codec.encode("show_limit", 42)) == CallbackData("show_limit", 42, "")
+
+def test_tampered_data_is_rejected(codec):
+    data = codec.encode("show_limit", -100)
+    forged = data.replace(encode_int(-100), encode_int(-101), 1)
+
+    assert codec.decode(forged) is None
+    assert codec.decode(data[:-1]) is None
+    assert CallbackDataCodec(b"other secret").decode(data) is None
+
+@pytest.mark.parametrize("data", [None, "", "show_limit", "a|b", "|||", "show_limit|-2s|extra|field|tag"])
+def test_malformed_data_is_rejected(codec, data):
+    assert codec.decode(data) is None
+
+def test_invalid_fields_are_refused(codec):
+    with pytest.raises(ValueError):
+        codec.encode("set|model", 1)
+    with pytest.raises(ValueError):
+        codec.encode("set_model", 1, "a" * MAX_CALLBACK_DATA_LENGTH)
@@ -0,0 +1,83 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from financial_validator import FinancialValidator
+from input_handler import InputHandler
+from message_limit_handler import MessageLimitHandler
+from rate_limiters import FixedWindowLimiter
+
+MODEL = "gpt-3.5-turbo"
+
+@pytest.fixture
+def validator():
+    validator = FinancialValidator()
+    # A request of 1000 prompt and 1000 completion tokens is estimated at $0.0035
+    validator.set_limit(1, 0.01)
+    return validator
+
+def test_reservations_count_towards_the_limit(validator):
+    reservations = [validator.reserve(1, MODEL, 1000, 1000) for _ in range(2)]
+
+    assert all(reservations)
+    assert validator.reserve(1, MODEL, 1000, 1000) is None
+    # Chats without a limit are never refused
+    assert validator.reserve(2, MODEL, 10 ** 6, 10 ** 6) is not None
+
+def test_commit_replaces_the_estimate_with_the_usage(validator):
+    reservation = validator.reserve(1, MODEL, 1000, 1000)
+    validator.commit(reservation, MODEL, 1000, 0)
+
+    assert validator.spent_usd[1] == pytest.approx(0.0015)
+    assert validator.reserved_usd == {}
+    assert validator.left_dollar_usage(1) == pytest.approx(0.0085)
+
+def test_release_frees_the_estimate(validator):
+    reservations = [validator.reserve(1, MODEL, 1000, 1000) for _ in range(2)]
+    validator.release(reservations[0])
+
+    assert validator.reserve(1, MODEL, 1000, 1000) is not None
+    assert validator.spent_usd.get(1, 0) == 0
+
+def test_abandoned_reservations_expire(validator):
+    validator.reservation_ttl = 0.01
+    validator.reserve(1, MODEL, 1000, 1000)
+    validator.reserve(1, MODEL, 1000, 1000)
+    time.sleep(0.02)
+
+    assert validator.reserve(1, MODEL, 1000, 1000) is not None
+    assert len(validator.reserved_usd[1]) == 1
+
+def test_new_interval_clears_spending_and_reservations(validator):
+    validator.reserve(1, MODEL, 1000, 1000)
+    validator.register_spending(1, 0.02)
+    assert not validator.can_send_message(1)
+
+    validator.reset_times[1] -= validator.reset_interval + 1
+    assert validator.can_send_message(1)
+    assert validator.spent_usd[1] == 0
+    assert 1 not in validator.reserved_usd
+
+def test_admins_are_notified_when_a_reservation_is_refused(validator):
+    sent = []
+    sender = SimpleNamespace(reply_to=lambda message, text, *args: sent.append(text))
+    message_limit_handler = MessageLimitHandler(rate_limiter=FixedWindowLimiter())
+    message_limit_handler.set_limit(1, 5)
+    handler = InputHandler(message_limit_handler, validator, SimpleNamespace(bot=None), None, message_sender=sender)
+    notifications = []
+    handler.notify_admins_limit_reached = lambda chat_id, limit_type, context: notifications.append((chat_id, limit_type))
+
+    # Spending stays under the limit, but the rest of the budget cannot cover another request
+    validator.register_spending(1, 0.008)
+    assert validator.can_send_message(1)
+    message = SimpleNamespace(
+        text="Hello", message_id=10, reply_to_message=None,
+        chat=SimpleNamespace(id=1, title="Chat", username=None), from_user=SimpleNamespace(id=5, language_code="en"))
+    handler.process_gpt_request(None, message, 1)
+
+    assert notifications == [(1, "USD")]
+    assert len(sent) == 1
+    # The message slot claimed for the refused request is given back
+    assert message_limit_handler.reserved_messages == {}
+    assert message_limit_handler.get_remaining_messages(1) == 5
@@ -0,0 +1,66 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+from financial_validator import FinancialValidator
+from input_handler import InputHandler, GPTRequest
+from message_limit_handler import MessageLimitHandler
+from tracing import Trace
+
+@pytest.fixture
+def handler():
+    sent = []
+    sender = SimpleNamespace(reply_to=lambda message, text, *args: sent.append(text))
+    handler = InputHandler(MessageLimitHandler(), FinancialValidator(), SimpleNamespace(bot=None), None, message_sender=sender)
+    handler.sent = sent
+    # There is no bot to show the indicator with
+    handler.typing_indicator._send_typing = lambda chat_id: None
+    yield handler
+    handler.typing_indicator.shutdown()
+
+def make_request(handler, chat_id=1):
+    finished = []
+    trace = Trace(SimpleNamespace(finish=finished.append), "u1", chat_id)
+    trace.hold()
+    message = SimpleNamespace(text="Hello", message_id=10, chat_id=chat_id)
+    request_kwargs = dict(model="gpt-3.5-turbo", messages=[])
+    reservation = handler.financial_validator.reserve(chat_id, request_kwargs["model"], 10, 10)
+    message_reservation = handler.message_limit_handler.reserve(chat_id, 5)
+    gpt_request = GPTRequest(None, message, chat_id, 5, "en", request_kwargs, None, reservation, message_reservation, "Hello", 10, None, trace)
+    handler.start_typing(None, chat_id)
+    return gpt_request, finished
+
+def completed(result=None, exception=None) -> Future:
+    future = Future()
+    if exception:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+def test_failed_registration_stops_typing_and_ends_the_trace(handler):
+    gpt_request, finished = make_request(handler)
+
+    def handle_gpt_response(*args):
+        raise TimeoutError("Could not acquire the lock")
+    handler.handle_gpt_response = handle_gpt_response
+
+    with pytest.raises(TimeoutError):
+        handler.handle_gpt_completion(gpt_request, completed(SimpleNamespace()))
+
+    assert handler.typing_indicator.active_count() == 0
+    assert finished == [gpt_request.trace]
+
+def test_failed_completion_stops_typing_once(handler):
+    gpt_request, finished = make_request(handler)
+    # Another request is still waiting in the same chat
+    handler.start_typing(None, gpt_request.chat_id)
+
+    handler.handle_gpt_completion(gpt_request, completed(exception=RuntimeError("Upstream failed")))
+
+    assert handler.typing_indicator.active_chats == {gpt_request.chat_id: 1}
+    assert finished == [gpt_request.trace]
+    assert len(handler.sent) == 1
+    assert handler.financial_validator.reserved_usd == {}
+    assert handler.message_limit_handler.reserved_messages == {}
@@ -0,0 +1,40 @@
+from message_chunker import split_message, CODE_FENCE
+
+def fence_lines(message):
+    return [line.strip() for line in message.split("\n") if CODE_FENCE.match(line)]
+
+def test_short_text_is_one_message():
+    assert split_message("  Hello  ") == ["Hello"]
+    assert split_message("   ") == []
+
+def test_messages_fit_the_limit_and_keep_every_word():
+    text = "\n\n".join(f"Paragraph {index}: " + "word " * 30 for index in range(20))
+    messages = split_message(text, max_length=200)
+
+    assert len(messages) > 1
+    assert all(len(message) <= 200 for message in messages)
+    assert " ".join(" ".join(messages).split()) == " ".join(text.split())
+
+def test_cuts_prefer_paragraph_ends():
+    first, second = "a" * 60, "b" * 60
+    assert split_message(f"{first}\n\n{second}", max_length=100) == [first, second]
+
+def test_long_words_are_cut():
+    messages = split_message("x" * 250, max_length=100)
+    assert all(len(message) <= 100 for message in messages)
+    assert "".join(messages) == "x" * 250
+
+def test_cut_code_blocks_are_closed_and_reopened():
+    code = "\n".join(f"print({index})" for index in range(60))
+    text = f"Here is the code:\n\n```python\n{code}\n```\n\nThat's it."
+    messages = split_message(text, max_length=200)
+
+    assert len(messages) > 2
+    for message in messages:
+        assert len(message) <= 200
+        fences = fence_lines(message)
+        # Every message opens and closes its own code blocks
+        assert len(fences) % 2 == 0
+        assert all(fence == "```python" for fence in fences[::2])
+        assert all(fence == "```" for fence in fences[1::2])
+    assert "".join(messages).count("print(") == 60
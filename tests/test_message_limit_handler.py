@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from message_limit_handler import MessageLimitHandler
+from rate_limiters import FixedWindowLimiter
+from shared_state import SharedState
+
+@pytest.fixture
+def handler():
+    handler = MessageLimitHandler(rate_limiter=FixedWindowLimiter())
+    handler.set_limit(1, 3)
+    handler.set_user_limit(1, 2)
+    return handler
+
+def test_shared_state_is_abstract():
+    with pytest.raises(TypeError):
+        SharedState()
+
+def test_reservations_count_towards_the_limits(handler):
+    first, second = handler.reserve(1, 10), handler.reserve(1, 10)
+
+    assert first and second
+    # The user's limit is taken by requests in flight, the chat has one slot left
+    assert handler.reserve(1, 10) is None
+    assert handler.reserve(1, 20) is not None
+    assert handler.reserve(1, 30) is None
+
+def test_released_slots_can_be_claimed_again(handler):
+    reservation = handler.reserve(1, 10)
+    handler.reserve(1, 10)
+    handler.release(reservation)
+
+    assert handler.reserve(1, 10) is not None
+    assert handler.get_remaining_messages(1) == 3
+
+def test_committed_slots_are_counted(handler):
+    handler.commit(handler.reserve(1, 10))
+
+    assert handler.get_remaining_messages(1) == 2
+    assert handler.get_remaining_messages(1, 10) == 1
+    assert handler.reserved_messages == {}
+
+def test_remaining_messages_count_the_whole_day():
+    handler = MessageLimitHandler()
+    handler.set_limit(1, 8)
+    for _ in range(2):
+        handler.commit(handler.reserve(1, 10))
+
+    # The default token bucket lets a quarter of the limit through at once
+    assert handler.reserve(1, 10) is None
+    assert handler.get_remaining_messages(1) == 6
+
+def test_abandoned_reservations_expire(handler):
+    handler.reservation_ttl = 0.01
+    handler.reserve(1, 10)
+    handler.reserve(1, 10)
+    time.sleep(0.02)
+
+    assert handler.reserve(1, 10) is not None
@@ -0,0 +1,137 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import RetryAfter, BadRequest, NetworkError
+
+from message_sender import MessageSender, PRIORITY
+
+class FakeBot:
+    """
+    A class for recording the messages sent, failing the attempts scripted for a text.
+    """
+    def __init__(self, errors=None):
+        self.sent = []  # (chat_id, text, monotonic time)
+        self.errors = errors or {}  # text -> exceptions raised by its next attempts
+
+    def send_message(self, chat_id, text, **kwargs):
+        errors = self.errors.get(text)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text, time.monotonic()))
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+    def sent_texts(self, chat_id=None):
+        return [text for sent_chat_id, text, _ in self.sent if chat_id in (None, sent_chat_id)]
+
+@pytest.fixture
+def make_sender():
+    senders = []
+
+    def make_sender(bot, **kwargs):
+        # Group chats (negative ids) with limits high enough not to slow the tests down
+        limits = dict(messages_per_second=1000, group_messages_per_minute=60000, group_burst=100)
+        sender = MessageSender(bot, **{**limits, **kwargs})
+        senders.append(sender)
+        return sender
+
+    yield make_sender
+    for sender in senders:
+        sender.stop(timeout=1)
+
+def test_messages_to_a_chat_are_sent_in_order(make_sender):
+    bot = FakeBot()
+    sender = make_sender(bot)
+
+    futures = [sender.send_message(-1, f"part {i}") for i in range(10)]
+    futures += [sender.send_message(-2, f"other {i}") for i in range(5)]
+
+    assert [future.result(timeout=5).text for future in futures[:10]] == [f"part {i}" for i in range(10)]
+    assert bot.sent_texts(-1) == [f"part {i}" for i in range(10)]
+    assert bot.sent_texts(-2) == [f"other {i}" for i in range(5)]
+
+def test_answers_go_before_notifications(make_sender):
+    bot = FakeBot()
+    # A single worker sends the messages one at a time, in the order they were dispatched
+    sender = make_sender(bot, max_workers=1)
+
+    # Holding the lock keeps the scheduler from dispatching until everything is queued
+    with sender.condition:
+        futures = [
+            sender.send_message(-1, "notification", PRIORITY.NOTIFICATION),
+            sender.send_message(-2, "normal"),
+            sender.send_message(-3, "answer", PRIORITY.ANSWER),
+        ]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert bot.sent_texts() == ["answer", "normal", "notification"]
+
+def test_retry_after_keeps_the_message_first_in_its_chat(make_sender):
+    bot = FakeBot({"first": [RetryAfter(0.2)]})
+    sender = make_sender(bot)
+
+    start_time = time.monotonic()
+    futures = [sender.send_message(-1, text) for text in ("first", "second", "third")]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert bot.sent_texts() == ["first", "second", "third"]
+    assert bot.sent[0][2] - start_time >= 0.2
+    assert sender.get_stats()["flood_waits"] == 1
+    assert sender.get_stats()["failed"] == 0
+
+def test_network_errors_are_not_retried_without_budget(make_sender):
+    bot = FakeBot({"first": [NetworkError("Connection reset")]})
+    sender = make_sender(bot, max_retry_budget=0)
+
+    with pytest.raises(NetworkError):
+        sender.send_message(-1, "first").result(timeout=5)
+
+    stats = sender.get_stats()
+    assert stats["retries"] == 0 and stats["retries_denied"] == 1 and stats["failed"] == 1
+
+def test_retries_stop_when_the_budget_runs_out(make_sender):
+    bot = FakeBot({"first": [NetworkError("Connection reset"), NetworkError("Connection reset")]})
+    sender = make_sender(bot, max_retries=3, max_retry_budget=1)
+
+    # The only retry waits 2 seconds, then fails again with no budget left
+    with pytest.raises(NetworkError):
+        sender.send_message(-1, "first").result(timeout=5)
+
+    stats = sender.get_stats()
+    assert stats["retries"] == 1 and stats["retries_denied"] == 1
+    assert stats["retry_budget"] == 0
+
+def test_retry_budget_is_earned_by_successful_sends(make_sender):
+    bot = FakeBot()
+    sender = make_sender(bot, retry_budget_ratio=0.5, max_retry_budget=1)
+    sender.retry_budget = 0
+
+    for future in [sender.send_message(-1, f"part {i}") for i in range(3)]:
+        future.result(timeout=5)
+
+    # Capped at `max_retry_budget`
+    assert sender.get_stats()["retry_budget"] == 1
+
+def test_batch_fails_with_the_first_error_once_every_call_is_done(make_sender):
+    bot = FakeBot({"second": [BadRequest("Message is too long")], "third": [BadRequest("Chat not found")]})
+    sender = make_sender(bot)
+
+    calls = [(bot.send_message, dict(chat_id=-1, text=text)) for text in ("first", "second", "third", "fourth")]
+    batch = sender.send_batch(calls, PRIORITY.ANSWER)
+
+    with pytest.raises(BadRequest, match="too long"):
+        batch.result(timeout=5)
+    # An error does not stop the rest of the batch
+    assert bot.sent_texts() == ["first", "fourth"]
+    assert sender.get_stats()["pending"] == 0
+
+def test_batch_results_are_in_order(make_sender):
+    bot = FakeBot()
+    sender = make_sender(bot)
+
+    calls = [(bot.send_message, dict(chat_id=-1, text=f"part {i}")) for i in range(5)]
+
+    assert [message.text for message in sender.send_batch(calls).result(timeout=5)] == [f"part {i}" for i in range(5)]
+    assert sender.send_batch([]).result(timeout=5) == []
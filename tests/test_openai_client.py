@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from fake_openai import FakeOpenAIServer, FakeOpenAIConfig
+from openai_client import OpenAIClient, CircuitBreaker, CircuitOpenError
+
+REQUEST = dict(model="gpt-3.5-turbo", messages=[{"role": "user", "content": "Hello"}], api_key="test")
+
+@pytest.fixture
+def fake_openai():
+    server = FakeOpenAIServer(FakeOpenAIConfig(latency=0.01, answer_words=3))
+    server.start()
+    yield server
+    server.stop()
+
+def configure(server: FakeOpenAIServer, **config):
+    server.config = server.config._replace(**config)
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+def test_cancelled_probe_lets_the_next_request_probe(fake_openai):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    open_breaker(breaker)
+    time.sleep(0.06)
+
+    async def run():
+        client = OpenAIClient(max_retries=0, circuit_breaker=breaker, api_base=fake_openai.api_base)
+        configure(fake_openai, latency=0.5)
+        # The engine's request timeout cancels the probe
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.create_chat_completion(**REQUEST), 0.05)
+        assert not breaker.probe_in_flight
+
+        configure(fake_openai, latency=0.01)
+        return await client.create_chat_completion(**REQUEST)
+
+    response = asyncio.run(run())
+    assert response.choices[0].message.content
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert fake_openai.stats["requests"] == 2
+
+def test_retry_after_sets_the_backoff(fake_openai):
+    configure(fake_openai, rate_limit_rate=1.0, retry_after=0.3)
+    client = OpenAIClient(max_retries=1, backoff_base=0.001, api_base=fake_openai.api_base)
+
+    start_time = time.monotonic()
+    with pytest.raises(openai.error.RateLimitError):
+        asyncio.run(client.create_chat_completion(**REQUEST))
+
+    assert time.monotonic() - start_time >= 0.3
+    assert fake_openai.stats["rate_limited"] == 2
+    assert client.retries == 1
+
+def test_backoff_delay_is_capped():
+    client = OpenAIClient(backoff_base=1.0, backoff_max=5.0)
+    rate_limited = openai.error.RateLimitError("Slow down", headers={"retry-after": "60"})
+
+    assert all(0 <= client.get_backoff_delay(1, openai.error.APIError("Oops")) <= 2 for _ in range(100))
+    assert all(client.get_backoff_delay(10, openai.error.APIError("Oops")) <= 5 for _ in range(100))
+    assert client.get_backoff_delay(0, rate_limited) == 5
+    assert client.get_retry_after(openai.error.RateLimitError("Slow down", headers={"Retry-After": "soon"})) is None
+
+def test_concurrency_is_capped_globally_and_per_chat(fake_openai):
+    configure(fake_openai, latency=0.05)
+    client = OpenAIClient(max_concurrency=3, max_per_chat=2, api_base=fake_openai.api_base)
+    active = {"all": 0, 1: 0, 2: 0}
+    peaks = dict(active)
+
+    async def request(chat_id):
+        async with client.slot(chat_id):
+            for key in ("all", chat_id):
+                active[key] += 1
+                peaks[key] = max(peaks[key], active[key])
+            await client.create_chat_completion(**REQUEST)
+            for key in ("all", chat_id):
+                active[key] -= 1
+
+    async def run():
+        await asyncio.gather(*[request(chat_id) for chat_id in (1, 1, 1, 1, 2, 2)])
+
+    asyncio.run(run())
+    # Which chat gets a freed global slot first is up to scheduling
+    assert peaks["all"] == 3
+    assert peaks[1] == 2 and peaks[2] <= 2
+    assert client.chat_semaphores == {}
+    assert fake_openai.stats["requests"] == 6
+
+def test_breaker_opens_after_consecutive_failures_and_fails_fast(fake_openai):
+    configure(fake_openai, error_rate=1.0)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    client = OpenAIClient(max_retries=1, backoff_base=0.001, circuit_breaker=breaker, api_base=fake_openai.api_base)
+
+    with pytest.raises(openai.error.APIError):
+        asyncio.run(client.create_chat_completion(**REQUEST))
+    assert breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(client.create_chat_completion(**REQUEST))
+    assert fake_openai.stats["requests"] == 2
+
+def test_breaker_lets_one_probe_through_after_the_reset_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    open_breaker(breaker)
+    assert not breaker.allow_request()
+
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only one probe at a time
+    assert not breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request() and breaker.allow_request()
@@ -0,0 +1,120 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from rate_limiters import (
+    RateLimiter,
+    FixedWindowLimiter,
+    SlidingWindowLimiter,
+    TokenBucketLimiter,
+    CalendarDayLimiter,
+    create_rate_limiter,
+)
+
+def register_times(limiter, limit, times, state=None):
+    for now in times:
+        state = limiter.register(state, limit, now)
+    return state
+
+def test_rate_limiter_is_abstract():
+    with pytest.raises(TypeError):
+        RateLimiter()
+
+def test_fixed_window_counts_until_the_window_ends():
+    limiter = FixedWindowLimiter(interval=100)
+    state = register_times(limiter, 3, [10, 20, 30])
+
+    assert not limiter.is_allowed(state, 3, 50)
+    assert limiter.remaining(state, 3, 110) == 0
+    assert limiter.window_start(state, 50) == 10
+
+def test_fixed_window_resets_after_the_interval():
+    limiter = FixedWindowLimiter(interval=100)
+    state = register_times(limiter, 3, [10, 20, 30])
+
+    assert limiter.remaining(state, 3, 111) == 3
+    assert limiter.window_start(state, 111) is None
+    state = limiter.register(state, 3, 111)
+    assert state == [111, 1]
+
+def test_sliding_window_frees_slots_as_messages_leave_the_window():
+    limiter = SlidingWindowLimiter(window=100)
+    state = register_times(limiter, 3, [0, 10, 20])
+
+    assert not limiter.is_allowed(state, 3, 99)
+    assert limiter.is_allowed(state, 3, 100)
+    assert limiter.remaining(state, 3, 100) == 1
+    assert limiter.remaining(state, 3, 120) == 3
+
+def test_sliding_window_wraps_around_without_reordering():
+    limiter = SlidingWindowLimiter(window=100)
+    state = register_times(limiter, 3, [0, 10, 20, 100, 110])
+
+    assert state["head"] == 2
+    assert state["times"] == [100, 110, 20]
+    # Checking a wrapped ring leaves it in place
+    assert limiter.is_allowed(state, 3, 120)
+    assert limiter.remaining(state, 3, 120) == 1
+    assert limiter.register(state, 3, 120) is state
+    assert state == {"head": 0, "times": [100, 110, 120]}
+
+def test_sliding_window_keeps_the_latest_messages_when_the_limit_changes():
+    limiter = SlidingWindowLimiter(window=100)
+    state = register_times(limiter, 3, [0, 10, 20, 30])
+
+    smaller = limiter.register(state, 2, 40)
+    assert smaller == {"head": 1, "times": [40, 30]}
+    assert limiter.remaining(smaller, 2, 40) == 0
+
+    larger = limiter.register(state, 5, 40)
+    assert larger == {"head": 0, "times": [10, 20, 30, 40]}
+    assert limiter.remaining(larger, 5, 40) == 1
+
+def test_token_bucket_limits_the_burst_and_refills_evenly():
+    limiter = TokenBucketLimiter(window=100, burst_share=0.25)
+    state = register_times(limiter, 8, [0, 0])
+
+    # 8 messages per 100 seconds: a burst of 2, then one every 12.5 seconds
+    assert not limiter.is_allowed(state, 8, 0)
+    assert limiter.wait_time(state, 8, 0) == pytest.approx(12.5)
+    assert limiter.is_allowed(state, 8, 12.5)
+    assert limiter.remaining(state, 8, 25) == 2
+    assert limiter.remaining(state, 8, 1000) == 2
+
+def test_token_bucket_reports_what_is_left_of_the_window():
+    limiter = TokenBucketLimiter(window=100, burst_share=0.25)
+    state = register_times(limiter, 8, [0, 0])
+
+    # The burst is spent, but 6 of the 8 messages are left for the rest of the window
+    assert limiter.remaining(state, 8, 0) == 0
+    assert limiter.remaining_in_window(state, 8, 0) == 6
+    assert limiter.remaining_in_window(state, 8, 12.5) == 7
+    assert limiter.remaining_in_window(state, 8, 1000) == 8
+    assert FixedWindowLimiter(interval=100).remaining_in_window([0, 3], 8, 10) == 5
+
+def test_token_bucket_without_burst_allows_the_whole_limit_at_once():
+    limiter = TokenBucketLimiter(window=100)
+    state = register_times(limiter, 4, [0, 0, 0, 0])
+
+    assert not limiter.is_allowed(state, 4, 0)
+    assert limiter.remaining(state, 4, 100) == 4
+
+def test_calendar_day_resets_at_the_reset_hour():
+    limiter = CalendarDayLimiter(timezone="Europe/Moscow", reset_hour=4)
+    zone = ZoneInfo("Europe/Moscow")
+    before_reset = datetime(2023, 5, 2, 3, 59, tzinfo=zone).timestamp()
+    after_reset = datetime(2023, 5, 2, 4, 0, tzinfo=zone).timestamp()
+
+    state = register_times(limiter, 2, [before_reset, before_reset])
+    assert not limiter.is_allowed(state, 2, before_reset)
+    assert limiter.remaining(state, 2, after_reset) == 2
+    assert limiter.window_start(state, after_reset) == after_reset
+
+def test_create_rate_limiter():
+    assert isinstance(create_rate_limiter("token_bucket"), TokenBucketLimiter)
+    assert isinstance(create_rate_limiter("sliding_window", 60), SlidingWindowLimiter)
+    calendar_day = create_rate_limiter("calendar_day", timezone="Europe/Moscow", reset_hour=4)
+    assert calendar_day.timezone == ZoneInfo("Europe/Moscow") and calendar_day.reset_hour == 4
+    with pytest.raises(ValueError):
+        create_rate_limiter("leaky_bucket")
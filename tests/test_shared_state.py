@@ -0,0 +1,228 @@
+import threading
+import time
+
+import pytest
+
+from shared_state import RedisSharedState
+
+class FakeRedis:
+    """
+    A class for the few Redis commands RedisSharedState uses, kept in memory. Like redis-py, it returns bytes.
+    """
+    def __init__(self):
+        self.data = {}  # key -> bytes, or {field: bytes} for hashes
+        self.expiry = {}  # key -> monotonic time the key expires at
+        self.lock = threading.Lock()
+        self.calls = []  # Names of the commands run, pipelined ones included
+
+    def _encode(self, value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def _expire_keys(self):
+        now = time.monotonic()
+        for key in [key for key, expires_at in self.expiry.items() if expires_at <= now]:
+            self.data.pop(key, None)
+            del self.expiry[key]
+
+    def _run(self, command, *args, **kwargs):
+        with self.lock:
+            self.calls.append(command)
+            self._expire_keys()
+            return getattr(self, f"_{command}")(*args, **kwargs)
+
+    def __getattr__(self, command):
+        if f"_{command}" not in type(self).__dict__:
+            raise AttributeError(command)
+        return lambda *args, **kwargs: self._run(command, *args, **kwargs)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def _set(self, key, value, nx=False, px=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = self._encode(value)
+        self.expiry.pop(key, None)
+        if px is not None:
+            self.expiry[key] = time.monotonic() + px / 1000
+        return True
+
+    def _get(self, key):
+        return self.data.get(key)
+
+    def _eval(self, script, numkeys, *keys_and_args):
+        # Only the compare-and-delete script releasing a lock is supported
+        assert "del" in script and numkeys == 1
+        key, token = keys_and_args
+        if self.data.get(key) != self._encode(token):
+            return 0
+        del self.data[key]
+        self.expiry.pop(key, None)
+        return 1
+
+    def _pexpire(self, key, milliseconds):
+        if key not in self.data:
+            return 0
+        self.expiry[key] = time.monotonic() + milliseconds / 1000
+        return 1
+
+    def _pttl(self, key):
+        if key not in self.data:
+            return -2
+        if key not in self.expiry:
+            return -1
+        return int((self.expiry[key] - time.monotonic()) * 1000)
+
+    def _hget(self, key, field):
+        return self.data.get(key, {}).get(self._encode(field))
+
+    def _hset(self, key, field, value):
+        fields = self.data.setdefault(key, {})
+        is_new = self._encode(field) not in fields
+        fields[self._encode(field)] = self._encode(value)
+        return int(is_new)
+
+    def _hdel(self, key, field):
+        fields = self.data.get(key, {})
+        if fields.pop(self._encode(field), None) is None:
+            return 0
+        if not fields:
+            self.data.pop(key, None)
+        return 1
+
+    def _hexists(self, key, field):
+        return int(self._encode(field) in self.data.get(key, {}))
+
+    def _hkeys(self, key):
+        return list(self.data.get(key, {}))
+
+    def _hlen(self, key):
+        return len(self.data.get(key, {}))
+
+class FakePipeline:
+    """
+    A class for queueing commands and running them together on `execute`, like a Redis transaction.
+    """
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, command):
+        return lambda *args, **kwargs: self.commands.append((command, args, kwargs))
+
+    def execute(self):
+        with self.client.lock:
+            self.client._expire_keys()
+            results = []
+            for command, args, kwargs in self.commands:
+                self.client.calls.append(command)
+                results.append(getattr(self.client, f"_{command}")(*args, **kwargs))
+        self.commands = []
+        return results
+
+@pytest.fixture
+def client():
+    return FakeRedis()
+
+def test_dict_stores_keys_and_values_as_json(client):
+    state = RedisSharedState(client=client, prefix="test")
+    limits = state.dict("message_limits")
+    limits[-100] = {"limit": 5, "states": [1.5, None]}
+    limits["-100:7"] = 3
+
+    assert client.data["test:message_limits"][b"-100"] == b'{"limit": 5, "states": [1.5, null]}'
+    assert limits[-100] == {"limit": 5, "states": [1.5, None]}
+    # Chat ids stay ints, and are not confused with the string keys of users
+    assert sorted(limits, key=str) == [-100, "-100:7"]
+    assert -100 in limits and "-100" not in limits
+    assert len(limits) == 2
+    assert limits.get(5, "default") == "default"
+
+    del limits[-100]
+    with pytest.raises(KeyError):
+        del limits[-100]
+    with pytest.raises(KeyError):
+        limits[-100]
+    # Other workers see the same data
+    assert dict(state.dict("message_limits")) == {"-100:7": 3}
+
+def test_persistent_dicts_do_not_expire(client):
+    limits = RedisSharedState(client=client, prefix="test").dict("message_limits")
+    limits[1] = 5
+
+    assert client.pttl("test:message_limits") == -1
+    assert "pipeline" not in client.calls and "pexpire" not in client.calls
+
+def test_volatile_dicts_expire_after_their_last_change(client):
+    reservations = RedisSharedState(client=client, prefix="test", volatile_ttl=0.3).dict("reserved_usd", persistent=False)
+    reservations[1] = {"abc": [0.01, 100]}
+
+    # The value and its expiry are set together
+    assert client.calls[-2:] == ["hset", "pexpire"]
+    assert 0 < client.pttl("test:reserved_usd") <= 300
+
+    time.sleep(0.2)
+    reservations[2] = {}
+    time.sleep(0.15)
+    # The second change pushed the expiry back
+    assert reservations[1] == {"abc": [0.01, 100]}
+
+    time.sleep(0.3)
+    assert 1 not in reservations and len(reservations) == 0
+
+def test_lock_is_a_key_that_expires(client):
+    state = RedisSharedState(client=client, prefix="test", lock_timeout=5)
+
+    with state.lock("financial:1"):
+        assert client.get("test:lock:financial:1") is not None
+        assert 4000 < client.pttl("test:lock:financial:1") <= 5000
+    assert client.get("test:lock:financial:1") is None
+
+def test_lock_is_exclusive_across_workers(client):
+    workers = [RedisSharedState(client=client, prefix="test") for _ in range(4)]
+    counter = workers[0].dict("counter")
+    counter["count"] = 0
+
+    def increment(state: RedisSharedState):
+        for _ in range(25):
+            with state.lock("counter"):
+                count = state.dict("counter")["count"]
+                time.sleep(0.0001)
+                state.dict("counter")["count"] = count + 1
+
+    threads = [threading.Thread(target=increment, args=(state,)) for state in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter["count"] == 100
+
+def test_lock_times_out_while_another_worker_holds_it(client):
+    holder = RedisSharedState(client=client, prefix="test")
+    waiter = RedisSharedState(client=client, prefix="test", lock_timeout=0.05)
+
+    with holder.lock("message_limit:1"):
+        start_time = time.monotonic()
+        with pytest.raises(TimeoutError):
+            with waiter.lock("message_limit:1"):
+                pass
+        assert time.monotonic() - start_time >= 0.05
+        # Other names are not affected
+        with waiter.lock("message_limit:2"):
+            pass
+
+def test_expired_lock_is_not_released_by_its_former_holder(client):
+    slow_worker = RedisSharedState(client=client, prefix="test", lock_timeout=0.05)
+    other_worker = RedisSharedState(client=client, prefix="test")
+    lock_key = "test:lock:financial:1"
+
+    slow_lock = slow_worker.lock("financial:1")
+    slow_lock.__enter__()
+    # The slow worker outlives its lock, and another worker takes the lock over
+    time.sleep(0.1)
+    with other_worker.lock("financial:1"):
+        token = client.get(lock_key)
+        slow_lock.__exit__(None, None, None)
+        assert client.get(lock_key) == token
+    assert client.get(lock_key) is None
@@ -0,0 +1,62 @@
+import sqlite3
+
+import pytest
+
+from storage import Storage, SQLiteStorage
+
+@pytest.fixture
+def storage(tmp_path):
+    # A long interval keeps the background thread from flushing during a test
+    storage = SQLiteStorage(str(tmp_path / "bot.db"), flush_interval=60)
+    yield storage
+    storage.close()
+
+def stored_rows(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("SELECT namespace, key, value FROM kv ORDER BY namespace, key").fetchall()
+    finally:
+        connection.close()
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+def test_writes_are_visible_before_they_are_flushed(storage):
+    storage.set("limits", 1, 10)
+    storage.set("limits", 2, 20)
+    storage.delete("limits", 2)
+
+    assert stored_rows(storage.path) == []
+    assert storage.get("limits", 1) == 10
+    assert storage.get("limits", 2, "missing") == "missing"
+    assert storage.load("limits") == {1: 10}
+
+def test_flush_writes_the_latest_value_of_each_key(storage):
+    storage.set("limits", 1, 10)
+    storage.set("limits", 1, 11)
+    storage.set("limits", "1:2", [1.5, 2])
+    storage.flush()
+
+    assert stored_rows(storage.path) == [("limits", '"1:2"', "[1.5, 2]"), ("limits", "1", "11")]
+    assert storage.pending_writes == {}
+
+    storage.delete("limits", 1)
+    storage.flush()
+    assert stored_rows(storage.path) == [("limits", '"1:2"', "[1.5, 2]")]
+
+def test_close_flushes_pending_writes(tmp_path):
+    path = str(tmp_path / "bot.db")
+    storage = SQLiteStorage(path, flush_interval=60)
+    limits = storage.dict("limits")
+    limits[1] = 10
+    limits.pop(1)
+    limits[2] = 20
+    storage.close()
+
+    assert not storage.flush_thread.is_alive()
+    reopened = SQLiteStorage(path, flush_interval=60)
+    try:
+        assert reopened.load("limits") == {2: 20}
+    finally:
+        reopened.close()
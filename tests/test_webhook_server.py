@@ -0,0 +1,58 @@
+import json
+from queue import Queue
+
+import pytest
+
+from webhook_server import WebhookServer, WebhookConfig, SECRET_TOKEN_HEADER
+
+SECRET = "webhook-secret"
+UPDATE = json.dumps({"update_id": 1}).encode("utf-8")
+
+@pytest.fixture
+def make_server():
+    servers = []
+    def make_server(max_queue_size=10, secret_token=SECRET):
+        # Port 0 binds any free port; requests are handed to handle_update directly
+        config = WebhookConfig(webhook_url=None, port=0, secret_token=secret_token, max_queue_size=max_queue_size)
+        server = WebhookServer(None, Queue(), config)
+        servers.append(server)
+        return server
+    yield make_server
+    for server in servers:
+        server.httpd.server_close()
+
+def test_secret_token_is_required(make_server):
+    with pytest.raises(ValueError):
+        make_server(secret_token=None)
+
+def test_listens_on_loopback_by_default(make_server):
+    assert make_server().server_address[0] == "127.0.0.1"
+
+@pytest.mark.parametrize("headers", [{}, {SECRET_TOKEN_HEADER: ""}, {SECRET_TOKEN_HEADER: "wrong"}])
+def test_requests_without_the_secret_are_refused(make_server, headers):
+    server = make_server()
+
+    assert server.handle_update(headers, UPDATE) == 403
+    assert server.update_queue.empty()
+    assert server.get_stats()["rejected_unauthorized"] == 1
+
+def test_updates_are_queued(make_server):
+    server = make_server()
+
+    assert server.handle_update({SECRET_TOKEN_HEADER: SECRET}, UPDATE) == 200
+    assert server.update_queue.get_nowait().update_id == 1
+    assert server.handle_update({SECRET_TOKEN_HEADER: SECRET}, b"not json") == 400
+
+def test_updates_are_refused_while_the_queue_is_full(make_server):
+    server = make_server(max_queue_size=2)
+    headers = {SECRET_TOKEN_HEADER: SECRET}
+
+    assert [server.handle_update(headers, UPDATE) for _ in range(3)] == [200, 200, 503]
+    stats = server.get_stats()
+    assert stats["accepted"] == 2
+    assert stats["rejected_queue_full"] == 1
+    assert stats["max_queue_size_seen"] == 2
+
+    # Telegram's redelivery is accepted once the dispatcher catches up
+    server.update_queue.get_nowait()
+    assert server.handle_update(headers, UPDATE) == 200